@@ -0,0 +1,90 @@
+'''
+============================ BATCH MAGIC SQUARE SOLVER ========================
+Solves many magic squares in one process, instead of paying for a new python
+process (and its startup) for every puzzle like driver.sh does.
+
+Each argument can be:
+    - a directory: every *.txt file in it is solved, in sorted order
+    - a glob, e.g. 'tests/*.txt' (quote it so the shell doesn't expand it)
+    - a file, which may hold several puzzles concatenated back to back
+    - '-' to read concatenated puzzles from stdin
+
+One JSON object is printed per puzzle, as soon as it is solved:
+    {"grid": [[1, 8], [9, 8]], "index": 0, "result": true,
+     "source": "tests/sample1.txt", "stats": {"nodes": 2, ...},
+     "time": 0.0001}
+index is the position of the puzzle inside its source, time is the seconds
+spent in solve(), stats holds the counters of magic.SolveStats and grid is
+null when there is no solution. Puzzles that repeat, or are symmetric images
+of earlier ones, are answered from a magic.SolutionCache.
+-------------------------------------------------------------------------------
+Usage: python batch.py tests/ 'solution/tests/*.txt' - < puzzles.txt
+===============================================================================
+'''
+
+import glob
+import json
+import os
+import sys
+from timeit import default_timer as timer
+
+from magic import SolutionCache, SolveStats, read_puzzle, solve
+
+# Expands the command line arguments into a list of sources, in order
+def expand_sources(args):
+    sources = []
+    for arg in args:
+        if arg == '-':
+            sources.append(arg)
+        elif os.path.isdir(arg):
+            sources.extend(sorted(glob.glob(os.path.join(arg, '*.txt'))))
+        elif glob.has_magic(arg):
+            sources.extend(sorted(glob.glob(arg)))
+        else:
+            sources.append(arg)
+    return sources
+
+# Yields (source, index, grid, constraints) for every puzzle in the sources
+def iter_puzzles(sources):
+    for source in sources:
+        if source == '-':
+            reader = sys.stdin
+        else:
+            reader = open(source)
+
+        try:
+            index = 0
+            puzzle = read_puzzle(reader)
+            while puzzle is not None:
+                (grid, constraints) = puzzle
+                yield (source, index, grid, constraints)
+                index += 1
+                puzzle = read_puzzle(reader)
+        finally:
+            if reader is not sys.stdin:
+                reader.close()
+
+# Solves a single puzzle and packs the result for output. With a cache,
+# puzzles that were already solved, or are symmetric images of solved ones,
+# are answered from it.
+def solve_one(source, index, grid, constraints, cache=None):
+    stats = SolveStats()
+    start = timer()
+    result = solve(grid, constraints, stats, cache)
+    elapsed = timer() - start
+    return {'source': source, 'index': index, 'result': result is not None,
+            'time': elapsed, 'grid': result, 'stats': stats.as_dict()}
+
+# Solves every puzzle in the sources, writing a JSON line for each one
+def run_batch(sources, out=sys.stdout):
+    cache = SolutionCache()
+    for (source, index, grid, constraints) in iter_puzzles(sources):
+        out.write(json.dumps(solve_one(source, index, grid, constraints,
+                                       cache),
+                             sort_keys=True))
+        out.write('\n')
+        out.flush()
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1):
+        run_batch(expand_sources(sys.argv[1:]))
@@ -0,0 +1,261 @@
+'''
+=========================== MAGIC SQUARE BENCHMARKS ===========================
+Times magic.solve(), sat.solve_sat() and the BackjumpSolution in
+solution/magic.py on every puzzle in tests/ and solution/tests/ (or the
+sources given, as in batch.py).
+
+Every (solver, puzzle) case runs in a fresh process, so one case can't warm
+up or bloat the memory of the next. A case first solves the puzzle --warmup
+times untimed, then --trials times timed. It records:
+    time_min, time_median, time_mean, times  wall seconds spent in solve()
+    nodes       values placed on the grid (assign calls), or branching
+                decisions of the SAT solver
+    backtracks  values taken back off the grid (unassign calls), or
+                conflicts of the SAT solver
+    peak_kb     growth of the max resident set size while solving, in KB
+    result      whether a solution was found
+Nodes and backtracks come from one extra run with the counters hooked in, so
+the counting never slows down the timed runs. All three solvers are
+deterministic, so the counts are exact.
+
+The results are written as JSON to --out (bench_latest.json, which is not
+tracked). Given --compare with an older file, every case whose median time
+grew by more than --tolerance, or whose result or node count changed, is
+printed and the exit status is 1. The committed baseline only changes when
+it is asked for:
+    python bench.py -c bench_baseline.json      check for regressions
+    python bench.py -o bench_baseline.json      refresh the baseline
+-------------------------------------------------------------------------------
+Usage: python bench.py [-n TRIALS] [-w WARMUP] [-s SOLVER] [-o OUT]
+                       [-c BASELINE] [-t TOLERANCE] [sources...]
+===============================================================================
+'''
+
+import argparse
+import imp
+import json
+import os
+import platform
+import resource
+import sys
+from multiprocessing import Pool
+from StringIO import StringIO
+from timeit import default_timer as timer
+
+from batch import expand_sources
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOURCES = [os.path.join(HERE, 'tests'),
+                   os.path.join(HERE, 'solution', 'tests')]
+DEFAULT_OUT = os.path.join(HERE, 'bench_latest.json')
+
+# Median times below this many seconds are too noisy to call a regression
+MIN_REGRESSION = 0.001
+
+# SOLVERS
+# Each solver is a (load, count) pair of functions, called in the case's own
+# process. load(path) returns a function that solves the puzzle once and
+# returns True if it found a solution; any setup, like reading the file, is
+# done before the timer starts. count(counts) hooks the solver's assign and
+# unassign (decisions and conflicts for SAT) so they bump counts['nodes']
+# and counts['backtracks'].
+
+def load_magic(path):
+    import magic
+    def run():
+        (grid, constraints) = magic.read_input(path)
+        start = timer()
+        result = magic.solve(grid, constraints)
+        return (timer() - start, result is not None)
+    return run
+
+def count_magic(counts):
+    import magic
+    count_calls(magic.SolverState, 'assign', counts, 'nodes')
+    count_calls(magic.SolverState, 'unassign', counts, 'backtracks')
+
+def load_sat(path):
+    import magic
+    from sat import solve_sat
+    def run():
+        (grid, constraints) = magic.read_input(path)
+        start = timer()
+        result = solve_sat(grid, constraints)
+        return (timer() - start, result is not None)
+    return run
+
+# A decision is a branch variable picked, the last call (which finds none
+# left) doesn't count. Every conflict past level 0 is analyzed once.
+def count_sat(counts):
+    from sat import SatSolver
+    pick_branch_var = SatSolver.pick_branch_var
+    def counted(self):
+        v = pick_branch_var(self)
+        if v is not None: counts['nodes'] += 1
+        return v
+    SatSolver.pick_branch_var = counted
+    count_calls(SatSolver, 'analyze', counts, 'backtracks')
+
+# solution/magic.py is loaded under another name, so it doesn't clash with
+# magic.py
+def import_backjump():
+    return imp.load_source('backjump',
+                           os.path.join(HERE, 'solution', 'magic.py'))
+
+def load_backjump(path):
+    backjump = import_backjump()
+    def run():
+        solution = backjump.BackjumpSolution(path)
+        # It prints its result, so stdout is captured to read it back
+        out = StringIO()
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            start = timer()
+            solution.solve()
+            elapsed = timer() - start
+        finally:
+            sys.stdout = stdout
+        return (elapsed, out.getvalue().startswith('True'))
+    return run
+
+def count_backjump(counts):
+    backjump = import_backjump()
+    count_calls(backjump.BackjumpSolution, 'assign', counts, 'nodes')
+    count_calls(backjump.BackjumpSolution, 'unassign', counts, 'backtracks')
+
+SOLVERS = {
+    'magic': (load_magic, count_magic),
+    'sat': (load_sat, count_sat),
+    'backjump': (load_backjump, count_backjump),
+}
+
+# Replaces cls.name with a wrapper that bumps counts[key] on every call
+def count_calls(cls, name, counts, key):
+    method = getattr(cls, name)
+    def counted(self, *args):
+        counts[key] += 1
+        return method(self, *args)
+    setattr(cls, name, counted)
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+# Runs in a fresh worker: benchmarks one solver on one puzzle file
+def run_case(args):
+    (solver, path, trials, warmup) = args
+    (load, count) = SOLVERS[solver]
+    run = load(path)
+
+    rss = max_rss_kb()
+    for k in xrange(warmup):
+        run()
+    times = []
+    for k in xrange(trials):
+        (elapsed, result) = run()
+        times.append(elapsed)
+    peak_kb = max_rss_kb() - rss
+
+    # The counted run goes last, since the hooks stay in for good
+    counts = {'nodes': 0, 'backtracks': 0}
+    count(counts)
+    run()
+
+    return {'solver': solver, 'file': os.path.relpath(path, HERE),
+            'result': result, 'nodes': counts['nodes'],
+            'backtracks': counts['backtracks'], 'peak_kb': peak_kb,
+            'time_min': min(times), 'time_median': median(times),
+            'time_mean': sum(times) / len(times), 'times': times}
+
+# Benchmarks every solver on every file, in order. Yields one case at a time.
+def run_bench(files, solvers, trials=5, warmup=1):
+    for path in files:
+        for solver in solvers:
+            # A new process per case, so memory and caches start out clean
+            pool = Pool(1)
+            try:
+                yield pool.apply(run_case, ((solver, path, trials, warmup),))
+            finally:
+                pool.terminate()
+                pool.join()
+
+# Returns a line describing every case that got worse since the baseline
+def compare(cases, baseline, tolerance):
+    old_cases = dict(((case['solver'], case['file']), case)
+                     for case in baseline['cases'])
+    problems = []
+    for case in cases:
+        old = old_cases.get((case['solver'], case['file']))
+        if old is None: continue
+
+        name = '%s %s' % (case['solver'], case['file'])
+        if case['result'] != old['result']:
+            problems.append('%s: result %s, was %s'
+                            % (name, case['result'], old['result']))
+        if case['nodes'] != old['nodes']:
+            problems.append('%s: %d nodes, was %d'
+                            % (name, case['nodes'], old['nodes']))
+        limit = max(old['time_median'] * (1 + tolerance), MIN_REGRESSION)
+        if case['time_median'] > limit:
+            problems.append('%s: median %.4fs, was %.4fs'
+                            % (name, case['time_median'],
+                               old['time_median']))
+    return problems
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the magic square solvers.')
+    parser.add_argument('sources', nargs='*',
+                        help='directories, globs or puzzle files '
+                             '(default: tests/ and solution/tests/)')
+    parser.add_argument('-n', '--trials', type=int, default=5,
+                        help='timed runs per case (default: %(default)s)')
+    parser.add_argument('-w', '--warmup', type=int, default=1,
+                        help='untimed runs per case (default: %(default)s)')
+    parser.add_argument('-s', '--solver', action='append',
+                        choices=sorted(SOLVERS),
+                        help='solver to run, may be repeated (default: all)')
+    parser.add_argument('-o', '--out', default=DEFAULT_OUT,
+                        help='JSON file to write (default: %(default)s)')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='JSON file of an earlier run to compare with')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25,
+                        help='allowed growth of the median time '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    files = expand_sources(args.sources or DEFAULT_SOURCES)
+    solvers = args.solver or sorted(SOLVERS)
+
+    cases = []
+    for case in run_bench(files, solvers, args.trials, args.warmup):
+        print '%-8s %-40s %-5s %8d nodes %8d backtracks %7d KB %.4fs' % (
+            case['solver'], case['file'], case['result'], case['nodes'],
+            case['backtracks'], case['peak_kb'], case['time_median'])
+        sys.stdout.flush()
+        cases.append(case)
+
+    # Load the baseline first, in case it is the file about to be replaced
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as reader:
+            baseline = json.load(reader)
+
+    with open(args.out, 'w') as writer:
+        json.dump({'python': platform.python_version(),
+                   'trials': args.trials, 'warmup': args.warmup,
+                   'cases': cases}, writer, indent=1, sort_keys=True)
+        writer.write('\n')
+
+    if baseline is not None:
+        problems = compare(cases, baseline, args.tolerance)
+        for problem in problems:
+            print 'REGRESSION ' + problem
+        if problems: sys.exit(1)
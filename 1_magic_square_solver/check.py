@@ -2,10 +2,11 @@
 # The first command line argument should be the path to test case file.
 # The second command line argument should be the path to completed square file.
 # The third command line argument should be a boolean denoting whether if there exists a valid solution.
+# The optional fourth and fifth command line arguments are the lowest and highest value a cell may take (default 0 and 9).
 
 import sys
 
-def check(input_file_path, output_file_path, isValid):
+def check(input_file_path, output_file_path, isValid, lo=0, hi=9):
 	size = -1
 	input_grid = []
 	row_sums = []
@@ -37,14 +38,14 @@ def check(input_file_path, output_file_path, isValid):
 				return False
 			output_grid.append(vals)
 
-	# check if output does not contradict input values, and is in range [0,9]
+	# check if output does not contradict input values, and is in range [lo,hi]
 	for i in xrange(size):
 		for j in xrange(size):
 			input_val = input_grid[i][j]
 			output_val = output_grid[i][j]
 			if (input_val != -1) and (input_val != output_val):
 				return False
-			if (output_val < 0) or (output_val > 9):
+			if (output_val < lo) or (output_val > hi):
 				return False
 
 	# check for row sums
@@ -82,4 +83,6 @@ def check(input_file_path, output_file_path, isValid):
 input_file_path = sys.argv[1]
 output_file_path = sys.argv[2]
 isValid = sys.argv[3]
-print check(input_file_path, output_file_path, isValid)
\ No newline at end of file
+lo = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+hi = int(sys.argv[5]) if len(sys.argv) > 5 else 9
+print check(input_file_path, output_file_path, isValid, lo, hi)
\ No newline at end of file
@@ -39,7 +39,9 @@ check 2 tests/sample2.txt True 1 1
 check 3 tests/sample2_fail.txt False 1 1
 check 4 tests/sample3.txt True 1 1
 check 5 tests/sample3_fail.txt False 1 1
+check 6 tests/restarts1.txt True 1 1
+check 7 tests/restarts2.txt True 1 1
 rm driver_output.txt
 
-echo "TOTAL SCORE: ${SCORE}/5 POINTS."
+echo "TOTAL SCORE: ${SCORE}/7 POINTS."
 echo "TOTAL TIME: ${TIME} SECONDS."
\ No newline at end of file
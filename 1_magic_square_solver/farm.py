@@ -0,0 +1,146 @@
+'''
+============================ PARALLEL PUZZLE FARM ==============================
+Solves many magic squares across a pool of worker processes. Takes the same
+sources as batch.py (directories, globs, multi-puzzle files or '-') and prints
+the same JSON lines, in the same order as the puzzles were read.
+
+Puzzles are sent to the workers in chunks. At most --queue chunks are in
+flight at once, so a huge stream of puzzles is never read into memory all at
+once. Every puzzle gets its own time limit (1 second by default, as in
+driver.sh); a puzzle that runs out of time is reported with "result": null
+and "timed_out": true and the worker moves on to the next one.
+-------------------------------------------------------------------------------
+Usage: python farm.py [-j JOBS] [-t TIMEOUT] [-c CHUNK] [-q QUEUE] sources...
+===============================================================================
+'''
+
+import argparse
+import json
+import signal
+import sys
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+from batch import expand_sources, iter_puzzles, solve_one
+from magic import SolutionCache
+
+# Time limit of every test in driver.sh. solution/driver.sh gives its harder
+# tests up to 10 seconds, pass -t 10 for those.
+DEFAULT_TIMEOUT = 1.0
+
+# Solutions seen by this worker process, see init_worker
+worker_cache = None
+
+# True while the worker's cache is being read or changed, and whether a
+# timeout came in meanwhile, see GuardedCache
+cache_busy = False
+timeout_pending = False
+
+class SolveTimeout(Exception):
+    pass
+
+def raise_timeout(signum, frame):
+    global timeout_pending
+    if cache_busy:
+        timeout_pending = True
+        return
+    raise SolveTimeout()
+
+# A SolutionCache that the timeout can't interrupt. Both of its methods
+# relink the entries of an OrderedDict, which an exception raised halfway
+# through would leave broken for every later puzzle of the worker. A timeout
+# that fires during one of them is held back and raised once it is done.
+class GuardedCache(SolutionCache):
+    def lookup(self, *args):
+        return self.guarded(SolutionCache.lookup, args)
+
+    def add(self, *args):
+        return self.guarded(SolutionCache.add, args)
+
+    def guarded(self, method, args):
+        global cache_busy, timeout_pending
+        cache_busy = True
+        try:
+            return method(self, *args)
+        finally:
+            cache_busy = False
+            if timeout_pending:
+                timeout_pending = False
+                raise SolveTimeout()
+
+# Runs in a worker: solves every puzzle of a chunk, giving each one at most
+# timeout seconds. Returns the results in the same order.
+def solve_chunk(chunk, timeout):
+    results = []
+    signal.signal(signal.SIGALRM, raise_timeout)
+    for (source, index, grid, constraints) in chunk:
+        try:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            result = solve_one(source, index, grid, constraints,
+                               worker_cache)
+            result['timed_out'] = False
+        except SolveTimeout:
+            result = {'source': source, 'index': index, 'result': None,
+                      'time': timeout, 'grid': None, 'stats': None,
+                      'timed_out': True}
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        results.append(result)
+    return results
+
+# Used by the pool so workers leave Ctrl-C to the parent process. Each
+# worker keeps its own cache of solutions.
+def init_worker():
+    global worker_cache
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker_cache = GuardedCache()
+
+# Yields the results of every puzzle in the sources, in order. At most
+# queue_size chunks of chunk_size puzzles are waiting on the pool at once.
+def run_farm(sources, jobs=None, timeout=DEFAULT_TIMEOUT, chunk_size=8,
+             queue_size=None):
+    if jobs is None: jobs = cpu_count()
+    if queue_size is None: queue_size = 4 * jobs
+
+    puzzles = iter_puzzles(sources)
+    pool = Pool(jobs, init_worker)
+    pending = deque()
+    try:
+        while True:
+            # Top up the queue, then wait on the oldest chunk
+            while len(pending) < queue_size:
+                chunk = list(islice(puzzles, chunk_size))
+                if chunk == []: break
+                pending.append(pool.apply_async(solve_chunk,
+                                                (chunk, timeout)))
+            if len(pending) == 0: break
+
+            for result in pending.popleft().get():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Solve magic squares on a pool of processes.')
+    parser.add_argument('sources', nargs='+',
+                        help='directories, globs, puzzle files or -')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('-t', '--timeout', type=float,
+                        default=DEFAULT_TIMEOUT,
+                        help='seconds allowed per puzzle (default: %(default)s)')
+    parser.add_argument('-c', '--chunk', type=int, default=8,
+                        help='puzzles sent to a worker at a time')
+    parser.add_argument('-q', '--queue', type=int, default=None,
+                        help='chunks in flight at once (default: 4 per job)')
+    args = parser.parse_args()
+
+    for result in run_farm(expand_sources(args.sources), args.jobs,
+                           args.timeout, args.chunk, args.queue):
+        sys.stdout.write(json.dumps(result, sort_keys=True))
+        sys.stdout.write('\n')
+        sys.stdout.flush()
@@ -1,54 +1,244 @@
 '''
 Create randomized test cases
+
+A puzzle is made by filling an n x n grid with random values 0..9, taking its
+row/col/diag sums as the constraints, then blanking exactly `blanks` distinct
+cells. The filled grid is a solution, so the puzzle is always solvable.
+
+An unsatisfiable variant shifts the constraint of one line. If that line is
+a row or col, a col or row gets the same shift, so the row and col totals
+still agree and the puzzle isn't thrown out by that check alone. The shift
+keeps every constraint a sum its own line can reach (a line of values 0..9
+reaches every sum between its smallest and largest), so that the solver
+can't refute the puzzle one line at a time. A shift far enough out is still
+refuted by the first pruning, and one close to 0 is usually solvable, so the
+furthest shift out that the pruning lets through is looked for on both sides
+(see boundary_shift), and a budgeted run of the solver decides if it has no
+solution. A few lines are tried. If none works out, which happens when the
+grid has so many blanks that every reachable constraint can be met, the
+first line is pushed past the largest sum its free cells can reach (every
+free cell at 9) instead.
+
+Every puzzle comes from its own seed, so any instance of a corpus can be made
+again with generate_puzzle(n, blanks, seed, unsat).
+
+Usage:
+    python generate_filled.py n blanks                  one puzzle to stdout
+    python generate_filled.py n blanks -c 1000 -s 7 -u 0.2 -o corpus/
+Written to a directory, every puzzle gets its own file, named after its
+size, blank count and seed, with _fail at the end if it has no solution.
+index.jsonl in the same directory lists the file, seed, size, blank count
+and solvability of each puzzle. Without -o the puzzles are written back to
+back to stdout, which batch.py and farm.py read with '-'.
 '''
-from random import randint
+import argparse
+import json
+import os
+import random
 import sys
-import math
-
-def generate(n, neg_count=None, neg_fn = None):
-    print n
-    grid = [[0]*n for _ in xrange(n)]
-    for i in xrange(n):
-        for j in xrange(n):
-            grid[i][j] = randint(0,9)
-    
-    row_sums = []
-    for i in xrange(n):
-        row_sums.append(sum(grid[i]))
-    row_str = [str(x) for x in row_sums]
-
-    col_sums = [0]*n
-    for i in xrange(n):
-        for j in xrange(n):
-            col_sums[j] += grid[i][j]
-    col_str = [str(x) for x in col_sums]
-
-    diag_sums = [0,0]
-    for i in xrange(n):
-        diag_sums[0] += grid[i][i]
-        diag_sums[1] += grid[i][n-i-1]
-    diag_str = [str(x) for x in diag_sums]
-
-    if neg_fn is not None and neg_count is not None:
-        neg_fn(grid, neg_count)
-
-    for i in xrange(n):
-        grid_str = [str(x) for x in grid[i]]
-        print ' '.join(grid_str)
-
-    print ' '.join(row_str)
-    print ' '.join(col_str)
-    print ' '.join(diag_str)
-
-def rand_neg(grid, neg_count):
-    for k in xrange(neg_count):
-        i = randint(0,len(grid)-1)
-        j = randint(0, len(grid)-1)
-        grid[i][j] = -1
-    
 
+from magic import NOGOOD_CAPACITY, NogoodStore, SolverState, SolveStats, search
+
+# Backtracks the solver may spend showing that an unsat variant has no
+# solution, before that shift is given up on
+UNSAT_BUDGET = 200
+# Lines tried per unsat variant
+UNSAT_LINES = 4
+
+def filled_grid(n, rng):
+    return [[rng.randint(0, 9) for j in xrange(n)] for i in xrange(n)]
+
+# Returns the [row sums, col sums, diag sums] of a filled grid
+def line_sums(grid):
+    n = len(grid)
+    row_sums = [sum(grid[i]) for i in xrange(n)]
+    col_sums = [sum(grid[i][j] for i in xrange(n)) for j in xrange(n)]
+    diag_sums = [sum(grid[i][i] for i in xrange(n)),
+                 sum(grid[i][n-i-1] for i in xrange(n))]
+    return [row_sums, col_sums, diag_sums]
+
+# Sets exactly blanks distinct cells to -1
+def blank_cells(grid, blanks, rng):
+    n = len(grid)
+    for k in rng.sample(xrange(n * n), blanks):
+        grid[k // n][k % n] = -1
+
+# Returns the cells of line (numbered like magic.SolverState's line ids)
+def cells_of(n, line):
+    if line < n:
+        return [(line, j) for j in xrange(n)]
+    elif line < 2 * n:
+        return [(i, line - n) for i in xrange(n)]
+    elif line == 2 * n:
+        return [(i, i) for i in xrange(n)]
+    return [(i, n-i-1) for i in xrange(n)]
+
+# Returns the (kind, index) of line in constraints
+def constraint_of(n, line):
+    return divmod(line, n) if line < 2 * n else (2, line - 2 * n)
+
+# Returns the shifts lo..hi of line's constraint that keep it a sum its own
+# cells can reach
+def shift_range(grid, constraints, line):
+    n = len(grid)
+    cells = cells_of(n, line)
+    fixed = sum(grid[i][j] for (i, j) in cells if grid[i][j] != -1)
+    free = sum(1 for (i, j) in cells if grid[i][j] == -1)
+    (kind, k) = constraint_of(n, line)
+    return (fixed - constraints[kind][k],
+            fixed + 9 * free - constraints[kind][k])
+
+# Returns a copy of constraints with every line of lines shifted by shift
+def shifted(constraints, n, lines, shift):
+    constraints = [sums[:] for sums in constraints]
+    for line in lines:
+        (kind, k) = constraint_of(n, line)
+        constraints[kind][k] += shift
+    return constraints
+
+# Returns True if the solver's first pruning shows the puzzle has no solution
+def refuted_by_pruning(grid, constraints):
+    state = SolverState([row[:] for row in grid], constraints, SolveStats())
+    return not state.propagate_all()
+
+# Returns True if a run of the solver shows, within UNSAT_BUDGET
+# backtracks, that the puzzle has no solution
+def refuted_by_search(grid, constraints):
+    state = SolverState([row[:] for row in grid], constraints, SolveStats())
+    if state.is_complete(): return False
+    if not state.propagate_all(): return True
+    return search(state, NogoodStore(NOGOOD_CAPACITY), UNSAT_BUDGET) is False
+
+# Returns the shift of lines from 0 towards end that is furthest out while
+# the first pruning can't refute it, or None if that is 0. Shift 0 is the
+# generated puzzle, which has a solution, so this is a binary search for
+# where the pruning starts to refute.
+def boundary_shift(grid, constraints, lines, end):
+    n = len(grid)
+    if not refuted_by_pruning(grid, shifted(constraints, n, lines, end)):
+        return end
+    (passed, refuted) = (0, end)
+    while abs(refuted - passed) > 1:
+        middle = passed + (refuted - passed) // 2
+        if refuted_by_pruning(grid, shifted(constraints, n, lines, middle)):
+            refuted = middle
+        else:
+            passed = middle
+    return passed if passed != 0 else None
+
+# Makes the puzzle impossible to fill, see the top of the file
+def make_unsat(grid, constraints, rng):
+    n = len(grid)
+    fallback = None
+    for attempt in xrange(UNSAT_LINES):
+        line = rng.randrange(2 * n + 2)
+        lines = [line]
+        if line < 2 * n:
+            # Shift a line of the other kind too, to keep the totals equal
+            lines.append(rng.randrange(n) + (n if line < n else 0))
+        if fallback is None:
+            (unused, top) = shift_range(grid, constraints, line)
+            fallback = (lines, top + rng.randint(1, 3))
+
+        # Shifts that keep every shifted line reachable
+        (lo, hi) = (-sys.maxint, sys.maxint)
+        for other in lines:
+            (other_lo, other_hi) = shift_range(grid, constraints, other)
+            (lo, hi) = (max(lo, other_lo), min(hi, other_hi))
+
+        for end in (hi, lo):
+            if end == 0: continue
+            shift = boundary_shift(grid, constraints, lines, end)
+            if shift is None: continue
+            candidate = shifted(constraints, n, lines, shift)
+            if refuted_by_search(grid, candidate):
+                constraints[:] = candidate
+                return
+
+    (lines, shift) = fallback
+    constraints[:] = shifted(constraints, n, lines, shift)
+
+# Returns the (grid, constraints) of a random puzzle. The same arguments
+# always give the same puzzle.
+def generate_puzzle(n, blanks, seed, unsat=False):
+    rng = random.Random(seed)
+    grid = filled_grid(n, rng)
+    constraints = line_sums(grid)
+    blank_cells(grid, blanks, rng)
+    if unsat:
+        make_unsat(grid, constraints, rng)
+    return (grid, constraints)
+
+# Writes a puzzle in the format read by magic.read_input
+def write_puzzle(out, grid, constraints):
+    out.write('%d\n' % len(grid))
+    for row in grid:
+        out.write(' '.join(str(x) for x in row) + '\n')
+    for sums in constraints:
+        out.write(' '.join(str(x) for x in sums) + '\n')
+
+def puzzle_name(n, blanks, seed, unsat):
+    return 'n%d_b%d_s%d%s.txt' % (n, blanks, seed, '_fail' if unsat else '')
+
+# Writes count puzzles with seeds seed, seed+1, ... Roughly a fraction
+# unsat_rate of them (picked by the master seed) have no solution. With a
+# directory, each goes to its own file and index.jsonl lists them; without
+# one, they are written back to back to out.
+def generate_corpus(n, blanks, count, seed, unsat_rate=0.0, directory=None,
+                    out=sys.stdout):
+    picker = random.Random(seed)
+    index = None
+    if directory is not None:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        index = open(os.path.join(directory, 'index.jsonl'), 'w')
+
+    try:
+        for k in xrange(count):
+            puzzle_seed = seed + k
+            unsat = picker.random() < unsat_rate
+            (grid, constraints) = generate_puzzle(n, blanks, puzzle_seed,
+                                                  unsat)
+            if directory is None:
+                write_puzzle(out, grid, constraints)
+                continue
+
+            name = puzzle_name(n, blanks, puzzle_seed, unsat)
+            with open(os.path.join(directory, name), 'w') as writer:
+                write_puzzle(writer, grid, constraints)
+            index.write(json.dumps({'file': name, 'seed': puzzle_seed,
+                                    'n': n, 'blanks': blanks,
+                                    'solvable': not unsat},
+                                   sort_keys=True))
+            index.write('\n')
+    finally:
+        if index is not None:
+            index.close()
 
 if __name__ == '__main__':
-    count = int(sys.argv[1])
-    neg_count = int(sys.argv[2])
-    generate(count, neg_count, rand_neg)
+    parser = argparse.ArgumentParser(
+        description='Generate random magic square puzzles.')
+    parser.add_argument('n', type=int, help='size of the grid')
+    parser.add_argument('blanks', type=int, help='free cells per puzzle')
+    parser.add_argument('-c', '--count', type=int, default=1,
+                        help='puzzles to generate (default: %(default)s)')
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='seed of the first puzzle (default: random)')
+    parser.add_argument('-u', '--unsat', type=float, default=0.0,
+                        help='fraction of unsolvable puzzles '
+                             '(default: %(default)s)')
+    parser.add_argument('-o', '--out', default=None,
+                        help='directory to write the puzzles to '
+                             '(default: stdout)')
+    args = parser.parse_args()
+
+    if args.n < 1:
+        parser.error('n must be at least 1')
+    if not 0 <= args.blanks <= args.n * args.n:
+        parser.error('blanks must be between 0 and n*n')
+    seed = args.seed
+    if seed is None:
+        seed = random.SystemRandom().randrange(1 << 31)
+
+    generate_corpus(args.n, args.blanks, args.count, seed, args.unsat,
+                    args.out)
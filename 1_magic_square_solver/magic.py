@@ -6,42 +6,72 @@ This is an implementation of an iterative backtracking algorithm that finds a
 solution for a NxN magic square, which is an incomplete grid with sum 
 constraints for the rows, columns, and 2 diagonals.
 
-The domains are pruned once in the beginning and pruned again every time a new
-value is placed on the grid or a value is removed from the grid (backtracked).
-The domain pruning works in 2 sequential stages:
+The domains are pruned once in the beginning of the search, in 2 sequential
+stages:
     1) Prune the domains based on the sum/col/diag constraints
     2) Prune the domains based on the lower/upper bounds of other variables
 
-For backtracking, a list of variables is kept, which is sorted according to
-two most-constraining heuristics:
+After that, pruning is incremental. A SolverState keeps the row, col and diag
+sums, and the sum of the lowest and highest values the free variables of each
+line can take. When a value is placed, only the row, col and diags through
+that cell are re-pruned, and any variable whose domain shrinks queues its own
+lines, until nothing changes. Every domain change is recorded on a trail.
+If a domain has holes, the line also drops every value that can't be summed
+up to the constraint with the other domains (see reachable_sums). Before any
+of this, the row sums and the col sums must add up to the same grid total.
+
+Variables are picked with two most-constraining heuristics:
     1) From the smallest domains to the largest
     2) Highest total of other variables in same row/col/diag to lowest
 
-From the beginning, the variables are sorted from most to least constrained,
-    [X0, X1, X2, .... , Xn]
-      ^
-with a variable pointer to the current variable being working on.
-
+Each decision is pushed on a stack together with the trail length at that
+point,
+    [X0, X1, X2, .... , Xi]
+                         ^
 Each value is popped off current variable domain (which is well-pruned). Each
-value is tried on the grid and if it doesn't break constraints: (1) the 
-variables are RE-SORTED and (2) the domains are RE-PRUNED from i+1 and onward.
-Finally, the variable pointer is incremented to work on the next variable,
-    [X0, X1', X2', .... , Xn']
-          ^
-
-If the domain is flushed and a good value wasn't found for the variable, then
-the variable pointer is decremented, the previous value is removed because it
-led to a bad path and, again, (1) the variables are RE-SORTED and (2) the
-domains are RE-PRUNED from i + 1 and onward,
-    [X0, X1'', X2'', .... , Xn'']
-      ^
+value is tried on the grid and if it doesn't break constraints, the lines
+through it are pruned and the next most constrained variable is pushed,
+    [X0, X1, X2, .... , Xi, Xi+1]
+                             ^
+
+If a value breaks constraints, the trail is popped back to the mark of the
+variable, which restores every domain exactly as it was without re-pruning.
+The bad value is then removed from the domain for good, and that removal is
+propagated like any other domain change.
+If the domain is flushed and a good value wasn't found for the variable, the
+variable is popped off the stack and we backtrack to the previous one,
+    [X0, X1, X2, .... , Xi]
+                         ^
+
+Random puzzles have a heavy tail of runs that get stuck deep in a bad part of
+the search tree. So once a run has backtracked more than its budget, it
+undoes everything and restarts with the ties between variables broken in a
+new random order, and from then on variables are picked by domain size
+alone and values at random. Budgets follow the Luby sequence
+(1 1 2 1 1 2 4 ...) times RESTART_UNIT. Every domain change and every failure
+keeps track of the decisions it came from, so a failed value is remembered as
+a nogood made of just those decisions, and the search jumps straight back to
+the latest decision the failure depends on instead of the one before it.
+
+If the puzzle (given cells and sums) maps onto itself under a symmetry of the
+square, like a transpose or a mirror that swaps the diagonals, its solutions
+come in symmetric pairs, and only one of each pair is searched for (see
+find_symmetry). A SolutionCache keyed by a canonical form of the puzzle
+answers repeated and symmetric puzzles without any search.
+
+Cells take the values D_MIN..D_MAX (0..9) unless solve() is given other
+ranges, one for the whole grid (say 0..255, or 1..n*n for a classic magic
+square) or one per cell. Domains stay bitmasks at any width; see DOMAINS for
+how their min/max/size lookups scale.
+
+iter_solutions() and count_solutions() (see ENUMERATION) go through every
+solution instead of stopping at the first: --all streams them out, --count
+only counts them, caching the counts of subproblems that come up again.
 
 Success is returned whenever a complete grid is created that satisfies all 
 constraints.
 
-Failure is returned in 2 cases:
-  1) Backtracking reaches back to the first variable and the domain is empty.
-  2) Forwarding reaches the last variable and the domain is flushed out.
+Failure is returned when backtracking pops the first variable off the stack.
 ===============================================================================
 
 -------------------------------------------------------------------------------
@@ -69,93 +99,998 @@ True
 -------------------------------------------------------------------------------
 '''
 
+import argparse
+import json
+import random
 import sys
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+# NumPy is optional, it only speeds up the pruning of large grids
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 D_MIN = 0
 D_MAX = 9
 
-# Given a grid and constraints, returns True if the grid is consistent with 
-# its constraints; False otherwise
-# We check the following constraints:
-#   - the sum of a row/col/diag <= the row/col/diag constraint
-#   - any free variable must have a nonempty domain
-#   - if the board is filled, it must be complete
-def is_consistent(grid, constraints):
+# Smallest grid worth the overhead of the vectorized pruning
+NUMPY_MIN_SIZE = 8
+
+# Backtracks allowed per unit of the Luby restart sequence
+RESTART_UNIT = 100
+# Most nogoods remembered at once
+NOGOOD_CAPACITY = 10000
+# Most subproblem counts count_solutions remembers before it starts over
+COUNT_CACHE_SIZE = 1 << 20
+# Seed for the variable order shuffles and value picks, so runs repeat
+RESTART_SEED = 381
+
+# DOMAINS
+# A domain is stored as a bitmask, where bit (v - lo) is set if value v is
+# still possible, for the range of values lo..hi a ValueRange stands for.
+# Removing a value is a single mask, and an empty domain is 0. The min, max,
+# size and "has no holes" of a domain are looked up in tables indexed by the
+# domain itself:
+#   - up to TABLE_BITS values, every domain is precomputed into a list. The
+#     default range D_MIN..D_MAX = 0..9 has only 1024 domains.
+#   - for wider ranges (0..255, or 1..n*n for a classic magic square) that
+#     would never fit, so each table is a DomainTable, a dict that computes
+#     the domains it is asked for and remembers them. Bitmasks are plain
+#     Python ints, so they grow to any width; only the domains the search
+#     actually meets are ever computed.
+TABLE_BITS = 12
+# Most domains a DomainTable remembers before it starts over
+DOMAIN_CACHE_SIZE = 1 << 16
+# Widest range the vectorized pruning can do, since it shifts int64s
+NUMPY_MAX_BITS = 62
+
+class DomainTable(dict):
+    def __init__(self, function):
+        dict.__init__(self)
+        self.function = function
+
+    def __missing__(self, domain):
+        if len(self) >= DOMAIN_CACHE_SIZE:
+            self.clear()
+        result = self[domain] = self.function(domain)
+        return result
+
+class ValueRange:
+    def __init__(self, lo, hi):
+        # -1 marks a free cell in the input, and the sums DP needs values
+        # that aren't negative
+        if lo < 0 or lo > hi:
+            raise ValueError('bad value range %d..%d' % (lo, hi))
+        self.lo = lo
+        self.hi = hi
+        self.bits = hi - lo + 1
+        self.full = (1 << self.bits) - 1
+        if self.bits <= TABLE_BITS:
+            domains = xrange(self.full + 1)
+            self.size = [self.domain_size(d) for d in domains]
+            self.min = [self.domain_min(d) for d in domains]
+            self.max = [self.domain_max(d) for d in domains]
+            # True if the domain has no holes, i.e. it is every value in
+            # min..max
+            self.interval = [self.domain_interval(d) for d in domains]
+        else:
+            self.size = DomainTable(self.domain_size)
+            self.min = DomainTable(self.domain_min)
+            self.max = DomainTable(self.domain_max)
+            self.interval = DomainTable(self.domain_interval)
+
+    def domain_size(self, domain):
+        return bin(domain).count('1')
+
+    def domain_min(self, domain):
+        if domain == 0: return None
+        return self.lo + (domain & -domain).bit_length() - 1
+
+    def domain_max(self, domain):
+        if domain == 0: return None
+        return self.lo + domain.bit_length() - 1
+
+    def domain_interval(self, domain):
+        if domain == 0: return False
+        low = domain >> ((domain & -domain).bit_length() - 1)
+        return (low & (low + 1)) == 0
+
+    # Returns the domain holding every value in lo..hi (0 if lo > hi)
+    def range(self, lo, hi):
+        lo = max(lo, self.lo)
+        hi = min(hi, self.hi)
+        if lo > hi: return 0
+        return ((1 << (hi - lo + 1)) - 1) << (lo - self.lo)
+
+    # Returns the domain holding only value
+    def bit(self, value):
+        return 1 << (value - self.lo)
+
+# Building the tables of a narrow range isn't free, so there is one
+# ValueRange per (lo, hi)
+value_range_cache = {}
+
+def value_range(lo, hi):
+    if (lo, hi) not in value_range_cache:
+        value_range_cache[(lo, hi)] = ValueRange(lo, hi)
+    return value_range_cache[(lo, hi)]
+
+DEFAULT_RANGE = value_range(D_MIN, D_MAX)
+
+# Returns (values, cells) for the ranges argument of solve(), which is one
+# of:
+#   - None, for D_MIN..D_MAX in every cell
+#   - a (lo, hi) pair, the same range for every cell
+#   - an n x n grid of (lo, hi) pairs, one range per cell
+# values is the ValueRange covering every cell's range, and cells is the
+# grid of the domains each cell starts from, or None if they all start full.
+def value_ranges(ranges, n):
+    if ranges is None: return (DEFAULT_RANGE, None)
+    if not isinstance(ranges[0], (list, tuple)):
+        (lo, hi) = ranges
+        return (value_range(lo, hi), None)
+
+    lo = min(cell_lo for row in ranges for (cell_lo, cell_hi) in row)
+    hi = max(cell_hi for row in ranges for (cell_lo, cell_hi) in row)
+    values = value_range(lo, hi)
+    cells = [[values.range(cell_lo, cell_hi) for (cell_lo, cell_hi) in row]
+             for row in ranges]
+    return (values, cells)
+
+# SUM DECOMPOSITION
+# Returns every sum that can be made by picking one value from each of the
+# domains, as a bitmask where bit s is set if sum s is reachable. This is the
+# subset-sum DP: start from {0} and shift the sums so far by every value of
+# the next domain.
+def reachable_sums(domains, domain_min=DEFAULT_RANGE.min):
+    sums = 1
+    for domain in domains:
+        new_sums = 0
+        while domain != 0:
+            new_sums |= sums << domain_min[domain]
+            domain &= domain - 1
+        sums = new_sums
+    return sums
+
+# Same as reachable_sums, for ranges wider than TABLE_BITS. A run of
+# consecutive values lo..lo+w-1 is shifted in by doubling (shifts 0..k-1
+# ORed with themselves shifted by k give 0..2k-1), so a domain costs
+# O(log w) big-int operations per run instead of one per value. For 0..9
+# the plain loop is quicker.
+def reachable_sums_wide(domains, domain_min):
+    sums = 1
+    for domain in domains:
+        new_sums = 0
+        while domain != 0:
+            low = domain & -domain
+            run = domain & ~(domain + low)  # lowest run of set bits
+            width = (run // low).bit_length()
+            shifted = sums << domain_min[domain]
+            covered = 1
+            while covered < width:
+                step = min(covered, width - covered)
+                shifted |= shifted << step
+                covered += step
+            new_sums |= shifted
+            domain &= ~run
+        sums = new_sums
+    return sums
+
+# Returns the lowest bits bits of x in reverse order
+def reverse_bits(x, bits):
+    return int(format(x, '0%db' % bits)[::-1], 2)
+
+# VARIABLE QUEUE
+# Indexed binary min-heap over the free variables, which are numbered r*n + c.
+# Besides the heap itself we keep the position of every variable in it, so a
+# variable's key can be changed in place in O(log n) whenever its domain or
+# its row/col/diag changes, instead of re-sorting every variable.
+class VarHeap:
+    def __init__(self, size):
+        self.heap = []
+        self.pos = [-1] * size  # -1 if the variable isn't in the heap
+        self.keys = [0] * size
+
+    def __len__(self):
+        return len(self.heap)
+
+    # Returns the variable with the smallest key, or None if empty
+    def top(self):
+        if self.heap == []: return None
+        return self.heap[0]
+
+    def push(self, var, key):
+        self.keys[var] = key
+        self.pos[var] = len(self.heap)
+        self.heap.append(var)
+        self.sift_up(self.pos[var])
+
+    def remove(self, var):
+        i = self.pos[var]
+        last = self.heap.pop()
+        self.pos[var] = -1
+        if last != var:
+            self.heap[i] = last
+            self.pos[last] = i
+            self.sift_up(i)
+            self.sift_down(self.pos[last])
+
+    # Changes the key of a variable that is in the heap
+    def update(self, var, key):
+        old_key = self.keys[var]
+        if key == old_key: return
+        self.keys[var] = key
+        if key < old_key:
+            self.sift_up(self.pos[var])
+        else:
+            self.sift_down(self.pos[var])
+
+    def sift_up(self, i):
+        heap, pos, keys = self.heap, self.pos, self.keys
+        var = heap[i]
+        key = keys[var]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if keys[heap[parent]] <= key: break
+            heap[i] = heap[parent]
+            pos[heap[i]] = i
+            i = parent
+        heap[i] = var
+        pos[var] = i
+
+    def sift_down(self, i):
+        heap, pos, keys = self.heap, self.pos, self.keys
+        size = len(heap)
+        var = heap[i]
+        key = keys[var]
+        while True:
+            child = 2 * i + 1
+            if child >= size: break
+            if child + 1 < size and keys[heap[child + 1]] < keys[heap[child]]:
+                child += 1
+            if keys[heap[child]] >= key: break
+            heap[i] = heap[child]
+            pos[heap[i]] = i
+            i = child
+        heap[i] = var
+        pos[var] = i
+
+# NOGOODS
+# A nogood is a set of decisions (var, value) that can't all be part of a
+# solution. Every failure comes with the decisions that caused it (see
+# SolverState.explain), so when a value fails, the nogood is that value plus
+# the decisions its failure came from, not the whole path down to it. That
+# makes it small enough to come up again under another variable order. They
+# are kept across restarts, so a dead end reached again is skipped right
+# away.
+#
+# Each nogood is indexed under every (var, value) pair in it, so a value is
+# checked against only the nogoods it is part of. Memory is bounded: past
+# capacity, the least recently used nogood goes.
+class NogoodStore:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.nogoods = OrderedDict()
+        self.watches = {}
+
+    def add(self, nogood):
+        if nogood in self.nogoods:
+            del self.nogoods[nogood]
+        else:
+            if len(self.nogoods) >= self.capacity:
+                (old, unused) = self.nogoods.popitem(last=False)
+                for pair in old:
+                    self.watches[pair].discard(old)
+            for pair in nogood:
+                self.watches.setdefault(pair, set()).add(nogood)
+        self.nogoods[nogood] = None
+
+    # Returns the decision bits (see SolverState.decided) of the rest of a
+    # nogood holding var = value whose other decisions all hold in the
+    # state, or None if there is no such nogood
+    def check(self, var, value, state):
+        grid = state.grid
+        n = state.n
+        for nogood in self.watches.get((var, value), ()):
+            reason = 0
+            for (other, other_value) in nogood:
+                if other == var: continue
+                (r, c) = divmod(other, n)
+                if grid[r][c] != other_value: break
+                reason |= state.decided[r][c]
+            else:
+                # Mark as recently used
+                del self.nogoods[nogood]
+                self.nogoods[nogood] = None
+                return reason
+        return None
+
+# RESTARTS
+# Returns the i-th term (from 1) of the Luby sequence 1 1 2 1 1 2 4 1 1 2 ...
+# Run i of the search may backtrack RESTART_UNIT * luby(i) times before it
+# gives up and restarts with a reshuffled variable order. The sequence grows
+# without bound, so some run always gets to finish.
+def luby(i):
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    while (1 << k) - 1 != i:
+        i -= (1 << (k - 1)) - 1
+        k = 1
+        while (1 << k) - 1 < i:
+            k += 1
+    return 1 << (k - 1)
+
+# SYMMETRY
+# The rows, cols and diagonals of a grid are mapped onto each other by every
+# symmetry of the square: the transposes, the mirror images (which swap the
+# two diagonals) and the rotations. Each is given as the cell (r, c) is
+# moved to, for an n x n grid.
+SYMMETRIES = [
+    ('identity', lambda n, r, c: (r, c)),
+    ('transpose', lambda n, r, c: (c, r)),
+    ('anti_transpose', lambda n, r, c: (n-1-c, n-1-r)),
+    ('flip_rows', lambda n, r, c: (n-1-r, c)),
+    ('flip_cols', lambda n, r, c: (r, n-1-c)),
+    ('rotate_180', lambda n, r, c: (n-1-r, n-1-c)),
+    ('rotate_90', lambda n, r, c: (c, n-1-r)),
+    ('rotate_270', lambda n, r, c: (n-1-c, r)),
+]
+# The ones that are their own inverse, see find_symmetry
+INVOLUTIONS = ['transpose', 'anti_transpose', 'flip_rows', 'flip_cols',
+               'rotate_180']
+
+# Returns the cells of every line, in the line id order of SolverState
+def lines_of(n):
+    lines = [[(r, c) for c in xrange(n)] for r in xrange(n)]
+    lines += [[(r, c) for r in xrange(n)] for c in xrange(n)]
+    lines.append([(i, i) for i in xrange(n)])
+    lines.append([(i, n-1-i) for i in xrange(n)])
+    return lines
+
+# Maps of every (n, move) worked out so far, see symmetry_maps
+SYMMETRY_MAPS = {}
+
+# Returns (cells, lines, puzzle) for the symmetry move on an n x n grid:
+# cells[k] is the cell (as r * n + c) that moves to cell k, lines[l] is the
+# line that moves onto line l, and puzzle is both in one, for a puzzle read
+# as one sequence of its cells and then its targets (see flat_puzzle). Only
+# worked out once per size and symmetry.
+def symmetry_maps(n, move):
+    key = (n, move)
+    if key not in SYMMETRY_MAPS:
+        cells = [None] * (n * n)
+        for r in xrange(n):
+            for c in xrange(n):
+                (tr, tc) = move(n, r, c)
+                cells[tr * n + tc] = r * n + c
+
+        # Line l moves onto the line holding the images of its cells. In a
+        # 1 x 1 grid every line holds the one cell, and stays where it is.
+        all_lines = lines_of(n)
+        line_ids = {}
+        for line, line_cells in enumerate(all_lines):
+            line_ids.setdefault(frozenset(line_cells), []).append(line)
+        lines = [None] * (2 * n + 2)
+        for line, line_cells in enumerate(all_lines):
+            image = line_ids[frozenset(move(n, r, c) for (r, c) in line_cells)]
+            lines[line if line in image else image[0]] = line
+        puzzle = cells + [n * n + line for line in lines]
+        SYMMETRY_MAPS[key] = (cells, lines, puzzle)
+    return SYMMETRY_MAPS[key]
+
+# Returns the puzzle as one list: the grid row by row, then the constraints
+# in line id order
+def flat_puzzle(grid, constraints):
+    return ([value for row in grid for value in row] + list(constraints[0]) +
+            list(constraints[1]) + list(constraints[2]))
+
+# Returns the puzzle moved by the symmetry move, as a (grid, targets) pair of
+# tuples: the grid row by row, and the constraints in line id order
+def transform_puzzle(grid, constraints, move):
     n = len(grid)
-
-    # Check the row/col/diag sum constraints
-    row_constraints = constraints[0]
-    col_constraints = constraints[1]
-    diag_constraints = constraints[2]
-
-    # Check if board is filled, then it must be complete as well
-    free_vars = 0
-    for row in grid: free_vars += row.count(-1)
-    if free_vars == 0: return is_complete(grid, constraints)
-
-    row_sums = [0] * n
-    col_sums = [0] * n
-    diag_sums = [0, 0]
-    for r in xrange(n):
-        for c in xrange(n):
-            value = grid[r][c]
-            if value != -1:
-                row_sums[r] += value
-                col_sums[c] += value
-
-                if (r == c): diag_sums[0] += value
-                if (r == n-1-c): diag_sums[1] += value
-
-    for i in xrange(n):
-        if row_sums[i] > row_constraints[i]: return False
-        if col_sums[i] > col_constraints[i]: return False
-
-    if diag_sums[0] > diag_constraints[0]: return False
-    if diag_sums[1] > diag_constraints[1]: return False
-
+    flat = flat_puzzle(grid, constraints)
+    image = [flat[k] for k in symmetry_maps(n, move)[2]]
+    return (tuple(tuple(image[r * n:(r + 1) * n]) for r in xrange(n)),
+            tuple(image[n * n:]))
+
+# Returns True if sequence is left unchanged when read in the order of the
+# map order, stopping at the first value that isn't
+def is_fixed(sequence, order):
+    for k in xrange(len(order)):
+        if sequence[order[k]] != sequence[k]: return False
     return True
 
-
-# Given a grid and constraints, returns True if the grid is filled and fulfills
-# the constraints. Returns false otherwise (not filled or violates constraints)
-def is_complete(grid, constraints):
+# Returns (key, move): the smallest of the puzzle's images under every
+# symmetry, and the symmetry that gives it. Puzzles that are symmetric
+# images of each other have the same key. Each image is only read as far as
+# its first value that differs from the smallest one so far.
+def canonical_form(grid, constraints):
     n = len(grid)
-
-    # Check the row/col/diag sum constraints
-    row_constraints = constraints[0]
-    col_constraints = constraints[1]
-    diag_constraints = constraints[2]
-
-    row_sums = [0] * n
-    col_sums = [0] * n
-    diag_sums = [0, 0]
-    for r in xrange(n):
-        for c in xrange(n):
-            value = grid[r][c]
-            if value == -1:
-                # Board must be full
-                return False
+    flat = flat_puzzle(grid, constraints)
+    (best, best_move) = (None, None)
+    for (name, move) in SYMMETRIES:
+        order = symmetry_maps(n, move)[2]
+        if best is not None:
+            for k in xrange(len(order)):
+                value = flat[order[k]]
+                if value != best[k]: break
             else:
-                row_sums[r] += value
-                col_sums[c] += value
-
-                if (r == c): diag_sums[0] += value
-                if (r == n-1-c): diag_sums[1] += value
+                continue
+            if value > best[k]: continue
+        best = [flat[k] for k in order]
+        best_move = move
+    key = (tuple(tuple(best[r * n:(r + 1) * n]) for r in xrange(n)),
+           tuple(best[n * n:]))
+    return (key, best_move)
+
+# Returns the name and move of the first symmetry in INVOLUTIONS that leaves
+# the puzzle unchanged, or None. Every solution S of such a puzzle is mapped
+# to another solution S' by the symmetry. The symmetry is its own inverse, so
+# it swaps the cells of every pair (p, move(p)), and S' holds the values of S
+# with each pair swapped. So of S and S', one has its first cells of the
+# pairs lexicographically no larger than its second cells, and only those
+# solutions need to be searched (see SolverState.propagate_lex). The 90
+# degree rotations aren't their own inverse, and any puzzle they fix is
+# fixed by rotate_180 too. With per-cell ranges (cells, see value_ranges),
+# the symmetry must map those onto themselves as well.
+def find_symmetry(grid, constraints, cells=None):
+    n = len(grid)
+    puzzle = flat_puzzle(grid, constraints)
+    for (name, move) in SYMMETRIES:
+        if name not in INVOLUTIONS: continue
+        (cell_map, line_map, puzzle_map) = symmetry_maps(n, move)
+        if not is_fixed(puzzle, puzzle_map): continue
+        if (cells is None or
+                is_fixed([domain for row in cells for domain in row],
+                         cell_map)):
+            return (name, move)
+    return None
 
-    for i in xrange(n):
-        if row_sums[i] != row_constraints[i]: return False
-        if col_sums[i] != col_constraints[i]: return False
+# SOLUTION CACHE
+# Remembers the solutions of solved puzzles under their canonical_form key,
+# with the solution moved the same way as the puzzle, or None if there was
+# none. Any puzzle that is the same up to symmetry is then answered by moving
+# the stored solution back. Past capacity, the least recently used puzzle
+# goes.
+class SolutionCache:
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.solutions = OrderedDict()
+
+    # Returns (found, solution). Fills grid in place if there is a solution.
+    def lookup(self, grid, constraints, form=None):
+        (key, move) = form or canonical_form(grid, constraints)
+        if key not in self.solutions: return (False, None)
+        solution = self.solutions.pop(key)
+        self.solutions[key] = solution
+        if solution is None: return (True, None)
+
+        n = len(grid)
+        for r in xrange(n):
+            for c in xrange(n):
+                (tr, tc) = move(n, r, c)
+                grid[r][c] = solution[tr][tc]
+        return (True, grid)
+
+    def add(self, grid, constraints, solution, form=None):
+        (key, move) = form or canonical_form(grid, constraints)
+        if solution is not None:
+            solution = transform_puzzle(solution, constraints, move)[0]
+        if key in self.solutions:
+            del self.solutions[key]
+        elif len(self.solutions) >= self.capacity:
+            self.solutions.popitem(last=False)
+        self.solutions[key] = solution
+
+# SEARCH STATISTICS
+# What one solve() call did. The counters cost an addition or two per node,
+# so they are always kept:
+#     nodes        values placed on the grid
+#     backtracks   values taken back after everything below them failed
+#     wipeouts     prunings that left some variable or line with no option
+#     prune_calls  calls to SolverState.propagate
+#     restarts     runs given up on for running out of budget
+#     nogood_hits  values skipped because they were known dead ends
+#     cache_hits   puzzles answered from a SolutionCache
+#     solutions    solutions found by iter_solutions or count_solutions
+#     memo_hits    subproblems count_solutions had already counted
+# symmetry is the name of the symmetry that was broken, or None. time_total
+# is the wall time of the whole solve() call.
+#
+# With timing=True, solve() also wraps the hot methods of its SolverState
+# with timers (see hook), adding up the seconds spent in each of TIMED. That
+# costs two timer calls per method call, so it is off unless asked for.
+class SolveStats:
+    TIMED = ('propagate', 'is_consistent', 'select_var', 'assign', 'unassign',
+             'undo')
+
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.nodes = 0
+        self.backtracks = 0
+        self.wipeouts = 0
+        self.prune_calls = 0
+        self.restarts = 0
+        self.nogood_hits = 0
+        self.cache_hits = 0
+        self.solutions = 0
+        self.memo_hits = 0
+        self.symmetry = None
+        self.time_total = 0.0
+        self.times = dict((name, 0.0) for name in self.TIMED)
+
+    # Replaces the methods of state named in TIMED by timed wrappers. Only the
+    # state instance is touched, not the class.
+    def hook(self, state):
+        for name in self.TIMED:
+            if name == 'select_var':
+                state.heap.top = self.timed(name, state.heap.top)
+            else:
+                setattr(state, name, self.timed(name, getattr(state, name)))
+
+    def timed(self, name, method):
+        times = self.times
+        def call(*args):
+            start = timer()
+            try:
+                return method(*args)
+            finally:
+                times[name] += timer() - start
+        return call
+
+    def as_dict(self):
+        result = {'nodes': self.nodes, 'backtracks': self.backtracks,
+                  'wipeouts': self.wipeouts, 'prune_calls': self.prune_calls,
+                  'restarts': self.restarts, 'nogood_hits': self.nogood_hits,
+                  'cache_hits': self.cache_hits, 'solutions': self.solutions,
+                  'memo_hits': self.memo_hits, 'symmetry': self.symmetry,
+                  'time_total': self.time_total}
+        if self.timing:
+            for name in self.TIMED:
+                result['time_' + name] = self.times[name]
+        return result
+
+# SOLVER STATE
+# Keeps running sums and free counts for every row, col and diagonal so that
+# placing or removing a value is O(1) instead of rescanning the whole grid.
+#
+# Lines are numbered as follows (line ids):
+#     0 .. n-1     rows (top to bottom)
+#     n .. 2n-1    cols (left to right)
+#     2n           diag (top-left to bottom-right)
+#     2n+1         diag (top-right to bottom-left)
+#
+# A line is 'bad' if its sum went over its constraint, or if it is full and
+# its sum is not exactly its constraint. We keep a count of the bad lines, so
+# consistency and completeness are just reads of the counters.
+#
+# The state also owns the domain of every free variable. For each line we keep
+# the sum of the smallest (free_lo) and largest (free_hi) values its free
+# variables can still take, so the bounds of a line can be tightened without
+# looking at the rest of the grid. Every domain change is pushed on a trail as
+# (r, c, old_domain, old_reason), and backtracking pops the trail back to a
+# mark instead of re-pruning the whole grid.
+#
+# Search decisions are numbered by their depth, and a set of decisions is a
+# bitmask of those numbers. decided holds the bit of the decision that placed
+# each assigned cell (0 for givens), reasons the decisions that the domain of
+# each free cell was narrowed by, and conflict the decisions behind the last
+# failure.
+#
+# Free variables sit in a VarHeap keyed by var_key, which is refreshed whenever
+# a domain or a free count it depends on changes.
+class SolverState:
+    def __init__(self, grid, constraints, stats=None, values=DEFAULT_RANGE,
+                 cells=None):
+        n = len(grid)
+        self.n = n
+        self.stats = stats if stats is not None else SolveStats()
+        self.values = values
+        domain_min = values.min
+        domain_max = values.max
+        domain_interval = values.interval
+        self.grid = grid
+        self.targets = (list(constraints[0]) + list(constraints[1]) +
+                        list(constraints[2]))
+
+        # Line ids that each (r, c) belongs to, and cells of each line
+        self.cell_lines = [[None] * n for r in xrange(n)]
+        self.line_cells = [[] for line in xrange(2 * n + 2)]
+        for r in xrange(n):
+            for c in xrange(n):
+                lines = [r, n + c]
+                if (r == c): lines.append(2 * n)
+                if (r == n-1-c): lines.append(2 * n + 1)
+                self.cell_lines[r][c] = lines
+                for line in lines:
+                    self.line_cells[line].append((r, c))
+
+        # Domains start from the one-off pruning of the whole grid
+        self.domains = get_domains(grid, constraints, values, cells)
+        self.trail = []
+        self.decided = [[0] * n for r in xrange(n)]
+        self.reasons = [[0] * n for r in xrange(n)]
+        self.conflict = 0
+        # Cell pairs ordered for symmetry breaking, see propagate_lex
+        self.lex_pairs = []
+
+        self.sums = [0] * (2 * n + 2)
+        self.free = [0] * (2 * n + 2)
+        self.free_lo = [0] * (2 * n + 2)
+        self.free_hi = [0] * (2 * n + 2)
+        self.holes = [0] * (2 * n + 2)
+        self.free_total = 0
+        self.wiped_out = False
+        for r in xrange(n):
+            for c in xrange(n):
+                value = grid[r][c]
+                if value == -1:
+                    domain = self.domains[r][c]
+                    if domain == 0:
+                        # No possible value, can't ever be solved
+                        self.wiped_out = True
+                        domain = self.domains[r][c] = values.full
+                    self.free_total += 1
+                    for line in self.cell_lines[r][c]:
+                        self.free[line] += 1
+                        self.free_lo[line] += domain_min[domain]
+                        self.free_hi[line] += domain_max[domain]
+                        self.holes[line] += not domain_interval[domain]
+                else:
+                    for line in self.cell_lines[r][c]:
+                        self.sums[line] += value
+
+        self.bad_lines = 0
+        for line in xrange(2 * n + 2):
+            if self.is_bad_line(line): self.bad_lines += 1
+
+        # Every cell is in exactly one row and one col, so the row sums and
+        # the col sums must both add up to the sum of the whole grid
+        if sum(self.targets[:n]) != sum(self.targets[n:2 * n]):
+            self.wiped_out = True
+
+        # Weights need every free count, so the heap is filled last. Once
+        # rng is set (see randomize), weights aren't used any more.
+        self.rng = None
+        self.ranks = range(n * n)
+        self.heap = VarHeap(n * n)
+        for r in xrange(n):
+            for c in xrange(n):
+                if grid[r][c] == -1:
+                    self.heap.push(r * n + c, self.var_key(r, c))
+
+    def is_bad_line(self, line):
+        if self.sums[line] > self.targets[line]: return True
+        return self.free[line] == 0 and self.sums[line] != self.targets[line]
+
+    # Places value at grid[r][c], which must be free
+    def assign(self, r, c, value):
+        domain_min = self.values.min
+        domain_max = self.values.max
+        domain_interval = self.values.interval
+        domain = self.domains[r][c]
+        self.grid[r][c] = value
+        self.free_total -= 1
+        for line in self.cell_lines[r][c]:
+            was_bad = self.is_bad_line(line)
+            self.sums[line] += value
+            self.free[line] -= 1
+            self.free_lo[line] -= domain_min[domain]
+            self.free_hi[line] -= domain_max[domain]
+            self.holes[line] -= not domain_interval[domain]
+            self.bad_lines += self.is_bad_line(line) - was_bad
+
+        self.heap.remove(r * self.n + c)
+        self.update_line_keys(r, c)
+
+    # Removes the value at grid[r][c], which must be assigned
+    def unassign(self, r, c):
+        domain_min = self.values.min
+        domain_max = self.values.max
+        domain_interval = self.values.interval
+        domain = self.domains[r][c]
+        value = self.grid[r][c]
+        self.grid[r][c] = -1
+        self.free_total += 1
+        for line in self.cell_lines[r][c]:
+            was_bad = self.is_bad_line(line)
+            self.sums[line] -= value
+            self.free[line] += 1
+            self.free_lo[line] += domain_min[domain]
+            self.free_hi[line] += domain_max[domain]
+            self.holes[line] += not domain_interval[domain]
+            self.bad_lines += self.is_bad_line(line) - was_bad
+
+        self.heap.push(r * self.n + c, self.var_key(r, c))
+        self.update_line_keys(r, c)
+
+    # Returns True if no row/col/diag sum has gone over its constraint and
+    # every filled row/col/diag matches its constraint exactly
+    def is_consistent(self):
+        return self.bad_lines == 0 and not self.wiped_out
+
+    # The decisions that placed the cells of the lines through (r, c) that
+    # went bad, for when placing a value there made the state inconsistent
+    def explain_bad(self, r, c):
+        why = 0
+        for line in self.cell_lines[r][c]:
+            if not self.is_bad_line(line): continue
+            for (vr, vc) in self.line_cells[line]:
+                why |= self.decided[vr][vc]
+        return why
+
+    # The decisions the bounds of a line depend on: those that placed its
+    # assigned cells and those that narrowed its free cells
+    def explain(self, line):
+        grid = self.grid
+        why = 0
+        for (r, c) in self.line_cells[line]:
+            if grid[r][c] == -1:
+                why |= self.reasons[r][c]
+            else:
+                why |= self.decided[r][c]
+        return why
+
+    # Returns True if the grid is filled and fulfills the constraints
+    def is_complete(self):
+        return self.free_total == 0 and self.bad_lines == 0
+
+    # Replaces the domain of the free variable at (r, c), remembering the old
+    # domain on the trail. reason is the decisions that ruled the missing
+    # values out.
+    def set_domain(self, r, c, domain, reason):
+        domain_min = self.values.min
+        domain_max = self.values.max
+        domain_interval = self.values.interval
+        old_domain = self.domains[r][c]
+        old_reason = self.reasons[r][c]
+        self.trail.append((r, c, old_domain, old_reason))
+        self.domains[r][c] = domain
+        self.reasons[r][c] = old_reason | reason
+        for line in self.cell_lines[r][c]:
+            self.free_lo[line] += domain_min[domain] - domain_min[old_domain]
+            self.free_hi[line] += domain_max[domain] - domain_max[old_domain]
+            self.holes[line] += (domain_interval[old_domain] -
+                                 domain_interval[domain])
+        self.heap.update(r * self.n + c, self.var_key(r, c))
+
+    # Pops the trail back to mark, restoring every domain changed since then
+    def undo(self, mark):
+        domain_min = self.values.min
+        domain_max = self.values.max
+        domain_interval = self.values.interval
+        trail = self.trail
+        while len(trail) > mark:
+            (r, c, old_domain, old_reason) = trail.pop()
+            domain = self.domains[r][c]
+            self.domains[r][c] = old_domain
+            self.reasons[r][c] = old_reason
+            if self.grid[r][c] == -1:
+                for line in self.cell_lines[r][c]:
+                    self.free_lo[line] += (domain_min[old_domain] -
+                                           domain_min[domain])
+                    self.free_hi[line] += (domain_max[old_domain] -
+                                           domain_max[domain])
+                    self.holes[line] += (domain_interval[domain] -
+                                         domain_interval[old_domain])
+                self.heap.update(r * self.n + c, self.var_key(r, c))
+
+    # Tightens domains starting from the given lines until nothing changes.
+    # Each free variable in a line must leave room for the others:
+    #   new_lower = constraint - sum - (free_hi - own max)
+    #   new_upper = constraint - sum - (free_lo - own min)
+    # When a domain shrinks, the other lines through that variable are queued.
+    # Returns False if some line can no longer reach its constraint, with the
+    # decisions that line's bounds came from in conflict.
+    def propagate(self, lines):
+        self.stats.prune_calls += 1
+        if self.tighten(lines): return True
+        self.stats.wipeouts += 1
+        return False
+
+    def tighten(self, lines):
+        domain_min = self.values.min
+        domain_max = self.values.max
+        domain_range = self.values.range
+        base = self.values.lo
+        top = self.values.hi
+        full = self.values.full
+        bits = self.values.bits
+        wide = bits > TABLE_BITS
+        queue = list(lines)
+        queued = set(queue)
+        while queue:
+            line = queue.pop()
+            queued.discard(line)
+
+            # Most visits change nothing, so the line is only explained once
+            # it does
+            why = None
+            rest = self.targets[line] - self.sums[line]
+            if self.free_lo[line] > rest or self.free_hi[line] < rest:
+                self.conflict = self.explain(line)
+                return False
 
-    if diag_sums[0] != diag_constraints[0]: return False
-    if diag_sums[1] != diag_constraints[1]: return False
+            for (r, c) in self.line_cells[line]:
+                if self.grid[r][c] != -1: continue
+                domain = self.domains[r][c]
+                d_lo = domain_min[domain]
+                d_hi = domain_max[domain]
+                lo = max(d_lo, rest - (self.free_hi[line] - d_hi))
+                hi = min(d_hi, rest - (self.free_lo[line] - d_lo))
+                if lo == d_lo and hi == d_hi: continue
+                # With holes, lo..hi can fall between the domain's values
+                new_domain = domain & domain_range(lo, hi)
+                if new_domain == 0:
+                    self.conflict = self.explain(line)
+                    return False
+
+                if why is None: why = self.explain(line)
+                self.set_domain(r, c, new_domain, why)
+                for other in self.cell_lines[r][c]:
+                    if other not in queued:
+                        queued.add(other)
+                        queue.append(other)
+
+            # Sums of intervals are intervals, so the bounds above already
+            # removed every unsupported value unless some domain has holes
+            if self.holes[line] == 0: continue
+            cells = [(r, c) for (r, c) in self.line_cells[line]
+                     if self.grid[r][c] == -1]
+
+            for (r, c) in cells:
+                domain = self.domains[r][c]
+                other_domains = [self.domains[vr][vc] for (vr, vc) in cells
+                                 if (vr, vc) != (r, c)]
+
+                # Keep the values v for which rest - v is reachable
+                if wide:
+                    # Bit j of window is the sum rest - top + j, i.e. the
+                    # value top - j, so reversed it lines up with the domain
+                    others = reachable_sums_wide(other_domains, domain_min)
+                    low_sum = rest - top
+                    if low_sum >= 0:
+                        window = (others >> low_sum) & full
+                    else:
+                        window = (others << -low_sum) & full
+                    new_domain = domain & reverse_bits(window, bits)
+                else:
+                    others = reachable_sums(other_domains, domain_min)
+                    new_domain = 0
+                    values = domain
+                    while values != 0:
+                        value = domain_min[values]
+                        values &= values - 1
+                        if (rest - value >= 0 and
+                                (others >> (rest - value)) & 1):
+                            new_domain |= 1 << (value - base)
+                if new_domain == domain: continue
+                if new_domain == 0:
+                    self.conflict = self.explain(line)
+                    return False
+
+                if why is None: why = self.explain(line)
+                self.set_domain(r, c, new_domain, why)
+                for other in self.cell_lines[r][c]:
+                    if other not in queued:
+                        queued.add(other)
+                        queue.append(other)
+        return True
+
+    # Key of the subproblem left to solve, see count_solutions: the free
+    # variables and what every line still needs to add up to
+    def subproblem_key(self):
+        targets = self.targets
+        sums = self.sums
+        rest = tuple([targets[line] - sums[line]
+                      for line in xrange(2 * self.n + 2)])
+        return (frozenset(self.heap.heap), rest)
+
+    # Propagates every line, used once before the search starts
+    def propagate_all(self):
+        if not self.is_consistent(): return False
+        return self.propagate(xrange(2 * self.n + 2))
+
+    # Symmetry breaking, see find_symmetry. The values of the first cells
+    # of lex_pairs, read in order, must be no larger (lexicographically)
+    # than the values of the second cells. Pairs are skipped while both of
+    # their cells are sure to be equal; the first pair that isn't gets its
+    # bounds ordered, value(p) <= value(q). Called before the search and
+    # after every assignment, so it only looks as far as the decisions so
+    # far allow. Returns False if a domain runs out. The bounds depend on
+    # the cells of every pair up to the one ordered, so those cells are what
+    # gets blamed.
+    def propagate_lex(self):
+        values = self.values
+        domain_min = self.values.min
+        domain_max = self.values.max
+        grid = self.grid
+        why = 0
+        for ((pr, pc), (qr, qc)) in self.lex_pairs:
+            p_value = grid[pr][pc]
+            q_value = grid[qr][qc]
+            for (r, c, value) in ((pr, pc, p_value), (qr, qc, q_value)):
+                why |= (self.reasons[r][c] if value == -1
+                        else self.decided[r][c])
+            p_domain = (self.domains[pr][pc] if p_value == -1
+                        else values.bit(p_value))
+            q_domain = (self.domains[qr][qc] if q_value == -1
+                        else values.bit(q_value))
+
+            new_p = p_domain & values.range(values.lo, domain_max[q_domain])
+            new_q = q_domain & values.range(domain_min[new_p], values.hi)
+            if new_p == 0 or new_q == 0:
+                self.stats.wipeouts += 1
+                self.conflict = why
+                return False
 
-    return True
+            # Only free cells can shrink; an assigned cell that would have to
+            # is out of order
+            for (r, c, value, old, new) in ((pr, pc, p_value, p_domain, new_p),
+                                            (qr, qc, q_value, q_domain, new_q)):
+                if new == old: continue
+                if value != -1:
+                    self.stats.wipeouts += 1
+                    self.conflict = why
+                    return False
+                self.set_domain(r, c, new, why)
+                if not self.propagate(self.cell_lines[r][c]): return False
+
+            # On to the next pair only if these two must be equal
+            if not (values.size[new_p] == 1 and new_p == new_q): return True
+        return True
+
+    # MOST CONSTRAINED VARIABLE
+    # Key of a free variable in the heap, smallest first:
+    # 1) Sort from smallest to largest domain length
+    # 2) For ties, then sort by count of other free variables in same
+    #    row/col/diag. Surprisingly, MORE free variables is better
+    # 3) For ties, the lowest rank. Ranks start out as r*n + c and are
+    #    reshuffled on every restart.
+    # Packed into one int so the heap compares plain numbers. After the first
+    # restart 2) is dropped, so the ranks pick among every variable with the
+    # smallest domain, not just the ones the weights can't tell apart.
+    def var_key(self, r, c):
+        n = self.n
+        if self.rng is not None:
+            size = self.values.size[self.domains[r][c]]
+            return size * n * n + self.ranks[r * n + c]
+        weight = 0
+        for line in self.cell_lines[r][c]:
+            weight += self.free[line]
+        size = self.values.size[self.domains[r][c]]
+        return ((size * (4 * n + 1) - weight) * n * n) + self.ranks[r * n + c]
+
+    # Breaks ties between variables in a new random order, and from now on
+    # picks values at random too (see pick_value)
+    def randomize(self, rng):
+        n = self.n
+        self.rng = rng
+        rng.shuffle(self.ranks)
+        for r in xrange(n):
+            for c in xrange(n):
+                if self.grid[r][c] == -1:
+                    self.heap.update(r * n + c, self.var_key(r, c))
+
+    # The free counts of the lines through (r, c) changed, so the weight of
+    # every free variable in those lines changed with them
+    def update_line_keys(self, r, c):
+        if self.rng is not None: return
+        n = self.n
+        heap = self.heap
+        for line in self.cell_lines[r][c]:
+            for (vr, vc) in self.line_cells[line]:
+                if self.grid[vr][vc] == -1:
+                    heap.update(vr * n + vc, self.var_key(vr, vc))
 
 
 # PRUNE THE DOMAINS BASED ON INITIAL SUM CONSTRAINTS
 # get_domains() takes in a grid and constraints and outputs an (n x n) array
-# that replaces each value with a list of each value's domain (valid inputs).
-# If the list is empty, it means the value is fixed.
+# that replaces each value with the bitmask of its domain (valid inputs).
+# If the domain is 0, it means the value is fixed.
 #
 # We do this by doing the following for each value at grid[r][c]...
 #
@@ -164,19 +1099,21 @@ def is_complete(grid, constraints):
 #     c_upper = c_constraints - c_fixed_sum
 #     d0_upper = d0_constraints - d0_fixed_sum
 #     d1_upper = d1_constraints - d1_fixed_sum
-#     upper = min(9, r_upper, c_upper, d0_upper, d1_upper)
+#     upper = min(hi, r_upper, c_upper, d0_upper, d1_upper)
 #
 # To find the lower bound for grid[r][c], we assume that other free variables
-# are assigned the most they can possibly be (9) and compute:
-#     r_lower = r_constraints - r_fixed_sum - (9 * r_free_count) + 9
-#     c_lower = c_constraints - c_fixed_sum - (9 * c_free_count) + 9
-#     d0_lower = d0_constraints - d0_fixed_sum - (9 * d0_free_count) + 9
-#     d1_lower = d1_constraints - d1_fixed_sum - (9 * d1_free_count) + 9
-#     lower = max(0, r_upper, c_upper, d0_upper, d1_upper)
+# are assigned the most they can possibly be (hi) and compute:
+#     r_lower = r_constraints - r_fixed_sum - (hi * r_free_count) + hi
+#     c_lower = c_constraints - c_fixed_sum - (hi * c_free_count) + hi
+#     d0_lower = d0_constraints - d0_fixed_sum - (hi * d0_free_count) + hi
+#     d1_lower = d1_constraints - d1_fixed_sum - (hi * d1_free_count) + hi
+#     lower = max(lo, r_upper, c_upper, d0_upper, d1_upper)
+#
+# where lo..hi is the value range (0..9 unless solve() is given ranges).
 #
-def prune_domains_sums(grid, constraints):
+def prune_domains_sums(grid, constraints, values=DEFAULT_RANGE):
     n = len(grid)
-    result = [ [[] for c in xrange(n)] for r in xrange(n) ]
+    result = [ [0 for c in xrange(n)] for r in xrange(n) ]
 
     # Parse the row, col, diag sum constraints
     row_constraints = constraints[0]
@@ -215,23 +1152,23 @@ def prune_domains_sums(grid, constraints):
             if (grid[r][c] == -1):
                 row_hi =  row_constraints[r] - row_fixed_sums[r]
                 col_hi =  col_constraints[c] - col_fixed_sums[c]
-                # Need to add 9 to ignore self in calculation
-                row_lo =  row_hi - D_MAX * (row_free_counts[r]-1)
-                col_lo =  col_hi -  D_MAX * (col_free_counts[c]-1)
+                # Need to add hi to ignore self in calculation
+                row_lo =  row_hi - values.hi * (row_free_counts[r]-1)
+                col_lo =  col_hi -  values.hi * (col_free_counts[c]-1)
 
                 # Setting defaults for non-diagonals
-                diag0_hi = diag1_hi = D_MAX
-                diag0_lo = diag1_lo = D_MIN
+                diag0_hi = diag1_hi = values.hi
+                diag0_lo = diag1_lo = values.lo
                 if (r == c):
                     diag0_hi = diag_constraints[0] - diag_fixed_sums[0]
-                    diag0_lo = diag0_hi - D_MAX * (diag_free_counts[0]-1)
+                    diag0_lo = diag0_hi - values.hi * (diag_free_counts[0]-1)
                 if (r == n-1-c):
                     diag1_hi = diag_constraints[1] - diag_fixed_sums[1]
-                    diag1_lo = diag1_hi - D_MAX * (diag_free_counts[1]-1)
-                hi = min(D_MAX, row_hi, col_hi, diag0_hi, diag1_hi)
-                lo = max(D_MIN, row_lo, col_lo, diag0_lo, diag1_lo)
+                    diag1_lo = diag1_hi - values.hi * (diag_free_counts[1]-1)
+                hi = min(values.hi, row_hi, col_hi, diag0_hi, diag1_hi)
+                lo = max(values.lo, row_lo, col_lo, diag0_lo, diag1_lo)
 
-                result[r][c] = range(lo, hi + 1)
+                result[r][c] = values.range(lo, hi)
 
     return result
 
@@ -239,7 +1176,7 @@ def prune_domains_sums(grid, constraints):
 # The idea is:
 #   new_lower = constraint - BEST_of_other_variables
 #   new_upper = constraint - WORST_of_other_variables
-def prune_domains_cross(grid, constraints):
+def prune_domains_cross(grid, constraints, values=DEFAULT_RANGE):
     n = len(grid)
     
     # Parse the row, col, diag sum constraints
@@ -247,7 +1184,7 @@ def prune_domains_cross(grid, constraints):
     col_constraints = constraints[1]
     diag_constraints = constraints[2]
 
-    domains = prune_domains_sums(grid, constraints)
+    domains = prune_domains_sums(grid, constraints, values)
 
     row_max_sums = [0] * n
     row_min_sums = [0] * n
@@ -260,20 +1197,20 @@ def prune_domains_cross(grid, constraints):
     for r in xrange(n):
         for c in xrange(n):
             if grid[r][c] == -1:
-                if domains[r][c] != []:
-
-                    row_max_sums[r] += max(domains[r][c])
-                    row_min_sums[r] += min(domains[r][c])
-                    col_max_sums[c] += max(domains[r][c])
-                    col_min_sums[c] += min(domains[r][c])
+                domain = domains[r][c]
+                if domain != 0:
+                    row_max_sums[r] += values.max[domain]
+                    row_min_sums[r] += values.min[domain]
+                    col_max_sums[c] += values.max[domain]
+                    col_min_sums[c] += values.min[domain]
 
                     if (r == c):
-                        diag_max_sums[0] += max(domains[r][c])
-                        diag_min_sums[0] += min(domains[r][c])
+                        diag_max_sums[0] += values.max[domain]
+                        diag_min_sums[0] += values.min[domain]
 
                     if (r == n-1-c):
-                        diag_max_sums[1] += max(domains[r][c])
-                        diag_min_sums[1] += min(domains[r][c])
+                        diag_max_sums[1] += values.max[domain]
+                        diag_min_sums[1] += values.min[domain]
             else:
                 row_max_sums[r] += grid[r][c]
                 row_min_sums[r] += grid[r][c]
@@ -289,222 +1226,519 @@ def prune_domains_cross(grid, constraints):
                     diag_min_sums[1] += grid[r][c]
 
     # Now, create the new domains list to return
-    new_domains = [ [[] for c in xrange(n)] for r in xrange(n) ]
+    new_domains = [ [0 for c in xrange(n)] for r in xrange(n) ]
 
     for r in xrange(n):
         for c in xrange(n):
             if grid[r][c] == -1:
-                if domains[r][c] != []:
+                domain = domains[r][c]
+                if domain != 0:
                     new_row_min = (row_constraints[r] - 
-                                   (row_max_sums[r] - max(domains[r][c])) )
+                                   (row_max_sums[r] - values.max[domain]) )
                     new_row_max = (row_constraints[r] -
-                                   (row_min_sums[r] - min(domains[r][c])))
+                                   (row_min_sums[r] - values.min[domain]))
 
                     new_col_min = (col_constraints[c] -
-                                   (col_max_sums[c] - max(domains[r][c])))
+                                   (col_max_sums[c] - values.max[domain]))
                     new_col_max = (col_constraints[c] -
-                                   (col_min_sums[c] - min(domains[r][c])))
+                                   (col_min_sums[c] - values.min[domain]))
 
                     # Setting defaults for non-diagonals
-                    new_diag0_min = new_diag1_min = D_MIN
-                    new_diag0_max = new_diag1_max = D_MAX
+                    new_diag0_min = new_diag1_min = values.lo
+                    new_diag0_max = new_diag1_max = values.hi
                     if (r == c):
                         new_diag0_min = (diag_constraints[0] -
-                                       (diag_max_sums[0] - max(domains[r][c])) )
+                                       (diag_max_sums[0] - values.max[domain]) )
                         new_diag0_max = (diag_constraints[0] -
-                                       (diag_min_sums[0] - min(domains[r][c])) )
+                                       (diag_min_sums[0] - values.min[domain]) )
                     if (r == n-1-c):
                         new_diag1_min = (diag_constraints[1] -
-                                       (diag_max_sums[1] - max(domains[r][c])) )
+                                       (diag_max_sums[1] - values.max[domain]) )
                         new_diag1_max = (diag_constraints[1] -
-                                       (diag_min_sums[1] - min(domains[r][c])) )
+                                       (diag_min_sums[1] - values.min[domain]) )
                 else:
-                    new_row_max=new_col_max=new_diag0_max=new_diag1_max=D_MAX
-                    new_row_min=new_col_min=new_diag0_min=new_diag1_min=D_MIN
+                    new_row_max=new_col_max=new_diag0_max=new_diag1_max=values.hi
+                    new_row_min=new_col_min=new_diag0_min=new_diag1_min=values.lo
 
 
-                new_max = min(D_MAX, new_row_max, new_col_max,
+                new_max = min(values.hi, new_row_max, new_col_max,
                               new_diag0_max, new_diag1_max)
-                new_min = max(D_MIN, new_row_min, new_col_min,
+                new_min = max(values.lo, new_row_min, new_col_min,
                               new_diag0_min, new_diag1_min)
 
-                new_domain = range(new_min, new_max + 1)
                 old_domain = domains[r][c]
+                new_domain = old_domain & values.range(new_min, new_max)
 
                 # Only assign the new domain if it's both VALID and
                 # BETTER than the old one
-                if len(new_domain) < len(old_domain) and new_domain != []:
+                if new_domain != 0 and new_domain != old_domain:
                     new_domains[r][c] = new_domain
                 else:
                     new_domains[r][c] = old_domain
 
     return new_domains
 
-# Wrapper function to get domains as a 3D list, where each entry of the NxN
-# is the domain for that (r, c)
-def get_domains(grid, constraints):
-    return prune_domains_cross(grid, constraints)
-
-# MOST CONSTRAINED VARIABLE
-# 1) Sort from smallest to largest domain length
-# 2) For ties, then sort by count of other free variables in same row/col/diag
-def var_sort_fn(A, B):
-    (Ar, Ac, Ad, Aw) = A
-    (Br, Bc, Bd, Bw) = B
-
-    if len(Ad) < len(Bd):
-        return -1
-    elif len(Ad) > len(Bd):
-        return 1
-    else:
-        if Aw < Bw:
-            return 1 # Surprisingly, MORE free variables is better
-        else:
-            return -1
-
-# Given a grid and constraints, return an array of [r, c, domain] lists that
-# is sorted from most to least constrained.
-def get_vars_and_domains(grid, constraints):
+# VECTORIZED PRUNING
+# Same two stages as prune_domains_sums() and prune_domains_cross(), but over
+# (n x n) NumPy arrays, so the bounds of every cell are computed at once
+# instead of cell by cell. Free cells are masked with np.where, line sums come
+# from row/col reductions and the diagonals from np.eye masks.
+# Since both stages only ever narrow bounds, each domain is an interval
+# lo..hi, which is turned into a bitmask at the very end.
+def diag_masks(n):
+    diag0 = np.eye(n, dtype=bool)
+    return (diag0, diag0[:, ::-1])
+
+def prune_domains_sums_np(grid, constraints, values=DEFAULT_RANGE):
     n = len(grid)
-    domains = get_domains(grid, constraints)
-    result = []
+    grid = np.array(grid, dtype=np.int64)
+    row_constraints = np.array(constraints[0], dtype=np.int64)
+    col_constraints = np.array(constraints[1], dtype=np.int64)
+    diag_constraints = constraints[2]
+    (diag0, diag1) = diag_masks(n)
+
+    free = grid == -1
+    fixed = np.where(free, 0, grid)
+
+    row_hi = (row_constraints - fixed.sum(axis=1))[:, None]
+    col_hi = (col_constraints - fixed.sum(axis=0))[None, :]
+    row_lo = row_hi - values.hi * (free.sum(axis=1)[:, None] - 1)
+    col_lo = col_hi - values.hi * (free.sum(axis=0)[None, :] - 1)
+
+    diag0_hi = diag_constraints[0] - fixed[diag0].sum()
+    diag1_hi = diag_constraints[1] - fixed[diag1].sum()
+    diag0_lo = diag0_hi - values.hi * (free[diag0].sum() - 1)
+    diag1_lo = diag1_hi - values.hi * (free[diag1].sum() - 1)
+
+    hi = np.minimum(np.minimum(row_hi, col_hi), values.hi)
+    hi = np.where(diag0, np.minimum(hi, diag0_hi), hi)
+    hi = np.where(diag1, np.minimum(hi, diag1_hi), hi)
+    lo = np.maximum(np.maximum(row_lo, col_lo), values.lo)
+    lo = np.where(diag0, np.maximum(lo, diag0_lo), lo)
+    lo = np.where(diag1, np.maximum(lo, diag1_lo), lo)
+
+    return (grid, free, lo, hi)
+
+def prune_domains_cross_np(grid, constraints, values=DEFAULT_RANGE):
+    (grid, free, lo, hi) = prune_domains_sums_np(grid, constraints,
+                                                   values)
+    row_constraints = np.array(constraints[0], dtype=np.int64)
+    col_constraints = np.array(constraints[1], dtype=np.int64)
+    diag_constraints = constraints[2]
+    (diag0, diag1) = diag_masks(len(grid))
 
-    for r in xrange(n):
-        for c in xrange(n):
-            # Only concerned with mutable variables
-            if (grid[r][c] == -1):
-                # Append a triplet of (row, col, domain)
-                result.append( [r, c, domains[r][c]] )
+    # Free cells with an empty domain don't count towards the line sums
+    valid = free & (lo <= hi)
+    min_vals = np.where(free, np.where(valid, lo, 0), grid)
+    max_vals = np.where(free, np.where(valid, hi, 0), grid)
 
-    # Heuristic: count other free variables in row/col/diag
-    row_free_counts = [0 for i in xrange(n)]
-    col_free_counts = [0 for i in xrange(n)]
-    diag_free_counts = [0, 0]
+    # Get the BEST and WORST that the variables can do for each row, col, diag
+    row_min = (row_constraints - max_vals.sum(axis=1))[:, None]
+    row_max = (row_constraints - min_vals.sum(axis=1))[:, None]
+    col_min = (col_constraints - max_vals.sum(axis=0))[None, :]
+    col_max = (col_constraints - min_vals.sum(axis=0))[None, :]
+    diag0_min = diag_constraints[0] - max_vals[diag0].sum()
+    diag0_max = diag_constraints[0] - min_vals[diag0].sum()
+    diag1_min = diag_constraints[1] - max_vals[diag1].sum()
+    diag1_max = diag_constraints[1] - min_vals[diag1].sum()
+
+    # new_lower = constraint - BEST_of_other_variables
+    # new_upper = constraint - WORST_of_other_variables
+    new_lo = np.maximum(np.maximum(row_min, col_min) + hi, values.lo)
+    new_lo = np.where(diag0, np.maximum(new_lo, diag0_min + hi), new_lo)
+    new_lo = np.where(diag1, np.maximum(new_lo, diag1_min + hi), new_lo)
+    new_hi = np.minimum(np.minimum(row_max, col_max) + lo, values.hi)
+    new_hi = np.where(diag0, np.minimum(new_hi, diag0_max + lo), new_hi)
+    new_hi = np.where(diag1, np.minimum(new_hi, diag1_max + lo), new_hi)
+
+    # Only take the new bounds if they leave a nonempty domain
+    new_lo = np.maximum(new_lo, lo)
+    new_hi = np.minimum(new_hi, hi)
+    better = valid & (new_lo <= new_hi)
+    lo = np.where(better, new_lo, lo)
+    hi = np.where(better, new_hi, hi)
+
+    widths = np.where(valid, hi - lo + 1, 0)
+    masks = ((np.left_shift(1, widths) - 1) <<
+             np.where(valid, lo - values.lo, 0))
+    return masks.tolist()
+
+# Wrapper function to get domains as a 2D list, where each entry of the NxN
+# is the domain bitmask for that (r, c) over the value range values. Large
+# grids use the vectorized pruning when NumPy is installed and the bitmasks
+# fit in an int64. cells, if given, is a grid of per-cell domains to narrow
+# the result to.
+def get_domains(grid, constraints, values=DEFAULT_RANGE, cells=None):
+    if (np is not None and len(grid) >= NUMPY_MIN_SIZE and
+            values.bits <= NUMPY_MAX_BITS):
+        domains = prune_domains_cross_np(grid, constraints, values)
+    else:
+        domains = prune_domains_cross(grid, constraints, values)
+    if cells is not None:
+        n = len(grid)
+        for r in xrange(n):
+            for c in xrange(n):
+                if grid[r][c] == -1:
+                    domains[r][c] &= cells[r][c]
+    return domains
+
+# Returns the (r, c) of the most constrained free variable, as ordered by
+# SolverState.var_key. Returns None if there are no free variables left.
+def select_var(state):
+    var = state.heap.top()
+    if var is None: return None
+    return divmod(var, state.n)
+
+# Returns the value to try next for the free variable at (r, c): the
+# smallest one left, or once the state is randomized, the first one left
+# from a random point of its range on
+def pick_value(state, r, c):
+    values = state.values
+    domain = state.domains[r][c]
+    if state.rng is None: return values.min[domain]
+    start = state.rng.randint(values.min[domain], values.max[domain])
+    return values.min[domain & values.range(start, values.hi)]
+
+# Rules value out for the free variable at (r, c) and prunes with that.
+# reason is the decisions that ruled it out. Returns False if that leaves no
+# possible value.
+def refute(state, r, c, value, reason):
+    domain = state.domains[r][c] & ~state.values.bit(value)
+    if domain == 0:
+        state.stats.wipeouts += 1
+        state.conflict = state.reasons[r][c] | reason
+        return False
+    state.set_domain(r, c, domain, reason)
+    return state.propagate(state.cell_lines[r][c])
+
+# Backtracking search from the current state. Returns True once the grid is
+# complete and False if there is no solution. Returns None if it had to
+# backtrack more than budget times, after rolling the state back to where
+# the search started.
+def search(state, nogoods, budget):
+    grid = state.grid
+    n = state.n
+    stats = state.stats
+    backtracks = 0
+
+    # Stack of decisions, each packed as [r, c, mark] where mark is the trail
+    # length before the variable was given its current value. A decision's
+    # depth on the stack is its bit in the sets of decisions (see
+    # SolverState).
+    (r, c) = select_var(state)
+    decisions = [[r, c, len(state.trail)]]
+
+    while decisions != []:
+        depth = len(decisions) - 1
+        (r, c, mark) = decisions[-1]
+        var = r * n + c
+
+        if grid[r][c] != -1:
+            # Previous value was bad, undo it and everything it pruned
+            value = grid[r][c]
+            conflict = state.conflict
+            state.undo(mark)
+            state.unassign(r, c)
+            state.decided[r][c] = 0
+            if not conflict >> depth & 1:
+                # The failure doesn't depend on this decision, so no value
+                # of it would do better: jump back past it
+                decisions.pop()
+                continue
+
+            # Remember the value together with the decisions it failed
+            # with as a dead end
+            reason = conflict & ~(1 << depth)
+            nogood = [(var, value)]
+            for k in xrange(depth):
+                if reason >> k & 1:
+                    (fr, fc, fmark) = decisions[k]
+                    nogood.append((fr * n + fc, grid[fr][fc]))
+            nogoods.add(frozenset(nogood))
+
+            backtracks += 1
+            stats.backtracks += 1
+            if backtracks > budget:
+                # Out of budget, roll everything back for a restart
+                for (fr, fc, fmark) in reversed(decisions[:depth]):
+                    state.undo(fmark)
+                    state.unassign(fr, fc)
+                    state.decided[fr][fc] = 0
+                return None
 
+            # Rule the value out for good and prune with that, too. If the
+            # domain runs out, backtrack to the previous variable.
+            if not refute(state, r, c, value, reason):
+                decisions.pop()
+            continue
+
+        # Try the next value, unless it's a known dead end
+        value = pick_value(state, r, c)
+        reason = nogoods.check(var, value, state)
+        if reason is not None:
+            stats.nogood_hits += 1
+            if not refute(state, r, c, value, reason):
+                decisions.pop()
+            continue
+
+        decisions[-1][2] = len(state.trail)
+        state.decided[r][c] = 1 << depth
+        state.assign(r, c, value)
+        stats.nodes += 1
+
+        if state.is_complete():
+            # Woo hoo!
+            return True
+        elif not state.is_consistent():
+            state.conflict = state.explain_bad(r, c)
+        elif (state.propagate(state.cell_lines[r][c]) and
+              state.propagate_lex()):
+            # Only the lines through (r, c) changed, so only those are
+            # re-pruned. Move on to the most constrained variable.
+            (r, c) = select_var(state)
+            decisions.append([r, c, len(state.trail)])
+
+    # Backtracked past the first variable, no solution found
+    return False
+
+# Returns True if every given cell of the grid is a value its range allows
+def givens_in_range(grid, values, cells=None):
+    n = len(grid)
     for r in xrange(n):
         for c in xrange(n):
-            # Count all the free variables
-            if (grid[r][c] == -1):
-                row_free_counts[r] += 1
-                col_free_counts[c] += 1
-
-                if (r == c): diag_free_counts[0] += 1
-                if (r == n-1-c): diag_free_counts[1] += 1
-
-    # Add 'weight' to each variable, so sort function can use it
-    for var in result:
-        (r, c, domain) = var
-
-        other_count = row_free_counts[r] + col_free_counts[c]
-        if (r == c): other_count += diag_free_counts[0]
-        if (r == n-1-c): other_count += diag_free_counts[1]
-        var.append(other_count) # variable packed as: [r, c, domain, weight]
-
-    # Return the list, sorted by most to least constrained
-    return sorted(result, var_sort_fn)
-
-# Takes in the grid, constraints to update:
-#   1) The ORDER of the variables, from most constrained to least constrained
-#   2) The new domains for the i+1 variable and onward
-def update_vars_and_domains(grid, constraints, curr_var, variables):
-    n = len(grid)
-    # Latest, best sorted vars/domains
-    new_variables = get_vars_and_domains(grid, constraints)
-    keep_list = []
-    remove_list = []
-
-    # Want to keep the exact same [0:i] variables
-    for i in xrange(curr_var + 1):
-        # Make list to keep old ones
-        keep_list.append(variables[i])
-
-        # Update new_variables to remove new ones
-        (old_r, old_c, old_d, old_w) = variables[i]
-        for new_var in new_variables:
-            (new_r, new_c, new_d, new_w) = new_var
-            if (new_r, new_c) == (old_r, old_c):
-                # Don't want to update this, remove this
-                remove_list.append(new_var)
-
-    len_new_var_pre = len(new_variables)
-
-    # Make the removals
-    for bad_var in remove_list:
-        new_variables.remove(bad_var)
-
-    result = keep_list + new_variables
+            value = grid[r][c]
+            if value == -1: continue
+            if not values.lo <= value <= values.hi: return False
+            if cells is not None and not cells[r][c] & values.bit(value):
+                return False
+    return True
 
-    return result
+# Returns the solved grid (filled in place), or None if there is no
+# solution. Pass a SolveStats to get the counters of the search back, and a
+# SolutionCache to share answers between calls. ranges gives the values the
+# cells may take, see value_ranges; by default every cell is D_MIN..D_MAX.
+# Puzzles with a range per cell don't go through the cache.
+def solve(grid, constraints, stats=None, cache=None, ranges=None):
+    if stats is None: stats = SolveStats()
+    start = timer()
+    try:
+        (values, cells) = value_ranges(ranges, len(grid))
+        if cache is None or cells is not None:
+            return solve_search(grid, constraints, stats, values, cells)
+
+        # The same puzzle over another range is another puzzle
+        (key, move) = canonical_form(grid, constraints)
+        form = ((values.lo, values.hi, key), move)
+        (found, result) = cache.lookup(grid, constraints, form)
+        if found:
+            stats.cache_hits += 1
+            return result
+        puzzle = [row[:] for row in grid]
+        result = solve_search(grid, constraints, stats, values)
+        cache.add(puzzle, constraints, result, form)
+        return result
+    finally:
+        stats.time_total += timer() - start
+
+def solve_search(grid, constraints, stats, values=DEFAULT_RANGE, cells=None):
+    if not givens_in_range(grid, values, cells): return None
+
+    # Running row/col/diag sums and domains, updated as values are placed
+    # and removed
+    state = SolverState(grid, constraints, stats, values, cells)
+    if stats.timing: stats.hook(state)
 
-def solve(grid, constraints):
     # Edge case?
-    if is_complete(grid, constraints): return grid
-
-    # Get possible variables and domains, [ (r,c,d,w) ... ]
-    variables = get_vars_and_domains(grid, constraints)
-    # Index pointer to the variable we're working with
-    curr_var = 0
-
-    while curr_var < len(variables):
-        # Go through all the variables
-        (r, c, domain, w) = variables[curr_var]
-        value_placed = False
-
-        while domain != [] and grid[r][c] == -1:
-            # Pop a value off the domain to try
-            value = domain.pop(0)
-            grid[r][c] = value
-
-            if is_complete(grid, constraints):
-                # Woo hoo!
-                return grid
-            elif is_consistent(grid, constraints):
-                # Prune domains further with value placed
-                prev_var_length = len(variables)
-                variables = update_vars_and_domains(grid, constraints,
-                                                    curr_var, variables)
-                value_placed = True
-                curr_var += 1
-                break
-            else:
-                # Bad value, remove it
-                grid[r][c] = -1
-
-        if not value_placed:
-            # Reached end of domain and we didn't find a good value
-
-            # Can't backtrack anymore -> FAILURE
-            if (curr_var == 0 and domain == []):
-                return None
-
-            # Backtrack: Remove previous variable's value and reset domains
-            curr_var -= 1
-            (r, c, domain, w) = variables[curr_var]
-            grid[r][c] = -1
-            variables = update_vars_and_domains(grid, constraints,
-                                                curr_var, variables)
-
-    # Reached end of variables, no solution found
-    return None
+    if state.is_complete(): return grid
+    # A line is already over its constraint, no need to look any further
+    if not state.is_consistent(): return None
+
+    # If the puzzle maps onto itself under a symmetry, so do its solutions,
+    # and only one solution of each symmetric pair is searched for
+    symmetry = find_symmetry(grid, constraints, cells)
+    if symmetry is not None:
+        (name, move) = symmetry
+        n = state.n
+        for r in xrange(n):
+            for c in xrange(n):
+                # Each pair once, and only the pairs that can differ
+                if grid[r][c] == -1 and move(n, r, c) > (r, c):
+                    state.lex_pairs.append(((r, c), move(n, r, c)))
+        if state.lex_pairs != []:
+            stats.symmetry = name
+            if not state.propagate_lex(): return None
+
+    # Prune everything once before searching
+    if not state.propagate_all(): return None
+
+    # Search with restarts, keeping the nogoods found along the way
+    rng = random.Random(RESTART_SEED)
+    nogoods = NogoodStore(NOGOOD_CAPACITY)
+    run = 1
+    while True:
+        result = search(state, nogoods, RESTART_UNIT * luby(run))
+        if result is not None:
+            if result: return grid
+            return None
+        run += 1
+        stats.restarts += 1
+        state.randomize(rng)
+
+# ENUMERATION
+# Every solution of a puzzle, instead of the first one. Both functions below
+# do a plain depth-first search over the pruned domains, trying every value
+# of every variable in turn. Restarts, nogoods and symmetry breaking are all
+# left out: they only pay off when one solution will do, and symmetry
+# breaking would skip half of the solutions.
+
+# Returns the SolverState for enumerating the puzzle, pruned once, or None if
+# it has no solution. The grid is copied, never filled in.
+def enumeration_state(grid, constraints, stats, ranges):
+    (values, cells) = value_ranges(ranges, len(grid))
+    if not givens_in_range(grid, values, cells): return None
+    state = SolverState([row[:] for row in grid], constraints, stats, values,
+                        cells)
+    if stats.timing: stats.hook(state)
+    if not state.is_complete() and not state.propagate_all(): return None
+    return state
+
+# Yields every solution of the puzzle, one at a time, as a new grid. Only
+# the search stack is kept between solutions, so a puzzle with millions of
+# solutions can be streamed through in constant memory. ranges is the same
+# as for solve().
+def iter_solutions(grid, constraints, ranges=None, stats=None):
+    if stats is None: stats = SolveStats()
+    state = enumeration_state(grid, constraints, stats, ranges)
+    if state is None: return
+    grid = state.grid
+    if state.is_complete():
+        stats.solutions += 1
+        yield [row[:] for row in grid]
+        return
+
+    # Stack of [r, c, mark, left] where mark is the trail length before the
+    # variable got a value and left holds the values it has yet to try
+    domain_min = state.values.min
+    (r, c) = select_var(state)
+    decisions = [[r, c, len(state.trail), state.domains[r][c]]]
+    while decisions != []:
+        (r, c, mark, left) = decisions[-1]
+        if grid[r][c] != -1:
+            # Everything under the previous value has been seen
+            state.undo(mark)
+            state.unassign(r, c)
+            stats.backtracks += 1
+        if left == 0:
+            decisions.pop()
+            continue
+
+        value = domain_min[left]
+        decisions[-1][3] = left & (left - 1)
+        state.assign(r, c, value)
+        stats.nodes += 1
+
+        if state.is_complete():
+            stats.solutions += 1
+            yield [row[:] for row in grid]
+        elif (state.is_consistent() and
+              state.propagate(state.cell_lines[r][c])):
+            (r, c) = select_var(state)
+            decisions.append([r, c, len(state.trail), state.domains[r][c]])
+
+# Returns the number of solutions of the puzzle, without building them.
+# The count of a subproblem only depends on which variables are still free
+# and on what each line still needs to add up to, not on how the assigned
+# values got there: pruning only ever removes values that are in no
+# completion, so the domains it leaves don't change the count. So the count
+# of every subproblem is remembered under that key (see
+# SolverState.subproblem_key), and when different assignments leave the same
+# residual line sums, the subtree is counted only once. This is what makes
+# counting much faster than iter_solutions on puzzles with many solutions.
+def count_solutions(grid, constraints, ranges=None, stats=None):
+    if stats is None: stats = SolveStats()
+    state = enumeration_state(grid, constraints, stats, ranges)
+    if state is None: return 0
+    grid = state.grid
+    domain_min = state.values.min
+    counts = {}
+
+    # Returns the count of the current subproblem if it is already known,
+    # otherwise pushes it on the stack and returns None
+    def enter():
+        if state.is_complete():
+            stats.solutions += 1
+            return 1
+        key = state.subproblem_key()
+        if key in counts:
+            stats.memo_hits += 1
+            stats.solutions += counts[key]
+            return counts[key]
+        (r, c) = select_var(state)
+        decisions.append([r, c, len(state.trail), state.domains[r][c], key,
+                          0])
+        return None
+
+    # Stack of [r, c, mark, left, key, total], as in iter_solutions, with
+    # the subproblem key and the solutions counted under it so far
+    decisions = []
+    count = enter()
+    while decisions != []:
+        (r, c, mark, left, key, total) = decisions[-1]
+        if grid[r][c] != -1:
+            # count is what the previous value led to
+            state.undo(mark)
+            state.unassign(r, c)
+            stats.backtracks += 1
+            decisions[-1][5] = total = total + count
+        if left == 0:
+            decisions.pop()
+            if len(counts) >= COUNT_CACHE_SIZE:
+                counts.clear()
+            counts[key] = count = total
+            continue
+
+        value = domain_min[left]
+        decisions[-1][3] = left & (left - 1)
+        state.assign(r, c, value)
+        stats.nodes += 1
+
+        count = 0
+        if state.is_complete():
+            stats.solutions += 1
+            count = 1
+        elif (state.is_consistent() and
+              state.propagate(state.cell_lines[r][c])):
+            count = enter()
+    return count
 
 '''
 read_input takes in a command line path to the sample text file, outlined 
 above.
-It will return the solution grid if one is found and return None otherwise.
+It will return the (grid, constraints) of the puzzle in the file.
 '''
 def read_input(path):
-    input_grid = []
     with open(path) as reader:
-        size = int(reader.readline().rstrip())
+        return read_puzzle(reader)
+
+# Reads the next puzzle from an open file, so several puzzles can be
+# concatenated into one stream. Blank lines between puzzles are skipped.
+# Returns (grid, constraints), or None once the stream is exhausted.
+def read_puzzle(reader):
+    line = reader.readline()
+    while line != '' and line.strip() == '':
+        line = reader.readline()
+    if line == '': return None
+    size = int(line.rstrip())
 
-        for i in xrange(size):
-            vals = [int(x) for x in reader.readline().rstrip().split(' ')]
-            input_grid.append(vals)
+    input_grid = []
+    for i in xrange(size):
+        vals = [int(x) for x in reader.readline().split()]
+        input_grid.append(vals)
 
-        # Do stuff with these
-        row_sums = [int(x) for x in reader.readline().rstrip().split(' ')]
-        col_sums = [int(x) for x in reader.readline().rstrip().split(' ')]
-        diag_sums = [int(x) for x in reader.readline().rstrip().split(' ')]
+    # Do stuff with these
+    row_sums = [int(x) for x in reader.readline().split()]
+    col_sums = [int(x) for x in reader.readline().split()]
+    diag_sums = [int(x) for x in reader.readline().split()]
 
     constraints = [row_sums, col_sums, diag_sums]
 
@@ -520,8 +1754,58 @@ def print_result(grid):
             print ' '.join(grid_str)
 
 if __name__ == '__main__':
-    if (len(sys.argv) > 1):
-        filename = sys.argv[1]
-        (input_grid, constraints) = read_input(filename)
-        grid = solve(input_grid, constraints)
+    parser = argparse.ArgumentParser(description='Solve a magic square.')
+    parser.add_argument('filename')
+    parser.add_argument('-b', '--backend', choices=['search', 'sat'],
+                        default='search',
+                        help='backtracking search, or the CDCL SAT solver '
+                             'in sat.py (default: %(default)s)')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='print search statistics and timings as JSON '
+                             'on stderr (search backend only)')
+    parser.add_argument('-r', '--range', nargs=2, type=int, default=None,
+                        metavar=('LO', 'HI'),
+                        help='values every cell may take '
+                             '(default: %d %d)' % (D_MIN, D_MAX))
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-a', '--all', action='store_true',
+                      help='print every solution, blank line separated')
+    mode.add_argument('-c', '--count', action='store_true',
+                      help='print the number of solutions')
+    args = parser.parse_args()
+
+    ranges = tuple(args.range) if args.range is not None else None
+    if ranges is not None and not 0 <= ranges[0] <= ranges[1]:
+        parser.error('the range must satisfy 0 <= LO <= HI')
+    if (args.all or args.count) and args.backend != 'search':
+        parser.error('--all and --count need the search backend')
+
+    (input_grid, constraints) = read_input(args.filename)
+    if args.all or args.count:
+        stats = SolveStats(timing=args.stats)
+        start = timer()
+        if args.all:
+            for grid in iter_solutions(input_grid, constraints, ranges, stats):
+                for row in grid:
+                    print ' '.join(str(x) for x in row)
+                print
+        else:
+            print count_solutions(input_grid, constraints, ranges, stats)
+        stats.time_total = timer() - start
+        sys.stderr.write('%d solutions in %.3fs (%.1f solutions/sec)\n' %
+                         (stats.solutions, stats.time_total,
+                          stats.solutions / max(stats.time_total, 1e-9)))
+        if args.stats:
+            sys.stderr.write(json.dumps(stats.as_dict(), sort_keys=True))
+            sys.stderr.write('\n')
+    else:
+        if args.backend == 'sat':
+            from sat import solve_sat
+            grid = solve_sat(input_grid, constraints, ranges)
+        else:
+            stats = SolveStats(timing=args.stats)
+            grid = solve(input_grid, constraints, stats, ranges=ranges)
+            if args.stats:
+                sys.stderr.write(json.dumps(stats.as_dict(), sort_keys=True))
+                sys.stderr.write('\n')
         print_result(grid)
\ No newline at end of file
@@ -0,0 +1,129 @@
+'''
+=========================== PARALLEL MAGIC SQUARE SOLVER =======================
+Solves a single hard magic square on several cores by splitting the search
+space.
+
+The first few branching decisions are expanded up front, breadth first, with
+the same variable ordering and pruning as solve(). Every value that survives
+pruning becomes a subproblem: the original grid with that cell filled in.
+Expansion stops once there are enough subproblems to keep every worker busy
+(--splits, 4 per job by default). The subproblems are independent and
+together cover the whole search space, so they are handed to a pool of
+processes running solve():
+    - the first worker to find a solution wins, and the pool is terminated
+    - if every subproblem fails, the puzzle has no solution
+The cells may take the values of --range (0..9 by default), both while
+splitting and in the workers, as in magic.py.
+-------------------------------------------------------------------------------
+Usage: python parallel.py [-j JOBS] [-s SPLITS] [-r LO HI] <puzzle file>
+===============================================================================
+'''
+
+import argparse
+import signal
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+from magic import (D_MAX, D_MIN, SolverState, givens_in_range, print_result,
+                   read_input, select_var, solve, value_ranges)
+
+def copy_grid(grid):
+    return [row[:] for row in grid]
+
+# Expands the search tree breadth first until there are at least count open
+# subproblems, and returns their grids. Returns [] if pruning alone shows
+# there is no solution. ranges is the same as for solve().
+def split_puzzle(grid, constraints, count, ranges=None):
+    (values, cells) = value_ranges(ranges, len(grid))
+    if not givens_in_range(grid, values, cells): return []
+
+    frontier = deque([copy_grid(grid)])
+    while 0 < len(frontier) < count:
+        sub_grid = frontier.popleft()
+        state = SolverState(copy_grid(sub_grid), constraints, values=values,
+                            cells=cells)
+        if not state.propagate_all(): continue
+
+        var = select_var(state)
+        if var is None:
+            # Already solved, nothing left to split
+            frontier.appendleft(sub_grid)
+            break
+
+        (r, c) = var
+        domain = state.domains[r][c]
+        while domain != 0:
+            value = state.values.min[domain]
+            domain &= domain - 1
+
+            # Only keep the values that survive pruning
+            mark = len(state.trail)
+            state.assign(r, c, value)
+            if (state.is_consistent() and
+                state.propagate(state.cell_lines[r][c])):
+                child = copy_grid(sub_grid)
+                child[r][c] = value
+                frontier.append(child)
+            state.undo(mark)
+            state.unassign(r, c)
+
+    return list(frontier)
+
+# Runs in a worker
+def solve_split(args):
+    (grid, constraints, ranges) = args
+    return solve(grid, constraints, ranges=ranges)
+
+# Used by the pool so workers leave Ctrl-C to the parent process
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Same as solve(), but spreads the search over jobs processes. Returns the
+# solution grid, or None if there is none.
+def solve_parallel(grid, constraints, jobs=None, splits=None, ranges=None):
+    if jobs is None: jobs = cpu_count()
+    if splits is None: splits = 4 * jobs
+
+    sub_grids = split_puzzle(grid, constraints, splits, ranges)
+    if sub_grids == []: return None
+    if len(sub_grids) == 1 or jobs == 1:
+        # Not worth a pool, just go through them in order
+        for sub_grid in sub_grids:
+            result = solve(sub_grid, constraints, ranges=ranges)
+            if result is not None: return result
+        return None
+
+    pool = Pool(jobs, init_worker)
+    try:
+        tasks = [(sub_grid, constraints, ranges) for sub_grid in sub_grids]
+        for result in pool.imap_unordered(solve_split, tasks):
+            if result is not None:
+                # First solution wins, the rest of the pool is cancelled
+                return result
+        return None
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Solve one magic square on several processes.')
+    parser.add_argument('filename')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('-s', '--splits', type=int, default=None,
+                        help='subproblems to split into (default: 4 per job)')
+    parser.add_argument('-r', '--range', nargs=2, type=int, default=None,
+                        metavar=('LO', 'HI'),
+                        help='values every cell may take '
+                             '(default: %d %d)' % (D_MIN, D_MAX))
+    args = parser.parse_args()
+
+    ranges = tuple(args.range) if args.range is not None else None
+    if ranges is not None and not 0 <= ranges[0] <= ranges[1]:
+        parser.error('the range must satisfy 0 <= LO <= HI')
+
+    (input_grid, constraints) = read_input(args.filename)
+    grid = solve_parallel(input_grid, constraints, args.jobs, args.splits,
+                          ranges)
+    print_result(grid)
@@ -0,0 +1,537 @@
+'''
+========================= MAGIC SQUARE AS A SAT PROBLEM =======================
+An alternative backend for magic.py. Instead of searching over cell values,
+the puzzle from read_input() is turned into clauses over boolean variables
+and handed to a small CDCL (conflict-driven clause learning) SAT solver.
+
+ENCODING
+A unary number is a sorted list of the values it can take, v0 < v1 < ...,
+and an order literal [x >= vk] for each of them but v0, tied together by
+[x >= vk+1] -> [x >= vk]. Each free cell is the unary number of the values
+left in its pruned domain, so values missing from a domain cost nothing.
+
+A row/col/diag sum is counted with a totalizer: a binary tree that merges
+the unary numbers of the line's free cells pairwise, up to one number for
+the whole line that can only take the value the line needs. Each node only
+gets the sums it can take in a solution: sums its cells can reach (see
+magic.reachable_sums) that leave a reachable sum for the rest of the line.
+Pairs of child values that add up to some other sum are ruled out instead of
+counted, and merge clauses that follow from a smaller one through the order
+clauses are left out.
+
+Wide value ranges (more than TABLE_BITS values) are written in base
+SAT_DIGIT_BASE instead: each free cell is its offset from its lowest value,
+as one small unary number per digit, and a line is added up one digit
+position at a time with a carry, like on paper. The number of clauses then
+grows with the number of digits of the range rather than with the range.
+
+SOLVER
+Standard CDCL: two watched literals per clause for unit propagation, first
+UIP conflict analysis to learn a clause and backjump, VSIDS-style variable
+activities, phase saving and Luby restarts. Learned clauses are never
+deleted, which is fine for the clause counts of these puzzles.
+-------------------------------------------------------------------------------
+Usage: python magic.py --backend sat <puzzle file>
+===============================================================================
+'''
+
+import heapq
+from bisect import bisect_left, bisect_right
+
+from magic import (TABLE_BITS, SolverState, givens_in_range, luby,
+                   reachable_sums, value_ranges)
+
+# Conflicts allowed per unit of the Luby restart sequence
+SAT_RESTART_UNIT = 100
+# Base of the digits wide value ranges are written in
+SAT_DIGIT_BASE = 16
+
+# Literal of variable v is 2v (true) or 2v + 1 (false); lit ^ 1 negates it.
+# Variables start from 1.
+def pos(v):
+    return 2 * v
+
+def neg(v):
+    return 2 * v + 1
+
+class SatSolver:
+    def __init__(self):
+        self.num_vars = 0
+        self.clauses = []
+        self.watches = [[], []]  # clauses watching each literal
+        self.lit_value = [-1, -1]  # 1 true, 0 false, -1 unassigned
+        self.level = [0]
+        self.reason = [None]
+        self.activity = [0.0]
+        self.polarity = [1]  # saved phase, as a literal offset (1 = false)
+        self.units = []
+        self.ok = True
+
+        self.trail = []
+        self.trail_lim = []  # trail length at the start of each level
+        self.qhead = 0
+        self.var_inc = 1.0
+        self.order = []  # heap of (-activity, var), may hold stale entries
+
+    def new_var(self):
+        self.num_vars += 1
+        v = self.num_vars
+        self.watches.extend([[], []])
+        self.lit_value.extend([-1, -1])
+        self.level.append(0)
+        self.reason.append(None)
+        self.activity.append(0.0)
+        self.polarity.append(1)
+        heapq.heappush(self.order, (0.0, v))
+        return v
+
+    # Adds a clause (list of literals) before solving
+    def add_clause(self, lits):
+        lits = sorted(set(lits))
+        for i in xrange(len(lits) - 1):
+            if lits[i] ^ 1 == lits[i + 1]:
+                return  # always true
+        if len(lits) == 0:
+            self.ok = False
+        elif len(lits) == 1:
+            self.units.append(lits[0])
+        else:
+            self.attach(lits)
+
+    def attach(self, lits):
+        index = len(self.clauses)
+        self.clauses.append(lits)
+        self.watches[lits[0]].append(index)
+        self.watches[lits[1]].append(index)
+        return index
+
+    def decision_level(self):
+        return len(self.trail_lim)
+
+    # Makes lit true, returns False if it is already false
+    def enqueue(self, lit, reason):
+        value = self.lit_value[lit]
+        if value != -1: return value == 1
+        v = lit >> 1
+        self.lit_value[lit] = 1
+        self.lit_value[lit ^ 1] = 0
+        self.level[v] = self.decision_level()
+        self.reason[v] = reason
+        self.trail.append(lit)
+        return True
+
+    # Unit propagation over the watched literals. Returns the index of a
+    # conflicting clause, or None.
+    def propagate(self):
+        lit_value = self.lit_value
+        clauses = self.clauses
+        watches = self.watches
+        trail = self.trail
+        while self.qhead < len(trail):
+            false_lit = trail[self.qhead] ^ 1
+            self.qhead += 1
+            ws = watches[false_lit]
+            i = j = 0
+            size = len(ws)
+            while i < size:
+                index = ws[i]
+                i += 1
+                clause = clauses[index]
+                # Keep the false literal in clause[1]
+                if clause[0] == false_lit:
+                    clause[0] = clause[1]
+                    clause[1] = false_lit
+                first = clause[0]
+                if lit_value[first] == 1:
+                    ws[j] = index
+                    j += 1
+                    continue
+
+                # Look for a new literal to watch
+                for k in xrange(2, len(clause)):
+                    if lit_value[clause[k]] != 0:
+                        clause[1] = clause[k]
+                        clause[k] = false_lit
+                        watches[clause[1]].append(index)
+                        break
+                else:
+                    ws[j] = index
+                    j += 1
+                    if lit_value[first] == 0:
+                        # Conflict, keep the rest of the watches
+                        while i < size:
+                            ws[j] = ws[i]
+                            j += 1
+                            i += 1
+                        del ws[j:]
+                        self.qhead = len(trail)
+                        return index
+                    self.enqueue(first, index)
+            del ws[j:]
+        return None
+
+    # Undoes every assignment above the given level
+    def cancel_until(self, level):
+        if self.decision_level() <= level: return
+        lim = self.trail_lim[level]
+        for lit in self.trail[lim:]:
+            v = lit >> 1
+            self.lit_value[lit] = -1
+            self.lit_value[lit ^ 1] = -1
+            self.reason[v] = None
+            self.polarity[v] = lit & 1
+            heapq.heappush(self.order, (-self.activity[v], v))
+        del self.trail[lim:]
+        del self.trail_lim[level:]
+        self.qhead = len(self.trail)
+
+    def bump(self, v):
+        self.activity[v] += self.var_inc
+        if self.activity[v] > 1e100:
+            # Rescale everything to keep the floats in range
+            for u in xrange(1, self.num_vars + 1):
+                self.activity[u] *= 1e-100
+            self.var_inc *= 1e-100
+            self.order = [(-self.activity[u], u)
+                          for u in xrange(1, self.num_vars + 1)
+                          if self.lit_value[pos(u)] == -1]
+            heapq.heapify(self.order)
+        elif self.lit_value[pos(v)] == -1:
+            heapq.heappush(self.order, (-self.activity[v], v))
+
+    # First UIP conflict analysis. Returns the learned clause, with the
+    # asserting literal first and a literal of the backjump level second,
+    # and the level to backjump to.
+    def analyze(self, conflict):
+        seen = set()
+        learnt = [None]
+        counter = 0
+        lit = None
+        index = len(self.trail) - 1
+        level = self.decision_level()
+
+        while True:
+            clause = self.clauses[conflict]
+            # clause[0] is the literal the reason clause implied
+            start = 0 if lit is None else 1
+            for k in xrange(start, len(clause)):
+                q = clause[k]
+                v = q >> 1
+                if v not in seen and self.level[v] > 0:
+                    seen.add(v)
+                    self.bump(v)
+                    if self.level[v] == level:
+                        counter += 1
+                    else:
+                        learnt.append(q)
+
+            # Walk back to the next literal of this level in the conflict
+            while (self.trail[index] >> 1) not in seen:
+                index -= 1
+            lit = self.trail[index]
+            index -= 1
+            v = lit >> 1
+            seen.discard(v)
+            counter -= 1
+            if counter == 0: break
+            conflict = self.reason[v]
+
+        learnt[0] = lit ^ 1
+        back_level = 0
+        if len(learnt) > 1:
+            best = 1
+            for k in xrange(2, len(learnt)):
+                if self.level[learnt[k] >> 1] > self.level[learnt[best] >> 1]:
+                    best = k
+            learnt[1], learnt[best] = learnt[best], learnt[1]
+            back_level = self.level[learnt[1] >> 1]
+        self.var_inc /= 0.95
+        return (learnt, back_level)
+
+    # Returns the unassigned variable with the highest activity, or None
+    def pick_branch_var(self):
+        while self.order:
+            (act, v) = heapq.heappop(self.order)
+            if self.lit_value[pos(v)] == -1:
+                return v
+        return None
+
+    # Returns True if the clauses can be satisfied, False otherwise
+    def solve(self):
+        if not self.ok: return False
+        for lit in self.units:
+            if not self.enqueue(lit, None): return False
+        if self.propagate() is not None: return False
+
+        restarts = 1
+        conflicts = 0
+        budget = SAT_RESTART_UNIT * luby(restarts)
+        while True:
+            conflict = self.propagate()
+            if conflict is not None:
+                if self.decision_level() == 0: return False
+                conflicts += 1
+                (learnt, back_level) = self.analyze(conflict)
+                self.cancel_until(back_level)
+                if len(learnt) == 1:
+                    self.enqueue(learnt[0], None)
+                else:
+                    self.enqueue(learnt[0], self.attach(learnt))
+                continue
+
+            if conflicts >= budget:
+                restarts += 1
+                conflicts = 0
+                budget = SAT_RESTART_UNIT * luby(restarts)
+                self.cancel_until(0)
+                continue
+
+            v = self.pick_branch_var()
+            if v is None: return True
+            self.trail_lim.append(len(self.trail))
+            self.enqueue(2 * v + self.polarity[v], None)
+
+    # Value of variable v in the solution
+    def value(self, v):
+        return self.lit_value[pos(v)] == 1
+
+# Returns a new unary number that can take the values of values (sorted),
+# as (values, literals), with literals[k] standing for [x >= values[k+1]]
+def new_unary(solver, values):
+    lits = [pos(solver.new_var()) for k in xrange(len(values) - 1)]
+    for k in xrange(len(lits) - 1):
+        solver.add_clause([lits[k + 1] ^ 1, lits[k]])
+    return (values, lits)
+
+# Merges the unary numbers a and b into their sum, which may only take the
+# values of allowed. Returns the sum as a unary number.
+def totalizer_merge(solver, a, b, allowed):
+    (a_values, a_lits) = a
+    (b_values, b_lits) = b
+    (c_values, c_lits) = new_unary(solver, allowed)
+    # A clause is left out when the one for the next value of a or b down
+    # (up for the upper bounds) already bounds c the same way, which the
+    # order clauses of a and b make at least as strong. last[i] is the bound
+    # the previous value of b gave with a's value i.
+    last = [None] * len(a_values)
+    for j in xrange(len(b_values)):
+        previous = None
+        for i in xrange(len(a_values)):
+            total = a_values[i] + b_values[j]
+            # a >= a_values[i] and b >= b_values[j] -> c >= total, i.e. c is
+            # at least the next allowed value (or can't be, past the last)
+            q = bisect_left(c_values, total)
+            if q > 0 and q != previous and q != last[i]:
+                clause = [c_lits[q - 1]] if q < len(c_values) else []
+                if i > 0: clause.append(a_lits[i - 1] ^ 1)
+                if j > 0: clause.append(b_lits[j - 1] ^ 1)
+                solver.add_clause(clause)
+            previous = last[i] = q
+
+    last = [None] * len(a_values)
+    for j in xrange(len(b_values) - 1, -1, -1):
+        previous = None
+        for i in xrange(len(a_values) - 1, -1, -1):
+            total = a_values[i] + b_values[j]
+            # a <= a_values[i] and b <= b_values[j] -> c <= total, i.e. c is
+            # at most the previous allowed value (or can't be, before the
+            # first)
+            q = bisect_right(c_values, total) - 1
+            if q < len(c_values) - 1 and q != previous and q != last[i]:
+                clause = [c_lits[q] ^ 1] if q >= 0 else []
+                if i < len(a_lits): clause.append(a_lits[i])
+                if j < len(b_lits): clause.append(b_lits[j])
+                solver.add_clause(clause)
+            previous = last[i] = q
+    return (c_values, c_lits)
+
+# Returns the sorted sums s that the cells can add up to such that rest - s
+# is a sum the other cells can add up to. Both are bitmasks of reachable
+# sums.
+def supported_sums(sums, other_sums, rest):
+    result = []
+    while sums != 0:
+        low = sums & -sums
+        value = low.bit_length() - 1
+        if value > rest: break
+        if (other_sums >> (rest - value)) & 1:
+            result.append(value)
+        sums ^= low
+    return result
+
+# Adds clauses that make the cells (a list of cell ids into unaries and
+# domains) add up to rest
+def encode_sum(solver, cells, unaries, domains, rest, values):
+    sums_of = lambda ids: reachable_sums([domains[k] for k in ids],
+                                         values.min)
+    if cells == []:
+        if rest != 0: solver.add_clause([])
+        return
+
+    # Merge pairwise up the tree, each node over a run of the cells
+    nodes = [([k], unaries[k]) for k in cells]
+    while len(nodes) > 1:
+        merged = []
+        for k in xrange(0, len(nodes) - 1, 2):
+            ids = nodes[k][0] + nodes[k + 1][0]
+            others = [cell for cell in cells if cell not in ids]
+            allowed = supported_sums(sums_of(ids), sums_of(others), rest)
+            if allowed == []:
+                solver.add_clause([])
+                return
+            merged.append((ids, totalizer_merge(solver, nodes[k][1],
+                                                nodes[k + 1][1], allowed)))
+        if len(nodes) % 2 == 1:
+            merged.append(nodes[-1])
+        nodes = merged
+
+    # The line adds up to exactly rest
+    (line_values, lits) = nodes[0][1]
+    if rest not in line_values:
+        solver.add_clause([])
+        return
+    k = line_values.index(rest)
+    if k > 0: solver.add_clause([lits[k - 1]])
+    if k < len(lits): solver.add_clause([lits[k] ^ 1])
+
+# Returns new unary digits, lowest first, for a number that can take the
+# values 0..bound. Digits above the top one are always full; the top digit
+# only goes up to the top digit of bound, and clauses keep the lower digits
+# from passing those of bound while the digits above them match it.
+def new_digits(solver, bound):
+    bound_digits = []
+    while True:
+        bound_digits.append(bound % SAT_DIGIT_BASE)
+        bound //= SAT_DIGIT_BASE
+        if bound == 0: break
+    top = len(bound_digits) - 1
+    digits = [new_unary(solver, range(SAT_DIGIT_BASE)) for k in xrange(top)]
+    digits.append(new_unary(solver, range(bound_digits[top] + 1)))
+
+    tight = None  # true while the digits from the top down match bound
+    for k in xrange(top, -1, -1):
+        (digit_values, lits) = digits[k]
+        b = bound_digits[k]
+        if b < len(lits):
+            # tight -> digit <= b
+            solver.add_clause([lits[b] ^ 1] +
+                              ([tight ^ 1] if tight is not None else []))
+        if k == 0: break
+        # tight and digit >= b -> the next digit down is tight
+        clause = [pos(solver.new_var())]
+        if tight is not None: clause.append(tight ^ 1)
+        if b > 0: clause.append(lits[b - 1] ^ 1)
+        solver.add_clause(clause)
+        tight = clause[0]
+    return digits
+
+# Value of a number made by new_digits() in the solution
+def digits_value(solver, digits):
+    value = 0
+    for (digit_values, lits) in reversed(digits):
+        value = value * SAT_DIGIT_BASE + sum(1 for lit in lits
+                                             if solver.value(lit >> 1))
+    return value
+
+# Same as encode_sum(), but for cells given as lists of digits (see
+# new_digits()), added up one digit position at a time like on paper: the
+# digits at a position and the carry in are merged into one number that must
+# end in the digit of rest there, and the rest of it is the carry out.
+def encode_sum_digits(solver, cells, digits, rest):
+    if rest < 0:
+        solver.add_clause([])
+        return
+    positions = max([len(digits[k]) for k in cells] + [0])
+    carry = None
+    for position in xrange(positions):
+        nodes = [digits[k][position] for k in cells
+                 if len(digits[k]) > position]
+        if carry is not None: nodes.append(carry)
+        last = position == positions - 1
+        while len(nodes) > 1:
+            merged = []
+            for k in xrange(0, len(nodes) - 1, 2):
+                (a, b) = (nodes[k][0], nodes[k + 1][0])
+                hi = a[-1] + b[-1]
+                if last: hi = min(hi, rest)
+                merged.append(totalizer_merge(solver, nodes[k], nodes[k + 1],
+                                              range(a[0] + b[0], hi + 1)))
+            if len(nodes) % 2 == 1:
+                merged.append(nodes[-1])
+            nodes = merged
+
+        # The sum at this position, over the values rest allows there
+        top = nodes[0][0][-1]
+        if last:
+            allowed = [rest] if rest <= top else []
+        else:
+            allowed = range(rest % SAT_DIGIT_BASE, top + 1, SAT_DIGIT_BASE)
+        if allowed == []:
+            solver.add_clause([])
+            return
+        (total_values, lits) = totalizer_merge(solver, nodes[0], ([0], []),
+                                               allowed)
+        carry = ([value // SAT_DIGIT_BASE for value in total_values], lits)
+        rest //= SAT_DIGIT_BASE
+    if positions == 0 and rest != 0:
+        solver.add_clause([])
+
+# Same contract as magic.solve(): returns the filled grid, or None if there
+# is no solution. ranges is the same as for magic.solve().
+def solve_sat(grid, constraints, ranges=None):
+    n = len(grid)
+    (values, cells) = value_ranges(ranges, n)
+    if not givens_in_range(grid, values, cells): return None
+
+    # Start from the propagated domains, so the encoding is as small as it
+    # can be
+    state = SolverState([row[:] for row in grid], constraints, None, values,
+                        cells)
+    if state.is_complete(): return grid
+    if not state.propagate_all(): return None
+
+    # Wide ranges are written in digits, since a unary number per cell (and
+    # the totalizers over them) would grow with the range
+    wide = values.bits > TABLE_BITS
+    solver = SatSolver()
+    ids = {}
+    unaries = []
+    domains = []
+    for r in xrange(n):
+        for c in xrange(n):
+            if grid[r][c] != -1: continue
+            domain = state.domains[r][c]
+            ids[(r, c)] = len(unaries)
+            domains.append(domain)
+            if wide:
+                unaries.append(new_digits(solver, values.max[domain] -
+                                          values.min[domain]))
+                continue
+            cell_values = []
+            rest = domain
+            while rest != 0:
+                cell_values.append(values.min[rest])
+                rest &= rest - 1
+            unaries.append(new_unary(solver, cell_values))
+
+    for line in xrange(2 * n + 2):
+        rest = state.targets[line] - state.sums[line]
+        cells = [ids[(r, c)] for (r, c) in state.line_cells[line]
+                 if grid[r][c] == -1]
+        if wide:
+            rest -= sum(values.min[domains[k]] for k in cells)
+            encode_sum_digits(solver, cells, unaries, rest)
+        else:
+            encode_sum(solver, cells, unaries, domains, rest, values)
+
+    if not solver.solve(): return None
+
+    for (r, c), k in ids.iteritems():
+        if wide:
+            grid[r][c] = (values.min[domains[k]] +
+                          digits_value(solver, unaries[k]))
+            continue
+        (cell_values, lits) = unaries[k]
+        grid[r][c] = cell_values[sum(1 for lit in lits
+                                     if solver.value(lit >> 1))]
+    return grid
@@ -1,35 +1,64 @@
 ''' 
 Contains optimal (conflict-directed backjumping) solution.
+
+The search never copies its state. Every change to a domain or a conflict set
+is pushed on a trail, and backjumping pops the trail back to the mark saved
+when the target variable was assigned. Domains are bitmasks over the values
+0..9 and conflict sets are bitsets over search depths, so the most recent
+culprit of a conflict is just the highest set bit.
 '''
 
-from copy import deepcopy
 import sys
 
+# Bit v of a domain is set if value v is still possible
+DOMAIN_FULL = (1 << 10) - 1
+DOMAIN_MIN = [None] + [(d & -d).bit_length() - 1 for d in xrange(1, 1 << 10)]
+DOMAIN_MAX = [None] + [d.bit_length() - 1 for d in xrange(1, 1 << 10)]
+DOMAIN_SIZE = [bin(d).count('1') for d in xrange(1 << 10)]
+
+def domain_range(lo, hi):
+	'''
+	Return the domain holding every value in lo..hi (0 if empty)
+	'''
+	lo = max(lo, 0)
+	hi = min(hi, 9)
+	if lo > hi:
+		return 0
+	return ((1 << (hi - lo + 1)) - 1) << lo
+
 class BackjumpSolution:
  	def __init__(self, filepath):
 		'''
 		grid: contains initial values
 		constr: list of ([(i1,j1), (i2,j2), ...], sum) constraints
 		variables: list of [(i1,j1), (i2,j2), ...] modifiable positions
-		domains: dict from (i,j) to [0,1,2...,9]
 		mapping: dict from (i,j) to k, inverse lookup of variables[k]
+		var_constr: list of constraint indices that contain variables[k]
+		constr_vars: list of variable indices k inside each constraint
 		'''
-		grid, constr, variables, domains, mapping = self.read_input(filepath)
+		grid, constr, variables, mapping = self.read_input(filepath)
 		self.grid = grid
 		self.constr = constr
 		self.variables = variables
-		self.domains = domains
 		self.mapping = mapping
 
+		self.var_constr = [[] for k in xrange(len(variables))]
+		self.constr_vars = []
+		for c in xrange(len(constr)):
+			nodes, total = constr[c]
+			self.constr_vars.append([mapping[node] for node in nodes
+									 if node in mapping])
+			for k in self.constr_vars[c]:
+				self.var_constr[k].append(c)
+
 	def read_input(self, filepath):
 		'''
-		Read input into grid, constr, variables, and domains
+		Read input into grid, constr, variables, and mapping
 		Each constraint is a tuple containing list of variables and desired sum
 		'''
 		grid = []
 		constr = []
 		variables = []
-		domains = {}
 
 		with open(filepath) as reader:
 			size = int(reader.readline().rstrip())
@@ -39,7 +68,6 @@ class BackjumpSolution:
 				for j in xrange(len(vals)):
 					if vals[j] == -1:
 						variables.append((i,j))
-						domains[(i,j)] = range(10)
 
 			row_sums = [int(x) for x in reader.readline().rstrip().split(' ')]
 			for i in xrange(len(row_sums)):
@@ -61,7 +89,7 @@ class BackjumpSolution:
 		for i in xrange(len(variables)):
 			mapping[variables[i]] = i
 
-		return grid, constr, variables, domains, mapping
+		return grid, constr, variables, mapping
 
 	def check_constr(self, grid):
 		'''
@@ -85,250 +113,248 @@ class BackjumpSolution:
 		return True
 
 	def solve(self):
-		grid = deepcopy(self.grid)
-		domains = deepcopy(self.domains)
-		variables = deepcopy(self.variables)
-		mapping = deepcopy(self.mapping)
-		assignments = [-1 for i in xrange(len(variables))]
-		conflicts = [[] for i in xrange(len(variables))]
+		'''
+		Conflict-directed backjumping. Each variable keeps a conflict set of
+		the depths of the assignments that pruned its domain. When a domain
+		runs out, jump back to the deepest variable in its conflict set (or
+		the previous one if it is empty) and hand the conflict set over.
+		'''
+		self.start_search()
 
 		# If there are no variables, just check constraints
-		if len(variables) == 0:
-			if self.check_constr(grid):
-				return self.print_result(grid)
+		if len(self.variables) == 0:
+			if self.check_constr(self.grid):
+				return self.print_result(self.grid)
 			else:
 				return self.print_result(None)
 
-		curr_index = 0
-		while(True):
-			if curr_index >= len(variables):
-				final_grid = self.fill_grid(grid, assignments, variables)
-				return self.print_result(final_grid)
-			if curr_index < 0:
-				return self.print_result(None)
-
-			(i, j) = variables[curr_index]
-			if len(domains[(i,j)]) == 0:
-				# Backtrack
-				conflict_set = conflicts[curr_index]
-				end_index = curr_index
-				if len(conflict_set) == 0:
-					curr_index -= 1
-					start_index = curr_index
+		if self.prune_domains(range(len(self.constr))) is not None:
+			return self.print_result(None)
+
+		order = self.order
+		marks = self.marks
+		domains = self.domains_left
+		conflicts = self.conflicts
+		self.push(self.mrv())
+
+		while True:
+			curr_index = len(order) - 1
+			k = order[curr_index]
+			domain = domains[k]
+
+			if domain == 0:
+				# Backjump to most recent element in conflict set
+				conflict_set = conflicts[k]
+				order.pop()
+				marks.pop()
+				self.depth[k] = -1
+				if conflict_set == 0:
+					target = curr_index - 1
 				else:
-					# Update index to most recent element in conflcit set
-					# Update conflict set of new index
-					curr_index = max(conflict_set)
-					start_index = curr_index
-					curr_conflict = conflicts[curr_index]
-					new_conflict = list(set().union(curr_conflict, conflict_set) - set([curr_index]))
-					conflicts[curr_index] = new_conflict
-
-				# Refresh assignments, domains, conflicts farther down the tree
-				for k in xrange(curr_index + 1, len(assignments)):
-					assignments[k] = -1
-					var_i, var_j = variables[k]
-					domains[(var_i, var_j)] = range(10)
-					conflicts[k] = []
-				if curr_index >= 0:
-					next_i, next_j = variables[curr_index]
-					domains[(next_i, next_j)].pop(0)
-					assignments[curr_index] = -1 
+					target = conflict_set.bit_length() - 1
+				if target < 0:
+					return self.print_result(None)
+
+				# Unassign everything farther down the tree, then undo all
+				# the pruning done since the target was assigned
+				while len(order) - 1 > target:
+					other = order.pop()
+					marks.pop()
+					self.depth[other] = -1
+					self.unassign(other)
+				target_k = order[target]
+				value = self.assignments[target_k]
+				self.undo(marks[target])
+				self.unassign(target_k)
+
+				# Target value is bad, and target inherits the conflict set
+				self.set_domain(target_k, domains[target_k] & ~(1 << value))
+				if conflict_set != 0:
+					self.set_conflict(target_k, conflicts[target_k] |
+									  (conflict_set & ~(1 << target)))
 				continue
 
-			assignments[curr_index] = domains[(i,j)][0]
-			tmp_grid = self.fill_grid(grid, assignments, variables)
+			value = DOMAIN_MIN[domain]
+			marks[curr_index] = len(self.trail)
+			self.assign(k, value)
 
 			# Prune domains and add conflicts
-			(check, prune_conflicts)= self.prune_domains(tmp_grid, 
-				assignments, domains, conflicts, variables, mapping)
-			if not check:
-				if len(domains[(i,j)]) == 0:
-					# Backtrack next loop
-					continue
-				domains[(i,j)].pop(0)
-				curr_conflict = conflicts[curr_index]
-				new_conflict = list(set().union(curr_conflict, prune_conflicts) - set([curr_index]))
-				conflicts[curr_index] = new_conflict
-				for k in xrange(curr_index + 1, len(assignments)):
-					assignments[k] = -1
-					var_i, var_j = variables[k]
-					domains[(var_i, var_j)] = range(10)
-					conflicts[k] = []
-				assignments[curr_index] = -1
-				continue
-
-			# Check for any constraint violations
-			if not self.check_constr(tmp_grid):
-				if len(domains[(i,j)]) == 0:
-					# Backtrack next loop
-					continue
-				domains[(i,j)].pop(0)
-				for k in xrange(curr_index + 1, len(assignments)):
-					assignments[k] = -1
-					var_i, var_j = variables[k]
-					domains[(var_i, var_j)] = range(10)
-					conflicts[k] = []
-				assignments[curr_index] = -1
+			prune_conflicts = self.prune_domains(self.var_constr[k])
+			if prune_conflicts is None:
+				if len(order) == len(self.variables):
+					return self.print_result(self.fill_grid())
+				self.push(self.mrv())
 				continue
 
-			curr_index += 1
-
-			variables, assignments = self.mrv(curr_index, variables, 
-				assignments, domains, mapping, conflicts)
-
-	def fill_grid(self, grid, assignments, variables):
-		grid = deepcopy(grid)
-		for k in xrange(len(variables)):
-			(i,j) = variables[k]
-			grid[i][j] = assignments[k]
-		return grid
+			# Bad value, undo its pruning and remember why it failed
+			self.undo(marks[curr_index])
+			self.unassign(k)
+			self.set_domain(k, domain & ~(1 << value))
+			self.set_conflict(k, conflicts[k] |
+							  (prune_conflicts & ~(1 << curr_index)))
 
-	def prune_domains(self, grid, assignments, domains, 
-					  conflicts, variables, mapping):
+	def start_search(self):
 		'''
-		Loop through each constraint, and remove impossible domain values.
-		Pruning needs to be done sufficiently well such that assigning any
-		value from a domain will not lead to a violated constraint in the next 
-		step. Whenever a domain is decreased, the conflict set is updated: add
-		all assigned nodes from the constraint and then union with the conflict
-		sets of the unassigned nodes.
-		If we find that variable has an empty domain, return False and the
-		conflict set of that variable.
+		Set up the search state. This is the only place anything is copied.
+		assignments: value of each variable, -1 if unassigned
+		domains_left: bitmask domain of each variable
+		conflicts: bitset of the depths each variable conflicts with
+		depth: position of each variable in order, -1 if not in order
+		order: variables in the order they were picked
+		marks: trail length before order[d] was given its current value
+		sums, free: running sum and unassigned count of each constraint
 		'''
-		for nodes, total in self.constr:
+		n = len(self.variables)
+		self.assignments = [-1] * n
+		self.domains_left = [DOMAIN_FULL] * n
+		self.conflicts = [0] * n
+		self.depth = [-1] * n
+		self.order = []
+		self.marks = []
+		self.trail = []
+
+		self.sums = []
+		self.free = []
+		for c in xrange(len(self.constr)):
+			nodes, total = self.constr[c]
 			nodes_sum = 0
-			found_empty = False
-			empty_nodes = []
 			for (i,j) in nodes:
-				if grid[i][j] == -1:
-					# Skip any constraints that are not all filled
-					empty_nodes.append((i,j))
-					continue
-				nodes_sum += int(grid[i][j])
+				if self.grid[i][j] != -1:
+					nodes_sum += int(self.grid[i][j])
+			self.sums.append(nodes_sum)
+			self.free.append(len(self.constr_vars[c]))
+
+	def push(self, k):
+		self.depth[k] = len(self.order)
+		self.order.append(k)
+		self.marks.append(len(self.trail))
+
+	def assign(self, k, value):
+		self.assignments[k] = value
+		for c in self.var_constr[k]:
+			self.sums[c] += value
+			self.free[c] -= 1
+
+	def unassign(self, k):
+		value = self.assignments[k]
+		self.assignments[k] = -1
+		for c in self.var_constr[k]:
+			self.sums[c] -= value
+			self.free[c] += 1
+
+	def set_domain(self, k, domain):
+		self.trail.append((self.domains_left, k, self.domains_left[k]))
+		self.domains_left[k] = domain
+
+	def set_conflict(self, k, conflict):
+		if conflict == self.conflicts[k]:
+			return
+		self.trail.append((self.conflicts, k, self.conflicts[k]))
+		self.conflicts[k] = conflict
+
+	def undo(self, mark):
+		'''
+		Pop the trail back to mark, restoring every domain and conflict set
+		'''
+		trail = self.trail
+		while len(trail) > mark:
+			(values, k, old) = trail.pop()
+			values[k] = old
 
-			if len(empty_nodes) == 1:
-				# There can only be one value for this empty_node
-				difference = total - nodes_sum
-				empty_node = empty_nodes[0]
-				old_domain = domains[empty_node]
-				domain = [x for x in old_domain if x == difference]
-				domains[empty_node] = domain
-				if len(domain) < len(old_domain):
-					# Check if pruned, then update conflict set
-					empty_index = mapping[empty_node]
-					for node in nodes:
-						if node not in mapping:
-							# Ignore non-variable nodes
-							continue
-						node_index = mapping[node]
-						if (node_index != empty_index and node_index not in conflicts[empty_index] and 
-							assignments[node_index] != -1):
-							# Add other assigned nodes from the given constraint to conflict set
-							conflicts[empty_index].append(node_index)
-						elif node_index != empty_index:
-							conflicts[empty_index] = list(set().union(conflicts[empty_index], conflicts[node_index]) - set([empty_index]))
-
-			elif len(empty_nodes) > 1:
-				for empty_node in empty_nodes:
-					# Domain values cannot be too big
-					old_domain = domains[empty_node]
-					min_total = nodes_sum
-					for other_node in empty_nodes:
-						if empty_node == other_node:
-							continue
-						if len(domains[other_node]) == 0:
-							# Found an empty domain, exit early
-							continue
-						min_total += min(domains[other_node])
-					upper_bound = total - min_total
-
-					domain = [x for x in old_domain if x <= upper_bound]
-
-					# Domain values cannot be too small
-					max_total = nodes_sum
-					for other_node in empty_nodes:
-						if empty_node == other_node:
-							continue
-						if len(domains[other_node]) == 0:
-							continue
-						max_total += max(domains[other_node])
-					lower_bound = total - max_total
-					if lower_bound >= 0:
-						domain = [x for x in domain if x >= lower_bound]
-
-					domains[empty_node] = domain
-					if len(domain) < len(old_domain):
-						# Update conflict set, since domain was pruned
-						empty_index = mapping[empty_node]
-
-						for node in nodes:
-							if node not in mapping:
-								# Ignore non-variable nodes
-								continue
-							node_index = mapping[node]
-							if (node_index != empty_index and 
-								node_index not in conflicts[empty_index] and 
-								assignments[node_index] != -1):
-								conflicts[empty_index].append(node_index)
-							elif node_index != empty_index:
-								conflicts[empty_index] = list(set().union(conflicts[empty_index], conflicts[node_index]) - set([empty_index]))
-
-		# Return False if any domains are empty
-		for k in xrange(len(variables)):
-			(i,j) = variables[k]
-			domain = domains[(i,j)]
-			if len(domain) == 0:
-				return (False, conflicts[k])
-		return (True, None)
-
-	def mrv(self, index, variables, assignments, domains, mapping, conflicts):
+	def explain(self, c, skip):
+		'''
+		Conflict set for a pruning done by constraint c: the depths of the
+		assigned variables in c, plus the conflict sets of the unassigned
+		ones (other than skip), since their domains shaped the bounds.
 		'''
-		Return a new copy of both variables and assignments such that
-		variables[index] contains the variable with the min number of
-		remaining values. Swap other data structures as necessary. 
+		conflict = 0
+		for k in self.constr_vars[c]:
+			if self.assignments[k] != -1:
+				conflict |= 1 << self.depth[k]
+			elif k != skip:
+				conflict |= self.conflicts[k]
+		return conflict
+
+	def prune_domains(self, constr_ids):
 		'''
-		variables = deepcopy(variables)
-		assignments = deepcopy(assignments)
+		Starting from the given constraints, remove impossible domain values
+		until nothing changes. Each unassigned variable in a constraint must
+		leave room for the others:
+			upper bound = total - sum - (min of the other unassigned)
+			lower bound = total - sum - (max of the other unassigned)
+		Whenever a domain is decreased, the conflict set is updated and the
+		other constraints of that variable are queued.
+		If a constraint can't be met or a domain empties, return the
+		conflict set of that failure. Return None otherwise.
+		'''
+		domains = self.domains_left
+		queue = list(constr_ids)
+		queued = set(queue)
+		while queue:
+			c = queue.pop()
+			queued.discard(c)
+
+			rest = self.constr[c][1] - self.sums[c]
+			empty_nodes = [k for k in self.constr_vars[c]
+						   if self.assignments[k] == -1]
+			min_total = 0
+			max_total = 0
+			for k in empty_nodes:
+				min_total += DOMAIN_MIN[domains[k]]
+				max_total += DOMAIN_MAX[domains[k]]
+			if min_total > rest or max_total < rest:
+				return self.explain(c, None)
+
+			for k in empty_nodes:
+				domain = domains[k]
+				lo = DOMAIN_MIN[domain]
+				hi = DOMAIN_MAX[domain]
+				lower_bound = rest - (max_total - hi)
+				upper_bound = rest - (min_total - lo)
+				if lower_bound <= lo and upper_bound >= hi:
+					continue
 
+				new_domain = domain & domain_range(lower_bound, upper_bound)
+				if new_domain == 0:
+					return self.conflicts[k] | self.explain(c, k)
+
+				self.set_domain(k, new_domain)
+				self.set_conflict(k, self.conflicts[k] | self.explain(c, k))
+				min_total += DOMAIN_MIN[new_domain] - lo
+				max_total += DOMAIN_MAX[new_domain] - hi
+				for other in self.var_constr[k]:
+					if other not in queued:
+						queued.add(other)
+						queue.append(other)
+		return None
+
+	def mrv(self):
+		'''
+		Return the unassigned variable not yet in order with the min number
+		of remaining values.
+		'''
 		minIndex = None
 		minValue = None
-		for i in xrange(index, index + len(variables[index:])):
-			if i == index and assignments[i] != -1:
-				# Index position is an assigned variable
-				return (variables, assignments)
-			elif assignments[i] != -1:
+		for k in xrange(len(self.variables)):
+			if self.depth[k] != -1:
 				continue
-			elif minIndex is None:
-				minIndex = i
-				minValue = len(domains[variables[i]])
-			elif len(domains[variables[i]]) < minValue:
-				minIndex = i
-				minValue = len(domains[variables[i]])
-
-		if minIndex is None:
-			return (variables, assignments)
-
-		# Swap current variable with minimum variable (move to 'front')
-		# Update variables, mapping, conflicts, assignments
-		tmp = variables[index]
-		variables[index] = variables[minIndex]
-		variables[minIndex] = tmp
-
-		mapping[variables[index]] = index
-		mapping[variables[minIndex]] = minIndex
-
-		tmp = deepcopy(conflicts[index])
-		conflicts[index] = deepcopy(conflicts[minIndex])
-		conflicts[minIndex] = tmp
-
-		tmp = assignments[index]
-		assignments[index] = assignments[minIndex]
-		assignments[minIndex] = tmp
-
-		return (variables, assignments)
+			size = DOMAIN_SIZE[self.domains_left[k]]
+			if minIndex is None or size < minValue:
+				minIndex = k
+				minValue = size
+		return minIndex
+
+	def fill_grid(self):
+		grid = [row[:] for row in self.grid]
+		for k in xrange(len(self.variables)):
+			(i,j) = self.variables[k]
+			grid[i][j] = self.assignments[k]
+		return grid
 
 	def print_result(self, grid):
+		'''
+		Print the result, and hand the grid back so solve() returns it
+		'''
 		if grid is None:
 			print 'False'
 		else:
@@ -336,6 +362,7 @@ class BackjumpSolution:
 			for i in xrange(len(grid)):
 				grid_str = [str(x) for x in grid[i]]
 				print ' '.join(grid_str)
+		return grid
 
 if __name__ == '__main__':
 	filename = sys.argv[1]
@@ -0,0 +1,212 @@
+'''
+============================ PERSISTENT SOLUTION CACHE ========================
+An on-disk cache of solved puzzles, shared by every run and process that opens
+the same file. It sits in front of magic.solve(), the SAT backend and the
+BackjumpSolution in solution/magic.py, so a puzzle that was solved once (by
+any of them) is answered straight from disk from then on.
+
+The key is the SHA-1 of the (grid, constraints) pair returned by read_input(),
+so only the exact same puzzle hits. Symmetric images of a puzzle are left to
+magic.SolutionCache, which works in memory. The value is the solution grid
+packed as a blob of machine ints (much quicker to read back than JSON), or
+NULL when the solver showed there is no solution.
+
+The cache is a SQLite table, kept by default under the user's cache directory
+($XDG_CACHE_HOME or ~/.cache) rather than next to the sources. Every entry
+carries the time it was last used (a counter, not the clock), and past
+--capacity entries the least recently used ones are evicted. The number of
+entries is kept in the file too, so adding a puzzle doesn't count the table.
+Writes don't wait for the disk (synchronous=OFF): a crash can lose the last
+few entries, but never hands out a wrong one. A hit only reads; the uses are
+written back TOUCH_BATCH at a time, and whenever a puzzle is added or the
+cache is closed.
+-------------------------------------------------------------------------------
+Usage: python solution_store.py [-s SOLVER] [-c CACHE] [-n CAPACITY] <file>
+===============================================================================
+'''
+
+import argparse
+import hashlib
+import imp
+import json
+import math
+import os
+import sqlite3
+import sys
+from array import array
+from StringIO import StringIO
+
+from magic import print_result, read_input, solve
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.expanduser(os.path.join('~', '.cache')),
+                            'magic_square', 'solutions.db')
+DEFAULT_CAPACITY = 100000
+# Uses of cached entries are written back in batches of this many
+TOUCH_BATCH = 100
+
+# The grid row by row, as an array of ints
+def encode_grid(grid):
+    if grid is None: return None
+    return sqlite3.Binary(array('i', [x for row in grid for x in row])
+                          .tostring())
+
+def decode_grid(blob):
+    if blob is None: return None
+    values = array('i')
+    values.fromstring(str(blob))
+    n = int(round(math.sqrt(len(values))))
+    return [values[r * n:(r + 1) * n].tolist() for r in xrange(n)]
+
+class DiskCache:
+    def __init__(self, path=DEFAULT_PATH, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS solutions '
+                        '(key TEXT PRIMARY KEY, solution BLOB, '
+                        'used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS solutions_used '
+                        'ON solutions (used)')
+        # One row holding the number of entries. Counted once, for a file
+        # made before it was kept.
+        self.db.execute('CREATE TABLE IF NOT EXISTS size (count INTEGER)')
+        self.db.execute('INSERT INTO size SELECT COUNT(*) FROM solutions '
+                        'WHERE NOT EXISTS (SELECT * FROM size)')
+        self.db.commit()
+        self.touched = []
+
+    @staticmethod
+    def key(grid, constraints):
+        puzzle = json.dumps([grid, [list(sums) for sums in constraints]],
+                            separators=(',', ':'))
+        return hashlib.sha1(puzzle).hexdigest()
+
+    # Newer than every use so far, also those of other processes
+    def next_use(self):
+        (used,) = self.db.execute('SELECT MAX(used) FROM solutions').fetchone()
+        return (used or 0) + 1
+
+    # Returns (found, solution), solution is None if there is none
+    def get(self, key):
+        row = self.db.execute('SELECT solution FROM solutions WHERE key = ?',
+                              (key,)).fetchone()
+        if row is None: return (False, None)
+        self.touched.append(key)
+        if len(self.touched) >= TOUCH_BATCH:
+            with self.db:
+                self.write_uses()
+        return (True, decode_grid(row[0]))
+
+    # Marks the entries hit since the last write as used, in the order they
+    # were hit. Runs inside the caller's transaction.
+    def write_uses(self):
+        use = self.next_use()
+        self.db.executemany('UPDATE solutions SET used = ? WHERE key = ?',
+                            [(use + k, key)
+                             for k, key in enumerate(self.touched)])
+        self.touched = []
+
+    def put(self, key, solution):
+        with self.db:
+            self.write_uses()
+            row = (encode_grid(solution), self.next_use(), key)
+            if self.db.execute('UPDATE solutions SET solution = ?, used = ? '
+                               'WHERE key = ?', row).rowcount > 0:
+                return
+            # Only a new entry can take the cache past its capacity
+            self.db.execute('INSERT INTO solutions (solution, used, key) '
+                            'VALUES (?, ?, ?)', row)
+            self.db.execute('UPDATE size SET count = count + 1')
+            self.evict()
+
+    # Drops the least recently used entries past the capacity. Runs inside
+    # the caller's transaction.
+    def evict(self):
+        excess = len(self) - self.capacity
+        if excess > 0:
+            evicted = self.db.execute(
+                'DELETE FROM solutions WHERE key IN '
+                '(SELECT key FROM solutions ORDER BY used LIMIT ?)',
+                (excess,)).rowcount
+            self.db.execute('UPDATE size SET count = count - ?', (evicted,))
+
+    def __len__(self):
+        return self.db.execute('SELECT count FROM size').fetchone()[0]
+
+    def close(self):
+        with self.db:
+            self.write_uses()
+        self.db.close()
+
+# Returns solver wrapped so that it goes through the cache first. solver
+# takes (grid, constraints) and returns the solution or None, like solve().
+def cached(cache, solver):
+    def cached_solver(grid, constraints):
+        key = DiskCache.key(grid, constraints)
+        (found, solution) = cache.get(key)
+        if found:
+            if solution is not None:
+                # Filled in place, like solve() does
+                for r in xrange(len(grid)):
+                    grid[r][:] = solution[r]
+                return grid
+            return None
+
+        solution = solver(grid, constraints)
+        cache.put(key, solution)
+        return solution
+    return cached_solver
+
+# Solves the puzzle file with the BackjumpSolution of solution/magic.py,
+# going through the cache first. Returns the solution or None.
+def solve_backjump(cache, path):
+    def solver(grid, constraints):
+        backjump = imp.load_source('backjump',
+                                   os.path.join(HERE, 'solution', 'magic.py'))
+        # It prints its result, which is returned by solve() too
+        out = StringIO()
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            return backjump.BackjumpSolution(path).solve()
+        finally:
+            sys.stdout = stdout
+
+    (grid, constraints) = read_input(path)
+    return cached(cache, solver)(grid, constraints)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Solve a magic square through the solution cache.')
+    parser.add_argument('filename')
+    parser.add_argument('-s', '--solver', default='magic',
+                        choices=['magic', 'sat', 'backjump'],
+                        help='solver used on a cache miss '
+                             '(default: %(default)s)')
+    parser.add_argument('-c', '--cache', default=DEFAULT_PATH,
+                        help='cache file (default: %(default)s)')
+    parser.add_argument('-n', '--capacity', type=int,
+                        default=DEFAULT_CAPACITY,
+                        help='most puzzles kept (default: %(default)s)')
+    args = parser.parse_args()
+
+    cache = DiskCache(args.cache, args.capacity)
+    try:
+        if args.solver == 'backjump':
+            grid = solve_backjump(cache, args.filename)
+        else:
+            if args.solver == 'sat':
+                from sat import solve_sat as solver
+            else:
+                solver = solve
+            (input_grid, constraints) = read_input(args.filename)
+            grid = cached(cache, solver)(input_grid, constraints)
+    finally:
+        cache.close()
+    print_result(grid)
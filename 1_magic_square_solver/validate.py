@@ -0,0 +1,161 @@
+'''
+=========================== BATCH SOLUTION VALIDATOR ==========================
+Checks the output of batch.py or farm.py in one go, instead of starting a
+check.py process for every puzzle. Needs NumPy.
+
+The JSON result lines are read from the files given (or stdin), and their
+puzzles are read back from the sources the lines name. Puzzles are grouped by
+size, and each group is stacked into (count, n, n) arrays, so every check
+below is one array operation over the whole group:
+    fixed   every given cell kept its value
+    range   every value is in D_MIN..D_MAX, or the --range given
+    rows, cols, diag, anti_diag   every line adds up to its constraint
+
+A puzzle whose source name contains _fail is expected to have no solution
+(like tests/sample2_fail.txt), every other puzzle to have one. Use
+--any-result to only check the solutions that were found.
+
+One JSON verdict is printed per result line, in the same order:
+    {"index": 0, "ok": false, "reason": "rows", "source": "tests/s.txt"}
+reason is null when ok is true, otherwise the first check that failed, or
+one of "expected", "timed_out", "shape" or "missing" (the puzzle couldn't be
+read back). A summary goes to stderr, and the exit status is 1 if any
+verdict failed.
+-------------------------------------------------------------------------------
+Usage: python batch.py tests/ | python validate.py
+       python validate.py results.jsonl [--any-result] [--range LO HI]
+===============================================================================
+'''
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from batch import iter_puzzles
+from magic import D_MAX, D_MIN
+
+CHECKS = ('fixed', 'range', 'rows', 'cols', 'diag', 'anti_diag')
+
+# Returns True if the puzzle at source is expected to have a solution
+def expects_solution(source):
+    return '_fail' not in os.path.basename(source)
+
+# Runs every check on a stack of same-sized puzzles. grids, solutions are
+# (count, n, n) arrays and rows, cols, diags are (count, n), (count, n) and
+# (count, 2). Values must be in lo..hi. Returns a dict from check name to a
+# boolean array over the stack.
+def check_stack(grids, solutions, rows, cols, diags, lo=D_MIN, hi=D_MAX):
+    n = grids.shape[1]
+    index = np.arange(n)
+    return {
+        'fixed': ((grids == -1) | (grids == solutions)).all(axis=(1, 2)),
+        'range': ((solutions >= lo) & (solutions <= hi)).all(axis=(1, 2)),
+        'rows': (solutions.sum(axis=2) == rows).all(axis=1),
+        'cols': (solutions.sum(axis=1) == cols).all(axis=1),
+        'diag': solutions[:, index, index].sum(axis=1) == diags[:, 0],
+        'anti_diag': (solutions[:, index, n - 1 - index].sum(axis=1) ==
+                      diags[:, 1]),
+    }
+
+# Reads every puzzle of the sources into a dict from (source, index) to
+# (grid, constraints). Sources that can't be read are left out.
+def load_puzzles(sources):
+    puzzles = {}
+    for source in sources:
+        if source == '-' or not os.path.isfile(source): continue
+        for (name, index, grid, constraints) in iter_puzzles([source]):
+            puzzles[(name, index)] = (grid, constraints)
+    return puzzles
+
+# Returns a (ok, reason) verdict for every result, in order
+def validate(results, puzzles, any_result=False, lo=D_MIN, hi=D_MAX):
+    verdicts = [None] * len(results)
+
+    # Verdicts that don't need a solution check, and solutions grouped by
+    # size for the rest
+    groups = {}
+    for k, result in enumerate(results):
+        key = (result['source'], result['index'])
+        if result.get('timed_out'):
+            verdicts[k] = (False, 'timed_out')
+        elif key not in puzzles:
+            verdicts[k] = (False, 'missing')
+        elif (not any_result and
+              result['result'] != expects_solution(result['source'])):
+            verdicts[k] = (False, 'expected')
+        elif not result['result']:
+            verdicts[k] = (True, None)
+        else:
+            (grid, constraints) = puzzles[key]
+            n = len(grid)
+            solution = result['grid']
+            if len(solution) != n or any(len(row) != n for row in solution):
+                verdicts[k] = (False, 'shape')
+            else:
+                groups.setdefault(n, []).append(k)
+
+    for n, members in groups.iteritems():
+        stacked = [puzzles[(results[k]['source'], results[k]['index'])]
+                   for k in members]
+        checks = check_stack(
+            np.array([grid for (grid, constraints) in stacked]),
+            np.array([results[k]['grid'] for k in members]),
+            np.array([constraints[0] for (grid, constraints) in stacked]),
+            np.array([constraints[1] for (grid, constraints) in stacked]),
+            np.array([constraints[2] for (grid, constraints) in stacked]),
+            lo, hi)
+
+        # The first failed check of every member, in CHECKS order
+        failed = np.array([~checks[name] for name in CHECKS])
+        first = failed.argmax(axis=0)
+        ok = ~failed.any(axis=0)
+        for i, k in enumerate(members):
+            if ok[i]:
+                verdicts[k] = (True, None)
+            else:
+                verdicts[k] = (False, CHECKS[first[i]])
+    return verdicts
+
+def read_results(paths):
+    results = []
+    for path in paths:
+        reader = sys.stdin if path == '-' else open(path)
+        try:
+            for line in reader:
+                if line.strip():
+                    results.append(json.loads(line))
+        finally:
+            if reader is not sys.stdin:
+                reader.close()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Validate batch.py/farm.py results.')
+    parser.add_argument('results', nargs='*', default=['-'],
+                        help='JSON lines files (default: stdin)')
+    parser.add_argument('-a', '--any-result', action='store_true',
+                        help="don't check whether a solution was expected")
+    parser.add_argument('-r', '--range', nargs=2, type=int,
+                        default=[D_MIN, D_MAX], metavar=('LO', 'HI'),
+                        help='values every cell may take '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    results = read_results(args.results)
+    sources = sorted(set(result['source'] for result in results))
+    verdicts = validate(results, load_puzzles(sources), args.any_result,
+                        *args.range)
+
+    failures = 0
+    for result, (ok, reason) in zip(results, verdicts):
+        failures += not ok
+        sys.stdout.write(json.dumps({'source': result['source'],
+                                     'index': result['index'], 'ok': ok,
+                                     'reason': reason}, sort_keys=True))
+        sys.stdout.write('\n')
+    sys.stderr.write('%d checked, %d failed\n' % (len(results), failures))
+    if failures: sys.exit(1)
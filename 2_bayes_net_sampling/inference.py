@@ -0,0 +1,408 @@
+'''
+Exact inference for the networks of sampling.py, by variable elimination or
+on a junction tree. Needs NumPy.
+
+A factor is a table over a few boolean variables, stored as a NumPy array
+with one axis of length 2 per variable (index 0 is false, 1 is true). Every
+CPT of the network becomes a factor over the variable and its parents. To
+answer a Query:
+    1) Variables that are neither the query, nor evidence, nor an ancestor
+       of either are dropped: they sum out to 1.
+    2) Evidence variables are fixed by slicing their axis out of every
+       factor.
+    3) The other hidden variables are eliminated one at a time, in min-fill
+       order: each step multiplies the factors that mention the variable and
+       sums it out, in one np.einsum call.
+    4) What is left is a factor over the query variable, which is
+       normalized into P(query | evidence).
+Min-fill picks the variable whose elimination adds the fewest new edges
+between its neighbours (ties go to the fewest neighbours, then the lowest
+id), which keeps the intermediate factors small.
+
+Variable elimination starts over for every query. For a workload of many
+queries on one network, a JunctionTree does the graph work once: the moral
+graph (every variable joined to its parents, and the parents to each other)
+is triangulated by a min-fill elimination of all the variables, the cliques
+that come out are joined into a tree, and every CPT is multiplied into the
+potential of a clique that holds its family. A query with new evidence then
+calibrates the tree by passing messages up to the root and back down, which
+gives the marginal of every variable at once. The marginals are cached per
+evidence set, so further queries with the same evidence (on any variable)
+are a lookup.
+
+The answer is exact, so it is also the ground truth for the samplers: with
+--errors, every sampler is run for a growing number of trials and its error
+and time are printed next to each other.
+
+Usage: python inference.py <network file> [--junction-tree] [--errors]
+                           [-n MAX_TRIALS]
+'''
+
+import argparse, sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+from sampling import BayesNet, Query, TALLIES
+
+# Most evidence sets a JunctionTree keeps the calibration of
+CALIBRATION_CACHE_SIZE = 1 << 12
+
+class Factor:
+    """
+    variables: list of variable ids, one per axis of table
+    table: NumPy array with an axis of length 2 per variable
+    """
+    def __init__(self, variables, table):
+        self.variables = variables
+        self.table = table
+
+    def restrict(self, evidence):
+        """
+        Returns the factor with the evidence variables fixed to their values
+        evidence: dictionary mapping variable id to True or False
+        """
+        if not any(v in evidence for v in self.variables):
+            return self
+        index = tuple(int(evidence[v]) if v in evidence else slice(None)
+                      for v in self.variables)
+        return Factor([v for v in self.variables if v not in evidence],
+                      self.table[index])
+
+def sum_product(factors, variables):
+    """
+    Returns the product of the factors with every variable but those of
+    variables (a list of ids, in the order of the result's axes) summed out.
+    Variables are numbered by id, which np.einsum takes as its axis labels,
+    so it only works for networks of up to 52 variables.
+    """
+    operands = []
+    for factor in factors:
+        operands.extend([factor.table, factor.variables])
+    operands.append(variables)
+    return Factor(variables, np.einsum(*operands))
+
+def multiply(factors, eliminate=None):
+    """
+    Returns the product of the factors, with the variable eliminate summed out
+    (unless it is None)
+    """
+    variables = set()
+    for factor in factors:
+        variables.update(factor.variables)
+    variables.discard(eliminate)
+    return sum_product(factors, sorted(variables))
+
+def cpt_factors(bayes_net):
+    """
+    Returns the list of the CPT factor of each variable, indexed by id
+    """
+    factors = []
+    for v, parents in enumerate(bayes_net.parent_ids):
+        # The compiled table has the first parent in the highest bit, so
+        # reshaped it has one axis per parent, in order
+        probs = np.array(bayes_net.tables[v]).reshape((2,) * len(parents))
+        factors.append(Factor(parents + [v],
+                              np.stack([1 - probs, probs], axis=-1)))
+    return factors
+
+def min_fill(scopes, hidden):
+    """
+    Eliminates the variables of hidden from the graph of the factors in
+    min-fill order. Yields (variable, neighbours), where neighbours is the
+    set of variables the variable was connected to when it was eliminated.
+    scopes: list of the variable lists of the factors
+    """
+    neighbors = {}
+    for scope in scopes:
+        for v in scope:
+            neighbors.setdefault(v, set()).update(scope)
+    for v in neighbors:
+        neighbors[v].discard(v)
+
+    def fill(v):
+        near = list(neighbors[v])
+        return sum(1 for i in xrange(len(near)) for j in xrange(i)
+                   if near[j] not in neighbors[near[i]])
+
+    remaining = set(hidden)
+    while remaining:
+        v = min(remaining, key=lambda v: (fill(v), len(neighbors[v]), v))
+        # Eliminating v connects all of its neighbours
+        for a in neighbors[v]:
+            neighbors[a].update(neighbors[v])
+            neighbors[a].discard(a)
+            neighbors[a].discard(v)
+        remaining.remove(v)
+        yield (v, neighbors.pop(v))
+
+def min_fill_order(scopes, hidden):
+    """
+    Returns the variables of hidden in min-fill elimination order
+    """
+    return [v for (v, near) in min_fill(scopes, hidden)]
+
+class VariableElimination:
+    """
+    bayes_net: the BayesNet queries are answered on
+    factors: list of the CPT factor of each variable, indexed by id
+    plans: dictionary mapping (query id, evidence ids) to the relevant
+           variables and elimination order, which only depend on which
+           variables are observed, not on their values
+    """
+    def __init__(self, bayes_net):
+        self.bayes_net = bayes_net
+        self.plans = {}
+        self.factors = cpt_factors(bayes_net)
+
+    def ancestors(self, variables):
+        """
+        Returns the set of the variables and all of their ancestors
+        """
+        found = set(variables)
+        stack = list(variables)
+        while stack:
+            for p in self.bayes_net.parent_ids[stack.pop()]:
+                if p not in found:
+                    found.add(p)
+                    stack.append(p)
+        return found
+
+    def probability(self, query=None):
+        """
+        Returns P(+query variable | evidence) exactly
+        query: Query object (default: the query of the network file)
+        """
+        ids = self.bayes_net.ids
+        if query is None: query = self.bayes_net.query
+        target = ids[query.variable]
+        evidence = dict((ids[letter], value)
+                        for letter, value in query.evidence.iteritems())
+        if target in evidence:
+            return float(evidence[target])
+
+        key = (target, frozenset(evidence))
+        if key not in self.plans:
+            relevant = sorted(self.ancestors([target] + evidence.keys()))
+            scopes = [[v for v in self.factors[u].variables
+                       if v not in evidence] for u in relevant]
+            hidden = [v for v in relevant
+                      if v != target and v not in evidence]
+            self.plans[key] = (relevant, min_fill_order(scopes, hidden))
+        (relevant, order) = self.plans[key]
+
+        factors = [self.factors[v].restrict(evidence) for v in relevant]
+        for v in order:
+            involved = [f for f in factors if v in f.variables]
+            factors = [f for f in factors if v not in f.variables]
+            factors.append(multiply(involved, v))
+
+        result = multiply(factors)
+        total = result.table.sum()
+        if total == 0:
+            raise ValueError('the evidence has probability 0')
+        return float(result.table[1] / total)
+
+class JunctionTree:
+    """
+    Built once per network (see BayesNet.junction_tree), then answers any
+    query on it by message passing.
+    bayes_net: the BayesNet queries are answered on
+    cliques: list of the variable lists (sorted ids) of the cliques
+    potentials: list of the potential of each clique, the product of the CPT
+                factors assigned to it, with an axis per clique variable
+    parents: list of the parent clique of each clique in the tree (None for
+             the root, clique 0)
+    children: list of the child cliques of each clique
+    separators: list of the variables each clique shares with its parent
+    order: list of the cliques, every one after its parent
+    home: list of the smallest clique containing each variable, indexed by id
+    calibrated: dictionary mapping evidence (frozenset of (id, value) pairs)
+                to the marginal P(+variable | evidence) of every variable,
+                read off the calibrated cliques (None if the evidence has
+                probability 0)
+    """
+    def __init__(self, bayes_net):
+        self.bayes_net = bayes_net
+        self.calibrated = {}
+        factors = cpt_factors(bayes_net)
+        families = [factor.variables for factor in factors]
+
+        # Triangulate the moral graph (every family connected) by eliminating
+        # all the variables. Each variable and its neighbours at the time it
+        # is eliminated are a clique, and the maximal ones are kept.
+        found = [near | set([v])
+                 for (v, near) in min_fill(families, xrange(len(families)))]
+        found.sort(key=len, reverse=True)
+        cliques = []
+        for clique in found:
+            if not any(clique <= other for other in cliques):
+                cliques.append(clique)
+        self.cliques = [sorted(clique) for clique in cliques]
+
+        # Join the cliques into a maximum spanning tree on separator size
+        # (Prim), which has the running intersection property. Cliques of
+        # unconnected parts of the network are joined by empty separators.
+        self.parents = [None] * len(cliques)
+        self.children = [[] for clique in cliques]
+        self.order = [0]
+        best = dict((c, (len(cliques[0] & cliques[c]), 0))
+                    for c in xrange(1, len(cliques)))
+        while best:
+            c = max(best, key=lambda c: (best[c][0], -c))
+            parent = best.pop(c)[1]
+            self.parents[c] = parent
+            self.children[parent].append(c)
+            self.order.append(c)
+            for d in best:
+                size = len(cliques[c] & cliques[d])
+                if size > best[d][0]:
+                    best[d] = (size, c)
+        self.separators = [None if p is None
+                           else sorted(cliques[c] & cliques[p])
+                           for c, p in enumerate(self.parents)]
+
+        self.home = [min((c for c in xrange(len(cliques)) if v in cliques[c]),
+                         key=lambda c: len(cliques[c]))
+                     for v in xrange(len(families))]
+
+        # Every CPT goes to the smallest clique that holds its whole family
+        assigned = [[] for clique in cliques]
+        for factor in factors:
+            family = set(factor.variables)
+            c = min((c for c in xrange(len(cliques)) if family <= cliques[c]),
+                    key=lambda c: len(cliques[c]))
+            assigned[c].append(factor)
+        self.potentials = [
+            sum_product([Factor(variables, np.ones((2,) * len(variables)))] +
+                        assigned[c], variables).table
+            for c, variables in enumerate(self.cliques)]
+
+    def calibrate(self, evidence):
+        """
+        Returns the marginal P(+variable | evidence) of every variable, or
+        None if the evidence has probability 0. The evidence zeroes out the
+        entries of the home clique of each evidence variable that disagree
+        with it. Messages are passed up from the leaves to the root, then
+        back down (Shafer-Shenoy: the message to a neighbour is the product
+        of the potential and the messages from every other neighbour), and
+        are normalized on the way so long chains don't underflow.
+        evidence: dictionary mapping variable id to True or False
+        """
+        potentials = list(self.potentials)
+        for v, value in evidence.iteritems():
+            c = self.home[v]
+            if potentials[c] is self.potentials[c]:
+                potentials[c] = potentials[c].copy()
+            index = [slice(None)] * len(self.cliques[c])
+            index[self.cliques[c].index(v)] = int(not value)
+            potentials[c][tuple(index)] = 0
+        clique_factors = [Factor(variables, potentials[c])
+                          for c, variables in enumerate(self.cliques)]
+
+        def message(c, incoming, variables):
+            result = sum_product([clique_factors[c]] + incoming, variables)
+            total = result.table.sum()
+            if total > 0:
+                result.table /= total
+            return result
+
+        up = [None] * len(self.cliques)
+        down = [None] * len(self.cliques)
+        for c in reversed(self.order[1:]):
+            up[c] = message(c, [up[k] for k in self.children[c]],
+                            self.separators[c])
+
+        marginals = [None] * len(self.home)
+        for c in self.order:
+            incoming = [up[k] for k in self.children[c]]
+            if down[c] is not None:
+                incoming.append(down[c])
+            for i, k in enumerate(self.children[c]):
+                down[k] = message(c, incoming[:i] + incoming[i + 1:],
+                                  self.separators[k])
+
+            belief = message(c, incoming, self.cliques[c])
+            if belief.table.sum() == 0:
+                return None
+            for v in self.cliques[c]:
+                if self.home[v] == c:
+                    marginals[v] = float(sum_product([belief], [v]).table[1])
+        return marginals
+
+    def probability(self, query=None):
+        """
+        Returns P(+query variable | evidence) exactly, calibrating the tree
+        for the evidence on its first use
+        query: Query object (default: the query of the network file)
+        """
+        ids = self.bayes_net.ids
+        if query is None: query = self.bayes_net.query
+        key = frozenset((ids[letter], value)
+                        for letter, value in query.evidence.iteritems())
+        if key not in self.calibrated:
+            if len(self.calibrated) >= CALIBRATION_CACHE_SIZE:
+                self.calibrated.clear()
+            self.calibrated[key] = self.calibrate(dict(key))
+        marginals = self.calibrated[key]
+        if marginals is None:
+            raise ValueError('the evidence has probability 0')
+        return marginals[ids[query.variable]]
+
+def sampler_errors(bayes_net, exact, max_trials):
+    """
+    Yields (sampler, trial count, estimate, error, seconds) for every sampler
+    and power of 10 of trials up to max_trials. Direct sampling ignores the
+    evidence, so it is measured against the query without evidence.
+    """
+    prior = exact.probability(Query(bayes_net.query.variable, []))
+    posterior = exact.probability()
+    samplers = [('direct', bayes_net.direct_sample, prior),
+                ('rejection', bayes_net.rejection_sample, posterior),
+                ('likelihood', bayes_net.likelihood_sample, posterior),
+                ('gibbs', bayes_net.gibbs_sample, posterior)]
+    for sampling_type in sorted(TALLIES):
+        if TALLIES[sampling_type][1] is None: continue
+        (name, method, truth) = samplers[sampling_type]
+        samplers.append(('numpy ' + name,
+                         getattr(bayes_net, 'batch_%s_sample' % name), truth))
+
+    for (name, method, truth) in samplers:
+        trial_count = 10
+        while trial_count <= max_trials:
+            start = timer()
+            estimate = method(trial_count)
+            elapsed = timer() - start
+            yield (name, trial_count, estimate, abs(estimate - truth), elapsed)
+            trial_count *= 10
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Answer the query of a Bayes net exactly.')
+    parser.add_argument('filename')
+    parser.add_argument('-j', '--junction-tree', action='store_true',
+                        help='answer on the junction tree of the network')
+    parser.add_argument('-e', '--errors', action='store_true',
+                        help='also print the error and time of every sampler')
+    parser.add_argument('-n', '--max-trials', type=int, default=100000,
+                        help='most trials per sampler with --errors '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    bayes_net = BayesNet(args.filename)
+    if args.junction_tree:
+        exact = bayes_net.junction_tree()
+    else:
+        exact = VariableElimination(bayes_net)
+    print exact.probability()
+
+    if args.errors:
+        repeats = 1000
+        start = timer()
+        for i in xrange(repeats):
+            exact.probability()
+        sys.stderr.write('exact: %.1f us per query\n' %
+                         ((timer() - start) / repeats * 1e6))
+        for row in sampler_errors(bayes_net, exact, args.max_trials):
+            sys.stderr.write('%-16s %8d trials  %.6f  error %.6f  %.4fs\n'
+                             % row)
@@ -4,24 +4,66 @@ Author: Sam Kim
 An exercise in bayes net sampling methods by implementing direct, rejection,
 likelihood, and Gibbs sampling.
 
+The direct, rejection and likelihood samplers also come in a vectorized
+version (batch_direct_sample, ...) that needs NumPy. Instead of one sample
+at a time, a whole batch of particles is sampled per variable, in
+topological order, as boolean arrays.
+
+Any sampler can also be run across a process pool (parallel_sample). The
+trials are split into chunks, each chunk is sampled with its own seed derived
+from the master seed, and the counts (or weights) of the chunks are added up
+before dividing. The result only depends on the master seed and the number of
+chunks, not on how many processes there are or which one ran which chunk.
+
+Usage: python sampling.py <network file> <trial count> <sampling type> [numpy]
+                          [-p PROCESSES] [-c CHUNKS] [-s SEED]
+Sampling types: 0 direct, 1 rejection, 2 likelihood, 3 gibbs. With numpy,
+types 0-2 use the vectorized samplers.
 '''
 
-import sys, random
+import argparse, hashlib, math, sys, random
+from multiprocessing import Pool, cpu_count
+
+# NumPy is optional, it's only needed by the batch samplers
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 random.seed(10000) # Use this seed (10000) when submitting to autolab
 
 DEBUG = 0
 
+# Most particles sampled at once by the batch samplers, to bound memory
+BATCH_SIZE = 1 << 20
+
+# Master seed of parallel_sample, the same as the seed above
+SEED = 10000
+
+# For each sampling type, the tally methods of the loop and batch samplers
+# (None if there is none), each with what its sampler does to the denominator
+# of its estimate (None if nothing): rejection_sample adds 1, while
+# batch_rejection_sample divides by at least 1
+TALLIES = {
+    0: (('direct_tally', None), ('batch_direct_tally', None)),
+    1: (('rejection_tally', lambda valid: valid + 1),
+        ('batch_rejection_tally', lambda valid: max(valid, 1))),
+    2: (('likelihood_tally', None), ('batch_likelihood_tally', None)),
+    3: (('gibbs_tally', None), None),
+}
+
 class BayesNet:
     """
     variables: dictionary mapping letter (ex: 'A') to a Variable object
     letters: list of letters in topological order
     query: Query object representing the query variable and evidence variables
+    tree: the JunctionTree of inference.py, once junction_tree has built it
     """
     def __init__(self, filepath):
         self.variables = {}
         self.letters = []
         self.query = None
+        self.tree = None
 
         with open(filepath) as reader:
             self.letters = reader.readline().rstrip().split(' ')
@@ -41,6 +83,8 @@ class BayesNet:
             dep_var = query_components.pop(0)
             self.query = Query(dep_var, query_components)
 
+        self.compile()
+
     def process_components(self, components):
         """
         Updates Bayes Net probabilities and structure. 
@@ -76,6 +120,73 @@ class BayesNet:
             if dep_var not in self.variables[parent].children:
                 self.variables[parent].children.append(dep_var)
 
+    def compile(self):
+        """
+        Compiles the network into flat lists, for the samplers' inner loops.
+        Letters are mapped to integer ids (their position in self.letters),
+        and a sample is a list of booleans indexed by id.
+        ids: dictionary mapping letter to id
+        parent_ids: list of the parent ids of each variable
+        tables: list of the CPT of each variable as a flat list, where entry i
+                is the probability given the parent values whose bits spell
+                out i, first parent in the highest bit (ex: parents ['C', 'D'],
+                index 2 -> +C -D). A variable without parents has a one entry
+                table, so every variable is looked up the same way.
+        child_ids: list of the child ids of each variable
+        """
+        self.ids = dict((letter, i) for i, letter in enumerate(self.letters))
+        self.parent_ids = []
+        self.tables = []
+        self.child_ids = []
+
+        for letter in self.letters:
+            variable = self.variables[letter]
+            k = len(variable.parents)
+            if k == 0:
+                table = [variable.probability]
+            else:
+                table = []
+                for index in xrange(1 << k):
+                    key = tuple(bool((index >> (k - 1 - i)) & 1)
+                                for i in xrange(k))
+                    table.append(variable.distribution[key])
+
+            self.parent_ids.append([self.ids[p] for p in variable.parents])
+            self.tables.append(table)
+            self.child_ids.append([self.ids[c] for c in variable.children])
+
+        if np is not None:
+            self.batch_tables = [np.array(table) for table in self.tables]
+
+        self.query_id = self.ids[self.query.variable]
+        # evidence[i] is the value variable i is fixed to, or None
+        self.evidence = [self.query.evidence.get(letter)
+                         for letter in self.letters]
+
+    def get_prob(self, i, values):
+        """
+        Compiled version of Variable.get_prob: probability that variable i is
+        true, given the values (list indexed by id) of its parents
+        """
+        index = 0
+        for p in self.parent_ids[i]:
+            index = (index << 1) | values[p]
+        return self.tables[i][index]
+
+    def junction_tree(self):
+        """
+        Returns the junction tree of the network, for exact answers to any
+        query (see inference.py, needs NumPy). It is built on the first call
+        and kept, along with the calibrations for the evidence it has seen,
+        so a workload of queries pays for the triangulation once and for
+        message passing once per evidence set.
+        """
+        if self.tree is None:
+            # inference imports this module, so it can't be imported above
+            from inference import JunctionTree
+            self.tree = JunctionTree(self)
+        return self.tree
+
     def sample(self, probability):
         """
         Use this function when generating random assignments.
@@ -88,49 +199,71 @@ class BayesNet:
         Example of a direct sampling implementation. Ignores evidence variables.
         You do not need to edit this.
         """
+        (count, trial_count) = self.direct_tally(trial_count)
+        return float(count) / trial_count
+
+    def direct_tally(self, trial_count):
+        """
+        The counts behind direct_sample: (query count, trial count)
+        """
         count = 0
+        variables = zip(self.parent_ids, self.tables)
+        values = [False] * len(self.letters)
+        sample = self.sample
 
         for i in xrange(trial_count):
-            values = {}
+            for v, (parent_ids, table) in enumerate(variables):
+                index = 0
+                for p in parent_ids:
+                    index = (index << 1) | values[p]
+                values[v] = sample(table[index])
 
-            for letter in self.letters:
-                prob = self.variables[letter].get_prob(values)
-                values[letter] = self.sample(prob)
-
-            if values[self.query.variable]:
+            if values[self.query_id]:
                 count += 1
 
-        return float(count) / trial_count
+        return (count, trial_count)
 
     def rejection_sample(self, trial_count):
         """
         Returns the estimated probability of the query using rejection method.
         Ignore any samples that result in any invalid evidence variables.
         """
+        (count, valid_trial_count) = self.rejection_tally(trial_count)
+        return float(count) / (valid_trial_count + 1)
+
+    def rejection_tally(self, trial_count):
+        """
+        The counts behind rejection_sample: (query count, valid trial count).
+        rejection_sample adds 1 to the valid trial count, so it never
+        divides by 0.
+        """
         count = 0
-        valid_trial_count = 1
+        valid_trial_count = 0
+        variables = zip(self.parent_ids, self.tables, self.evidence)
+        values = [False] * len(self.letters)
+        sample = self.sample
 
         for i in xrange(trial_count):
-            values = {}
-
             valid_sample = True
 
-            for letter in self.letters:
-                prob = self.variables[letter].get_prob(values)
-                values[letter] = self.sample(prob)
+            for v, (parent_ids, table, evidence) in enumerate(variables):
+                index = 0
+                for p in parent_ids:
+                    index = (index << 1) | values[p]
+                values[v] = sample(table[index])
 
-                if letter in self.query.evidence:
-                    if (self.query.evidence[letter] != values[letter]):
+                if evidence is not None:
+                    if (evidence != values[v]):
                         valid_sample = False
                         break
 
             if valid_sample:
                 valid_trial_count += 1
 
-                if values[self.query.variable]:
+                if values[self.query_id]:
                     count += 1
 
-        return float(count) / valid_trial_count
+        return (count, valid_trial_count)
 
     def likelihood_sample(self, trial_count):
         """
@@ -142,69 +275,90 @@ class BayesNet:
         At the end, we divide all the weights of the valid queries over the
         total weights.
         """
-        count = 0
+        (sum_query_weights, sum_total_weights) = \
+            self.likelihood_tally(trial_count)
+        return float(sum_query_weights) / sum_total_weights
+
+    def likelihood_tally(self, trial_count):
+        """
+        The weights behind likelihood_sample: (sum of the weights of the
+        samples where the query is true, sum of all weights)
+        """
 
         sum_query_weights = 0
         sum_total_weights = 0
+        variables = zip(self.parent_ids, self.tables, self.evidence)
+        values = [False] * len(self.letters)
+        sample = self.sample
 
         for i in xrange(trial_count):
-            values = {}
-
             sample_weight = 1.0
 
-            for letter in self.letters:
-                prob = self.variables[letter].get_prob(values)
+            for v, (parent_ids, table, evidence) in enumerate(variables):
+                index = 0
+                for p in parent_ids:
+                    index = (index << 1) | values[p]
+                prob = table[index]
 
                 # Fix the evidence variables
-                if letter in self.query.evidence:
-                    values[letter] = self.query.evidence[letter]
+                if evidence is not None:
+                    values[v] = evidence
 
-                    if (values[letter]):
+                    if (values[v]):
                         sample_weight *= prob
                     else:
                         sample_weight *= (1 - prob)
                 else:
-                    values[letter] = self.sample(prob)
+                    values[v] = sample(prob)
 
-            if values[self.query.variable]:
+            if values[self.query_id]:
                 sum_query_weights += sample_weight
 
             sum_total_weights += sample_weight
 
-        return float(sum_query_weights) / sum_total_weights
+        return (sum_query_weights, sum_total_weights)
 
     def gibbs_sample(self, trial_count):
         """
         Implement this!
         Returns the estimated probability of the query, using gibbs method.
         """
-        values = {}
+        (count, total_trials) = self.gibbs_tally(trial_count)
+        return float(count) / total_trials
+
+    def gibbs_tally(self, trial_count):
+        """
+        The counts behind gibbs_sample: (query count, total trials)
+        """
+        values = []
         count = total_trials = 0
+        get_prob = self.get_prob
+        sample = self.sample
 
         # Initialize
-        for letter in self.letters:
-            if (letter in self.query.evidence):
+        for v in xrange(len(self.letters)):
+            if (self.evidence[v] is not None):
                 # Fix evidence variables
-                values[letter] = self.query.evidence[letter]
+                values.append(self.evidence[v])
             else:
                 # Initialize non-evidence to True
-                values[letter] = True
+                values.append(True)
 
         # Collect non-evidence variables
-        non_evidence_letters = []
-        for letter in self.letters:
-            if (letter not in self.query.evidence):
-                non_evidence_letters.append(letter)
+        non_evidence_ids = []
+        for v in xrange(len(self.letters)):
+            if (self.evidence[v] is None):
+                non_evidence_ids.append(v)
 
         for i in xrange(trial_count):
-            for letter in non_evidence_letters:
+            for v in non_evidence_ids:
 
                 # Probability of x, given its parents
-                pos_prob = self.variables[letter].get_prob(values)
+                pos_prob = get_prob(v, values)
                 # Probability of x's children, given their parents
-                values[letter] = True # FIX TO BE TRUE
-                for child in self.variables[letter].children:
-                    child_prob = self.variables[child].get_prob(values)
+                values[v] = True # FIX TO BE TRUE
+                for child in self.child_ids[v]:
+                    child_prob = get_prob(child, values)
 
                     if (values[child]):
                         pos_prob *= child_prob
@@ -214,11 +368,11 @@ class BayesNet:
                 ### DO SAME THING FOR FALSE PROB
 
                 # Probability of x, given its parents
-                neg_prob = 1 - self.variables[letter].get_prob(values)
+                neg_prob = 1 - get_prob(v, values)
                 # Probability of x's children, given their parents
-                values[letter] = False # FIX TO BE FALSE
-                for child in self.variables[letter].children:
-                    child_prob = self.variables[child].get_prob(values)
+                values[v] = False # FIX TO BE FALSE
+                for child in self.child_ids[v]:
+                    child_prob = get_prob(child, values)
 
                     if (values[child]):
                         neg_prob *= child_prob
@@ -229,14 +383,128 @@ class BayesNet:
                 prob = pos_prob / (pos_prob + neg_prob)
 
                 ### SAMPLE
-                values[letter] = self.sample(prob)
+                values[v] = sample(prob)
 
-                if values[self.query.variable]:
+                if values[self.query_id]:
                     count += 1
 
                 total_trials += 1
 
-        return float(count) / total_trials 
+        return (count, total_trials)
+
+    def batch_rng(self):
+        """
+        Random generator of the batch samplers, seeded like random above
+        """
+        return np.random.RandomState(10000)
+
+    def sample_batch(self, size, rng, evidence=None):
+        """
+        Samples size particles at once. Every variable is sampled for all of
+        them in topological order, so its parents' arrays are ready when its
+        CPT is looked up, with the parents' bits packed into an index array
+        the same way as in compile.
+        evidence: list indexed by id of the values the evidence variables are
+                  fixed to (likelihood weighting), or None to sample every
+                  variable
+        Returns (values, weights): values is a list indexed by id of boolean
+        arrays over the particles, weights is the likelihood weight array of
+        the particles (None without evidence).
+        """
+        values = []
+        weights = None if evidence is None else np.ones(size)
+
+        for v in xrange(len(self.letters)):
+            index = np.zeros(size, dtype=np.intp)
+            for p in self.parent_ids[v]:
+                index <<= 1
+                index |= values[p]
+            prob = self.batch_tables[v][index]
+
+            if evidence is not None and evidence[v] is not None:
+                values.append(np.empty(size, dtype=bool))
+                values[v].fill(evidence[v])
+                weights *= prob if evidence[v] else 1 - prob
+            else:
+                values.append(rng.random_sample(size) < prob)
+
+        return (values, weights)
+
+    def batches(self, trial_count):
+        """
+        Sizes of the batches that trial_count particles are sampled in
+        """
+        for start in xrange(0, trial_count, BATCH_SIZE):
+            yield min(BATCH_SIZE, trial_count - start)
+
+    def batch_direct_sample(self, trial_count):
+        """
+        Vectorized direct_sample
+        """
+        (count, trial_count) = self.batch_direct_tally(trial_count,
+                                                       self.batch_rng())
+        return float(count) / trial_count
+
+    def batch_direct_tally(self, trial_count, rng):
+        """
+        Vectorized direct_tally, drawing from the RandomState rng
+        """
+        count = 0
+
+        for size in self.batches(trial_count):
+            (values, weights) = self.sample_batch(size, rng)
+            count += np.count_nonzero(values[self.query_id])
+
+        return (count, trial_count)
+
+    def batch_rejection_sample(self, trial_count):
+        """
+        Vectorized rejection_sample. Every particle is sampled in full, and
+        the ones that disagree with the evidence are masked out afterwards.
+        """
+        (count, valid_trial_count) = self.batch_rejection_tally(
+            trial_count, self.batch_rng())
+        return float(count) / max(valid_trial_count, 1)
+
+    def batch_rejection_tally(self, trial_count, rng):
+        """
+        Vectorized rejection_tally, drawing from the RandomState rng
+        """
+        count = valid_trial_count = 0
+
+        for size in self.batches(trial_count):
+            (values, weights) = self.sample_batch(size, rng)
+
+            valid = np.ones(size, dtype=bool)
+            for v, value in enumerate(self.evidence):
+                if value is not None:
+                    valid &= values[v] == value
+
+            valid_trial_count += np.count_nonzero(valid)
+            count += np.count_nonzero(valid & values[self.query_id])
+
+        return (count, valid_trial_count)
+
+    def batch_likelihood_sample(self, trial_count):
+        """
+        Vectorized likelihood_sample
+        """
+        (sum_query_weights, sum_total_weights) = self.batch_likelihood_tally(
+            trial_count, self.batch_rng())
+        return float(sum_query_weights) / sum_total_weights
+
+    def batch_likelihood_tally(self, trial_count, rng):
+        """
+        Vectorized likelihood_tally, drawing from the RandomState rng
+        """
+        sum_query_weights = sum_total_weights = 0.0
+
+        for size in self.batches(trial_count):
+            (values, weights) = self.sample_batch(size, rng, self.evidence)
+            sum_query_weights += float(weights[values[self.query_id]].sum())
+            sum_total_weights += float(weights.sum())
+
+        return (sum_query_weights, sum_total_weights)
 
 class Variable:
     """
@@ -274,6 +542,63 @@ class Query:
             self.evidence[s[1]] = (s[0] == "+")
             # {'B':True, 'C':False}
 
+def chunk_seed(seed, k):
+    """
+    Seed of chunk k of a parallel run with master seed seed. Hashing keeps
+    the seeds of neighbouring chunks (and master seeds) unrelated, and fits
+    them in 32 bits for NumPy's RandomState.
+    """
+    return int(hashlib.sha1('%d %d' % (seed, k)).hexdigest()[:8], 16)
+
+def split_trials(trial_count, chunks):
+    """
+    Splits trial_count into chunks counts that differ by at most 1
+    """
+    (size, extra) = divmod(trial_count, chunks)
+    return [size + (k < extra) for k in xrange(chunks)]
+
+def run_tally(args):
+    """
+    Runs in a worker: tallies one chunk of trials with the chunk's own seed.
+    Loop samplers draw from the global random module, which is reseeded here;
+    every worker is its own process, so that doesn't touch the others.
+    """
+    (bayes_net, name, trial_count, seed) = args
+    if name.startswith('batch_'):
+        return getattr(bayes_net, name)(trial_count,
+                                        np.random.RandomState(seed))
+    random.seed(seed)
+    return getattr(bayes_net, name)(trial_count)
+
+def parallel_sample(bayes_net, sampling_type, trial_count, processes=None,
+                    chunks=None, seed=SEED, batch=False):
+    """
+    Returns the estimate of the sampler of sampling_type (see TALLIES), with
+    the trials split into chunks (default: one per process) over a pool of
+    processes (default: one per core). Gibbs runs one chain per chunk. Counts
+    are added as ints and weights with math.fsum, in chunk order, so the
+    same seed and chunk count always give the same estimate. Like the
+    samplers themselves, raises ZeroDivisionError when there is nothing to
+    divide by (no trials, or only zero likelihood weights).
+    """
+    (name, adjust) = TALLIES[sampling_type][int(batch)]
+    if processes is None: processes = cpu_count()
+    if chunks is None: chunks = processes
+
+    tasks = [(bayes_net, name, count, chunk_seed(seed, k))
+             for k, count in enumerate(split_trials(trial_count, chunks))]
+    pool = Pool(processes)
+    try:
+        tallies = pool.map(run_tally, tasks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    numerator = math.fsum(tally[0] for tally in tallies)
+    denominator = math.fsum(tally[1] for tally in tallies)
+    if adjust is not None: denominator = adjust(denominator)
+    return numerator / denominator
+
 if __name__ == '__main__':
     # filename = sys.argv[1]
     # bayes_net = BayesNet(filename)
@@ -290,12 +615,48 @@ if __name__ == '__main__':
     # for i in xrange(1, 50):
     #     print bayes_net.gibbs_sample(i)
 
-    filename = sys.argv[1]
-    trial_count = int(sys.argv[2])
-    sampling_type = int(sys.argv[3])
+    parser = argparse.ArgumentParser(description='Sample a Bayes net.')
+    parser.add_argument('filename')
+    parser.add_argument('trial_count', type=int)
+    parser.add_argument('sampling_type', type=int, choices=sorted(TALLIES),
+                        help='0 direct, 1 rejection, 2 likelihood, 3 gibbs')
+    parser.add_argument('engine', nargs='?', choices=['loop', 'numpy'],
+                        default='loop',
+                        help='numpy for the vectorized samplers '
+                             '(default: %(default)s)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='sample across this many processes '
+                             '(default: none, sample in this one)')
+    parser.add_argument('-c', '--chunks', type=int, default=None,
+                        help='chunks the trials are split into with -p '
+                             '(default: one per process)')
+    parser.add_argument('-s', '--seed', type=int, default=SEED,
+                        help='master seed of the chunks with -p '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    filename = args.filename
+    trial_count = args.trial_count
+    sampling_type = args.sampling_type
     bayes_net = BayesNet(filename)
-
-    if sampling_type == 0:
+    if args.engine == 'numpy':
+        if np is None:
+            sys.exit('The numpy samplers need NumPy')
+        if sampling_type == 3:
+            sys.exit('There is no numpy Gibbs sampler')
+
+    if args.processes is not None or args.chunks is not None:
+        print parallel_sample(bayes_net, sampling_type, trial_count,
+                              args.processes, args.chunks, args.seed,
+                              args.engine == 'numpy')
+    elif args.engine == 'numpy':
+        if sampling_type == 0:
+            print bayes_net.batch_direct_sample(trial_count)
+        elif sampling_type == 1:
+            print bayes_net.batch_rejection_sample(trial_count)
+        elif sampling_type == 2:
+            print bayes_net.batch_likelihood_sample(trial_count)
+    elif sampling_type == 0:
         print bayes_net.direct_sample(trial_count)
     elif sampling_type == 1:
         print bayes_net.rejection_sample(trial_count)
@@ -0,0 +1,65 @@
+'''
+Checks that parallel_sample gives the same estimate as the sampler it
+parallelizes. With one chunk, the parallel run draws exactly the samples the
+single-process sampler draws when it is seeded with that chunk's seed, so the
+two estimates must be equal, down to how the counts are divided. Where the
+sampler can't divide, parallel_sample must fail the same way.
+
+Usage: python test_sampling.py
+'''
+
+import os, random, unittest
+
+from sampling import BayesNet, SEED, chunk_seed, np, parallel_sample
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NETWORKS = ['sample.txt', 'burglary.txt']
+# Small counts too, where adding 1 to the valid trial count shows the most
+TRIAL_COUNTS = [1, 5, 10, 100, 5000]
+
+def load(network):
+    return BayesNet(os.path.join(HERE, 'tests', network))
+
+class RejectionTest(unittest.TestCase):
+    def test_loop(self):
+        for network in NETWORKS:
+            bayes_net = load(network)
+            for trial_count in TRIAL_COUNTS:
+                estimate = parallel_sample(bayes_net, 1, trial_count,
+                                           processes=1, chunks=1)
+                random.seed(chunk_seed(SEED, 0))
+                self.assertEqual(estimate,
+                                 bayes_net.rejection_sample(trial_count),
+                                 (network, trial_count))
+
+    @unittest.skipIf(np is None, 'the batch samplers need NumPy')
+    def test_batch(self):
+        for network in NETWORKS:
+            bayes_net = load(network)
+            # batch_rng is replaced on its own copy, the one sent to the
+            # pool has to stay picklable
+            serial = load(network)
+            serial.batch_rng = lambda: np.random.RandomState(
+                chunk_seed(SEED, 0))
+            for trial_count in TRIAL_COUNTS:
+                estimate = parallel_sample(bayes_net, 1, trial_count,
+                                           processes=1, chunks=1, batch=True)
+                self.assertEqual(estimate,
+                                 serial.batch_rejection_sample(trial_count),
+                                 (network, trial_count))
+
+class NoTrialsTest(unittest.TestCase):
+    def test_direct(self):
+        bayes_net = load(NETWORKS[0])
+        self.assertRaises(ZeroDivisionError, bayes_net.direct_sample, 0)
+        self.assertRaises(ZeroDivisionError, parallel_sample, bayes_net, 0, 0,
+                          processes=1, chunks=1)
+
+    def test_likelihood(self):
+        bayes_net = load(NETWORKS[0])
+        self.assertRaises(ZeroDivisionError, bayes_net.likelihood_sample, 0)
+        self.assertRaises(ZeroDivisionError, parallel_sample, bayes_net, 2, 0,
+                          processes=1, chunks=1)
+
+if __name__ == '__main__':
+    unittest.main()